@@ -10,8 +10,15 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
-import pbr.version
 
+def __getattr__(name):
+    # NOTE(armax): pbr, and looking the version up in the package metadata,
+    # take longer than importing most of the package, only do it when asked
+    # (module __getattr__ requires Python 3.7).
+    if name == '__version__':
+        import pbr.version
 
-__version__ = pbr.version.VersionInfo(
-    's3uploader').version_string()
+        version = pbr.version.VersionInfo('s3uploader').version_string()
+        globals()['__version__'] = version
+        return version
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
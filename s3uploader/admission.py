@@ -0,0 +1,281 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Admission control of the requests bound to S3.
+
+When S3 slows down, requests pile up in the workers and every caller ends
+up waiting on them. A limited endpoint serves up to a number of requests
+at once, a bounded number of others wait for a slot for a bounded time,
+and the rest are failed fast with a 503 and a Retry-After header: the
+requests admitted keep being served in time.
+
+The limit can also adapt to S3, by additive increase and multiplicative
+decrease: it is cut whenever a request is slower than the latency target
+(or S3 did not answer in time), and grows back by one for every limit's
+worth of requests served in time, up to the configured limit.
+"""
+
+import asyncio
+import collections
+import contextlib
+import os
+import threading
+import time
+
+from s3uploader import constants
+from s3uploader import exceptions
+from s3uploader import metrics
+from s3uploader import s3
+
+
+class Limit(object):
+    """A fixed concurrency limit."""
+
+    def __init__(self, limit):
+        self.max_limit = limit
+        self.value = float(limit)
+
+    @property
+    def current(self):
+        """The number of requests that may be served at once."""
+        return max(int(self.value), 1)
+
+    def update(self, elapsed, timed_out=False):
+        """Account for a request served in elapsed seconds."""
+
+
+class AIMDLimit(Limit):
+    """A concurrency limit adapting to the latency of the requests.
+
+    :param latency_target: the seconds above which a request is too slow.
+    :param backoff_ratio: what the limit is multiplied by when it is.
+    """
+
+    def __init__(self, limit,
+                 latency_target=constants.ADMISSION_LATENCY_TARGET,
+                 backoff_ratio=constants.ADMISSION_BACKOFF_RATIO, min_limit=1,
+                 clock=time.monotonic):
+        super(AIMDLimit, self).__init__(limit)
+        self.latency_target = latency_target
+        self.backoff_ratio = backoff_ratio
+        self.min_limit = min_limit
+        self._clock = clock
+        self._backoff_until = None
+
+    def update(self, elapsed, timed_out=False):
+        if timed_out or elapsed > self.latency_target:
+            # NOTE(armax): the requests in flight when S3 slowed down all
+            # come back slow, only cut the limit once per latency target.
+            now = self._clock()
+            if self._backoff_until is None or now >= self._backoff_until:
+                self.value = max(self.value * self.backoff_ratio,
+                                 self.min_limit)
+                self._backoff_until = now + self.latency_target
+        else:
+            self.value = min(self.value + 1.0 / self.value, self.max_limit)
+
+
+class Limiter(object):
+    """Admit the requests to an endpoint, made by concurrent threads.
+
+    :param limit: the Limit of the requests served at once.
+    :param queue_size: how many requests may wait for a slot.
+    :param queue_timeout: how long (in seconds) they may wait, 0 to reject
+                          the requests over the limit at once.
+    :param retry_after: the seconds rejected callers are told to wait.
+    """
+
+    def __init__(self, name, limit, queue_size=constants.ADMISSION_QUEUE_SIZE,
+                 queue_timeout=constants.ADMISSION_QUEUE_TIMEOUT,
+                 retry_after=constants.ADMISSION_RETRY_AFTER):
+        self.name = name
+        self.limit = limit
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.in_flight = 0
+        self.queued = 0
+        self._lock = threading.Lock()
+        self._slot_freed = threading.Condition(self._lock)
+        metrics.ADMISSION_LIMIT.set(limit.current, name)
+
+    def acquire(self):
+        """Wait for a slot to serve a request.
+
+        :raises AssetOverloadedError: if the queue is full, or no slot was
+                                      freed in time.
+        """
+        with self._lock:
+            if self.in_flight < self.limit.current:
+                self.in_flight += 1
+                return
+            self._check_queue()
+            expires_at = time.monotonic() + self.queue_timeout
+            self._set_queued(self.queued + 1)
+            try:
+                while self.in_flight >= self.limit.current:
+                    remaining = expires_at - time.monotonic()
+                    if remaining <= 0:
+                        raise self._reject('queue_timeout')
+                    self._slot_freed.wait(remaining)
+            finally:
+                self._set_queued(self.queued - 1)
+            self.in_flight += 1
+
+    def release(self, elapsed, error=None):
+        """Free the slot of a request served in elapsed seconds."""
+        with self._lock:
+            self.in_flight -= 1
+            self._update(elapsed, error)
+            free = self.limit.current - self.in_flight
+            if free > 0:
+                self._slot_freed.notify(free)
+
+    @contextlib.contextmanager
+    def admit(self):
+        """Hold a slot while serving a request, see acquire."""
+        self.acquire()
+        started_at = time.perf_counter()
+        error = None
+        try:
+            yield
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self.release(time.perf_counter() - started_at, error)
+
+    def _check_queue(self):
+        if not self.queue_timeout or self.queued >= self.queue_size:
+            raise self._reject('queue_full')
+
+    def _set_queued(self, queued):
+        self.queued = queued
+        metrics.ADMISSION_QUEUED.set(queued, self.name)
+
+    def _reject(self, reason):
+        metrics.ADMISSION_REJECTED.inc(self.name, reason)
+        return exceptions.AssetOverloadedError(self.retry_after)
+
+    def _update(self, elapsed, error):
+        self.limit.update(
+            elapsed, isinstance(error, exceptions.AssetTimeoutError))
+        metrics.ADMISSION_LIMIT.set(self.limit.current, self.name)
+
+
+class AsyncLimiter(Limiter):
+    """Admit the requests to an endpoint, made by concurrent coroutines.
+
+    The requests waiting for a slot get it in turn.
+    """
+
+    def __init__(self, name, limit, queue_size=constants.ADMISSION_QUEUE_SIZE,
+                 queue_timeout=constants.ADMISSION_QUEUE_TIMEOUT,
+                 retry_after=constants.ADMISSION_RETRY_AFTER):
+        super(AsyncLimiter, self).__init__(
+            name, limit, queue_size=queue_size, queue_timeout=queue_timeout,
+            retry_after=retry_after)
+        self._waiters = collections.deque()
+
+    async def acquire(self):
+        """See Limiter.acquire."""
+        if self.in_flight < self.limit.current and not self._waiters:
+            self.in_flight += 1
+            return
+        self._check_queue()
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        self._set_queued(self.queued + 1)
+        try:
+            # the slot is handed over by release
+            await asyncio.wait_for(waiter, self.queue_timeout)
+        except BaseException as e:
+            if waiter.done() and not waiter.cancelled():
+                # handed a slot just as the wait was given up on
+                self._release_slot()
+            if isinstance(e, asyncio.TimeoutError):
+                raise self._reject('queue_timeout')
+            raise
+        finally:
+            self._set_queued(self.queued - 1)
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+
+    def release(self, elapsed, error=None):
+        """See Limiter.release."""
+        self._update(elapsed, error)
+        self._release_slot()
+
+    @contextlib.asynccontextmanager
+    async def admit(self):
+        """See Limiter.admit."""
+        await self.acquire()
+        started_at = time.perf_counter()
+        error = None
+        try:
+            yield
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self.release(time.perf_counter() - started_at, error)
+
+    def _release_slot(self):
+        self.in_flight -= 1
+        while self._waiters and self.in_flight < self.limit.current:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(None)
+
+
+def build_limiters(config, limiter_class=Limiter):
+    """Return the limiters of the endpoints limited by config, by name."""
+    limiters = {}
+    for name, limit in config.concurrency_limits.items():
+        if config.adaptive_limits:
+            limit = AIMDLimit(limit, config.latency_target)
+        else:
+            limit = Limit(limit)
+        limiters[name] = limiter_class(
+            name, limit, queue_size=config.queue_size,
+            queue_timeout=config.queue_timeout,
+            retry_after=config.retry_after)
+    return limiters
+
+
+_limiters_lock = threading.Lock()
+_limiters = None
+
+
+def get_limiter(name):
+    """Return the process-wide Limiter of an endpoint, None if it is not
+    limited.
+    """
+    global _limiters
+    if _limiters is None:
+        with _limiters_lock:
+            if _limiters is None:
+                _limiters = build_limiters(s3.get_config())
+    return _limiters.get(name)
+
+
+def reset_limiters():
+    """Drop the process-wide limiters, e.g. after a fork."""
+    global _limiters, _limiters_lock
+    # NOTE(armax): the requests in flight at fork time are not the child's.
+    _limiters_lock = threading.Lock()
+    _limiters = None
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reset_limiters)
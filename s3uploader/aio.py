@@ -0,0 +1,488 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Asyncio flavour of the asset and S3 managers (Python 3.5+ only)."""
+
+import asyncio
+
+from botocore import exceptions as boto_exc
+from werkzeug import exceptions as werkzeug_exc
+
+from s3uploader import calls
+from s3uploader import constants
+from s3uploader import exceptions
+from s3uploader import metrics
+from s3uploader import routing
+from s3uploader import s3
+from s3uploader import singleflight
+
+
+LOG = s3.LOG
+
+
+class AsyncAssetManager(s3.AssetManager):
+    """See s3.AssetManager.
+
+    The state store, if any, is blocking: it is called from the default
+    executor, off the event loop.
+    """
+
+    async def create_asset(self):
+        asset_id = self._generate_uuid()
+        url = await self.storage_manager.get_url_for_upload(asset_id)
+        if self.state_store is not None:
+            await self._run_blocking(self.state_store.create, asset_id)
+        return s3.Asset(url, asset_id)
+
+    async def create_assets(self, count):
+        asset_ids = [self._generate_uuid() for _ in range(count)]
+        urls = await self.storage_manager.get_urls_for_upload(asset_ids)
+        if self.state_store is not None:
+            for asset_id in asset_ids:
+                await self._run_blocking(self.state_store.create, asset_id)
+        return [s3.Asset(url, asset_id)
+                for url, asset_id in zip(urls, asset_ids)]
+
+    async def update_asset(self, asset_id, size=None):
+        if self.state_store is not None:
+            await self._run_blocking(self.state_store.mark_uploaded,
+                                     asset_id, size)
+        elif self.write_behind is not None:
+            # NOTE(armax): appending waits for the journal to hit the disk.
+            await self._run_blocking(self.write_behind.append, asset_id)
+            self.storage_manager.remember_uploaded(asset_id)
+        else:
+            await self.storage_manager.update_upload_status(asset_id)
+
+    async def get_asset(self, asset_id, timeout, region=None):
+        if self.state_store is not None:
+            state = await self._get_state(asset_id)
+            url = None
+            if state.uploaded:
+                try:
+                    # NOTE(armax): presigning does not involve any I/O.
+                    url = self.storage_manager.presign_download(
+                        asset_id, timeout, region=region)
+                except boto_exc.BotoCoreError as e:
+                    LOG.error(e)
+                    raise exceptions.AssetError()
+            return s3.Asset(url, asset_id)
+        url = await self.storage_manager.get_url_for_download(
+            asset_id, timeout, region=region)
+        return s3.Asset(url, asset_id)
+
+    async def open_download(self, asset_id, byte_range=None,
+                            if_none_match=None):
+        """See s3.AssetManager.open_download."""
+        if not self.proxy:
+            raise werkzeug_exc.NotFound()
+        if self.state_store is not None:
+            uploaded = (await self._get_state(asset_id)).uploaded
+        else:
+            uploaded = await self.storage_manager.get_upload_status(asset_id)
+        if not uploaded:
+            return
+        return await self.storage_manager.open_download(
+            asset_id, byte_range, if_none_match, self.proxy_chunk_size)
+
+    async def get_assets(self, asset_ids, timeout, region=None):
+        if self.state_store is not None:
+            async def _get_asset(asset_id):
+                try:
+                    return await self.get_asset(asset_id, timeout, region)
+                except werkzeug_exc.HTTPException as e:
+                    return s3.Asset(None, asset_id, e)
+
+            return await asyncio.gather(*[_get_asset(asset_id)
+                                          for asset_id in asset_ids])
+        results = await self.storage_manager.get_urls_for_download(
+            asset_ids, timeout, region=region)
+        return [s3.Asset(url, asset_id, error)
+                for (url, error), asset_id in zip(results, asset_ids)]
+
+    async def list_assets(self, limit, cursor=None, status=None,
+                          created_after=None, created_before=None):
+        """See s3.AssetManager.list_assets."""
+        cursor = cursor or {}
+        if self.state_store is not None:
+            return await self._run_blocking(
+                self._list_stored_assets, limit, cursor, status,
+                created_after, created_before)
+        if cursor and 'token' not in cursor:
+            raise werkzeug_exc.BadRequest('cursor is invalid')
+        states, token = await self.storage_manager.list_assets(
+            limit, cursor.get('token'))
+        return [asset_state for asset_state in states if s3.state_matches(
+            asset_state, status, created_after, created_before)], (
+            {'token': token} if token else None)
+
+    async def create_multipart_asset(self, size, part_size=None):
+        part_size, part_numbers = self._plan_parts(size, part_size)
+        asset_id = self._generate_uuid()
+        upload_id = await self.storage_manager.create_multipart_upload(
+            asset_id)
+        if self.state_store is not None:
+            await self._run_blocking(self.state_store.create, asset_id)
+        urls = await self.storage_manager.get_urls_for_part_upload(
+            asset_id, upload_id, part_numbers, self.part_url_timeout)
+        return s3.MultipartUpload(asset_id, upload_id, part_size,
+                                  list(zip(part_numbers, urls)))
+
+    async def get_multipart_upload(self, asset_id, upload_id,
+                                   part_numbers=()):
+        parts = await self.storage_manager.list_parts(asset_id, upload_id)
+        urls = []
+        if part_numbers:
+            urls = await self.storage_manager.get_urls_for_part_upload(
+                asset_id, upload_id, part_numbers, self.part_url_timeout)
+        return s3.MultipartUpload(asset_id, upload_id,
+                                  part_urls=list(zip(part_numbers, urls)),
+                                  parts=parts)
+
+    async def complete_multipart_asset(self, asset_id, upload_id,
+                                       size=None):
+        size = await self.storage_manager.complete_multipart_upload(
+            asset_id, upload_id, size)
+        await self.update_asset(asset_id, size)
+
+    async def abort_multipart_asset(self, asset_id, upload_id):
+        await self.storage_manager.abort_multipart_upload(asset_id, upload_id)
+
+    async def _get_state(self, asset_id):
+        state = await self._run_blocking(self.state_store.get, asset_id)
+        if state is None:
+            raise exceptions.AssetNotFoundError()
+        return state
+
+    async def _run_blocking(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(
+            None, func, *args)
+
+
+class AsyncDownload(s3.Download):
+    """See s3.Download, iterated with async for."""
+
+    def __iter__(self):
+        raise TypeError('use async for')
+
+    async def __aiter__(self):
+        if self.body is None:
+            return
+        try:
+            while True:
+                chunk = await self.body.read(self.chunk_size)
+                if not chunk:
+                    break
+                metrics.PROXY_BYTES.inc(amount=len(chunk))
+                yield chunk
+        except Exception:
+            LOG.exception('Download of %s interrupted', self.asset_id)
+            raise
+        finally:
+            self.close()
+
+
+class AsyncS3Manager(object):
+    """Talk to S3 without blocking the event loop.
+
+    Presigning does not involve any I/O: it is delegated, along with the
+    caches, to a regular S3Manager. Only the requests that do hit S3 go
+    through the asyncio client.
+    """
+
+    def __init__(self, s3_manager, client, caller=None):
+        self.s3_manager = s3_manager
+        self.config = s3_manager.config
+        self.key_layout = s3_manager.key_layout
+        self.client = client
+        self.caller = caller or calls.AsyncCaller(client)
+        self._lookups = singleflight.AsyncGroup('get_object_tagging')
+
+    # NOTE(armax): the S3Manager times the calls delegated to it.
+
+    async def get_url_for_upload(self, asset_id):
+        return self.s3_manager.get_url_for_upload(asset_id)
+
+    async def get_urls_for_upload(self, asset_ids):
+        return self.s3_manager.get_urls_for_upload(asset_ids)
+
+    @metrics.timed('update_upload_status')
+    async def update_upload_status(self, asset_id):
+        readiness_cache = self.s3_manager.readiness_cache
+        try:
+            await self.caller(
+                'put_object_tagging',
+                Bucket=self.config.bucket,
+                Key=self.key_layout.key(asset_id),
+                Tagging=s3.UPLOADED_TAGGING)
+            self.remember_uploaded(asset_id)
+        except boto_exc.ClientError as e:
+            LOG.error(e)
+            # NOTE(armax): see s3.S3Manager.update_upload_status.
+            if readiness_cache is not None and not calls.is_retryable(e):
+                readiness_cache.invalidate(asset_id)
+            raise s3.asset_error(e)
+        except boto_exc.BotoCoreError as e:
+            LOG.error(e)
+            raise exceptions.AssetError()
+
+    def remember_uploaded(self, asset_id):
+        """See s3.S3Manager.remember_uploaded."""
+        self._lookups.forget(asset_id)
+        self.s3_manager.remember_uploaded(asset_id)
+
+    def presign_download(self, asset_id, timeout, region=None):
+        """See s3.S3Manager.presign_download, which involves no I/O."""
+        return self.s3_manager.presign_download(asset_id, timeout)
+
+    @metrics.timed('get_url_for_download')
+    async def get_url_for_download(self, asset_id, timeout, region=None):
+        try:
+            if not await self._is_uploaded(asset_id):
+                return
+            return self.s3_manager.presign_download(asset_id, timeout)
+        except boto_exc.ClientError as e:
+            LOG.error(e)
+            raise s3.asset_error(e)
+        except boto_exc.BotoCoreError as e:
+            LOG.error(e)
+            raise exceptions.AssetError()
+
+    @metrics.timed('get_urls_for_download')
+    async def get_urls_for_download(self, asset_ids, timeout, region=None):
+        # NOTE(armax): there is no thread to spare here, yet do not flood S3
+        # with a request per asset at once.
+        semaphore = asyncio.Semaphore(self.s3_manager.batch_workers)
+
+        async def _get_url(asset_id):
+            async with semaphore:
+                try:
+                    url = await self.get_url_for_download(asset_id, timeout)
+                    return url, None
+                except werkzeug_exc.HTTPException as e:
+                    return None, e
+
+        return await asyncio.gather(*[_get_url(i) for i in asset_ids])
+
+    @metrics.timed('get_upload_status')
+    async def get_upload_status(self, asset_id):
+        try:
+            return await self._is_uploaded(asset_id)
+        except boto_exc.ClientError as e:
+            LOG.error(e)
+            raise s3.asset_error(e)
+        except boto_exc.BotoCoreError as e:
+            LOG.error(e)
+            raise exceptions.AssetError()
+
+    @metrics.timed('open_download')
+    async def open_download(self, asset_id, byte_range=None,
+                            if_none_match=None,
+                            chunk_size=constants.PROXY_CHUNK_SIZE):
+        """See s3.S3Manager.open_download."""
+        kwargs = s3.get_object_conditions(byte_range, if_none_match)
+        try:
+            response = await self.caller(
+                'get_object',
+                Bucket=self.config.bucket,
+                Key=self.key_layout.key(asset_id),
+                **kwargs)
+        except boto_exc.ClientError as e:
+            if s3.is_not_modified(e):
+                return AsyncDownload(asset_id, 304,
+                                     s3.not_modified_headers(e))
+            LOG.error(e)
+            raise s3.asset_error(e)
+        except boto_exc.BotoCoreError as e:
+            LOG.error(e)
+            raise exceptions.AssetError()
+        return AsyncDownload(
+            asset_id, 206 if response.get('ContentRange') else 200,
+            s3.download_headers(response), response['Body'], chunk_size)
+
+    @metrics.timed('list_assets')
+    async def list_assets(self, page_size, continuation_token=None):
+        """See s3.S3Manager.list_assets."""
+        kwargs = {'Bucket': self.config.bucket, 'MaxKeys': page_size}
+        if continuation_token:
+            kwargs['ContinuationToken'] = continuation_token
+        try:
+            response = await self.caller('list_objects_v2', **kwargs)
+        except boto_exc.ClientError as e:
+            LOG.error(e)
+            raise s3.asset_error(e)
+        except boto_exc.BotoCoreError as e:
+            LOG.error(e)
+            raise exceptions.AssetError()
+        token = None
+        if response.get('IsTruncated'):
+            token = response.get('NextContinuationToken')
+        return s3.listed_states(response.get('Contents', []),
+                                self.key_layout,
+                                self.s3_manager.readiness_cache), token
+
+    @metrics.timed('create_multipart_upload')
+    async def create_multipart_upload(self, asset_id):
+        try:
+            response = await self.caller(
+                'create_multipart_upload',
+                Bucket=self.config.bucket,
+                Key=self.key_layout.key(asset_id))
+        except boto_exc.ClientError as e:
+            LOG.error(e)
+            raise s3.asset_error(e)
+        except boto_exc.BotoCoreError as e:
+            LOG.error(e)
+            raise exceptions.AssetError()
+        return response['UploadId']
+
+    async def get_urls_for_part_upload(self, asset_id, upload_id,
+                                       part_numbers, timeout):
+        return self.s3_manager.get_urls_for_part_upload(
+            asset_id, upload_id, part_numbers, timeout)
+
+    @metrics.timed('list_parts')
+    async def list_parts(self, asset_id, upload_id):
+        kwargs = {'Bucket': self.config.bucket,
+                  'Key': self.key_layout.key(asset_id),
+                  'UploadId': upload_id}
+        parts = []
+        try:
+            while True:
+                response = await self.caller('list_parts', **kwargs)
+                parts.extend(response.get('Parts', []))
+                if not response.get('IsTruncated'):
+                    return parts
+                kwargs['PartNumberMarker'] = response['NextPartNumberMarker']
+        except boto_exc.ClientError as e:
+            LOG.error(e)
+            raise s3.asset_error(e)
+        except boto_exc.BotoCoreError as e:
+            LOG.error(e)
+            raise exceptions.AssetError()
+
+    @metrics.timed('complete_multipart_upload')
+    async def complete_multipart_upload(self, asset_id, upload_id,
+                                        size=None):
+        parts = await self.list_parts(asset_id, upload_id)
+        total = s3.check_parts(parts, size)
+        try:
+            await self.caller(
+                'complete_multipart_upload',
+                Bucket=self.config.bucket,
+                Key=self.key_layout.key(asset_id),
+                UploadId=upload_id,
+                MultipartUpload=s3.completed_parts(parts))
+        except boto_exc.ClientError as e:
+            LOG.error(e)
+            raise s3.asset_error(e)
+        except boto_exc.BotoCoreError as e:
+            LOG.error(e)
+            raise exceptions.AssetError()
+        return total
+
+    @metrics.timed('abort_multipart_upload')
+    async def abort_multipart_upload(self, asset_id, upload_id):
+        try:
+            await self.caller(
+                'abort_multipart_upload',
+                Bucket=self.config.bucket,
+                Key=self.key_layout.key(asset_id),
+                UploadId=upload_id)
+        except boto_exc.ClientError as e:
+            LOG.error(e)
+            raise s3.asset_error(e)
+        except boto_exc.BotoCoreError as e:
+            LOG.error(e)
+            raise exceptions.AssetError()
+
+    @metrics.timed('is_uploaded')
+    async def _is_uploaded(self, asset_id):
+        readiness_cache = self.s3_manager.readiness_cache
+        if readiness_cache is not None:
+            uploaded = readiness_cache.get(asset_id)
+            if uploaded is not None:
+                return uploaded
+        return await self._lookups.do(asset_id, self._fetch_upload_status,
+                                      asset_id)
+
+    async def _fetch_upload_status(self, asset_id):
+        readiness_cache = self.s3_manager.readiness_cache
+        tags = await self.caller(
+            'get_object_tagging',
+            Bucket=self.config.bucket,
+            Key=self.key_layout.key(asset_id))
+        uploaded = s3.is_marked_uploaded(tags)
+        if readiness_cache is not None:
+            readiness_cache.observe(asset_id, uploaded)
+        return uploaded
+
+
+async def create_client(config, exit_stack):
+    """Build an asyncio S3 client, closed along with exit_stack."""
+    # NOTE(armax): aiobotocore (and aiohttp) are imported on first use,
+    # see s3.create_client.
+    try:
+        from aiobotocore import session as aio_session
+    except ImportError:
+        raise RuntimeError('the aiobotocore package is required to serve '
+                           'the API with asyncio')
+    from botocore import config as boto_config
+
+    session = aio_session.get_session()
+    return await exit_stack.enter_async_context(session.create_client(
+        's3',
+        aws_access_key_id=config.access_key_id,
+        aws_secret_access_key=config.access_key,
+        region_name=config.region,
+        endpoint_url=config.endpoint_url,
+        config=boto_config.Config(
+            max_pool_connections=config.max_pool_connections,
+            connect_timeout=config.connect_timeout,
+            read_timeout=config.read_timeout,
+            retries={'max_attempts': 0})))
+
+
+async def build_s3_manager(s3_manager, exit_stack):
+    """Return the AsyncS3Manager of the bucket of an S3Manager."""
+    client = await create_client(s3_manager.config, exit_stack)
+    return AsyncS3Manager(s3_manager, client, caller=s3.build_caller(
+        s3_manager.config, client, caller_class=calls.AsyncCaller))
+
+
+async def build_asset_manager(config, exit_stack):
+    """Wire up an AsyncAssetManager and its dependencies from config."""
+    asset_manager = s3.build_asset_manager(config)
+    storage_manager = asset_manager.storage_manager
+    if isinstance(storage_manager, routing.RoutingManager):
+        managers = {}
+        # the default location may be a named one as well
+        built = {}
+        for name, manager in storage_manager.managers.items():
+            if id(manager) not in built:
+                built[id(manager)] = await build_s3_manager(
+                    manager, exit_stack)
+            managers[name] = built[id(manager)]
+        storage_manager = routing.AsyncRoutingManager(
+            managers, storage_manager.replicas,
+            storage_manager.replication_lag)
+    else:
+        storage_manager = await build_s3_manager(storage_manager, exit_stack)
+    return AsyncAssetManager(
+        storage_manager,
+        state_store=asset_manager.state_store,
+        part_size=asset_manager.part_size,
+        part_url_timeout=asset_manager.part_url_timeout,
+        key_layout=asset_manager.key_layout,
+        write_behind=asset_manager.write_behind,
+        proxy=asset_manager.proxy,
+        proxy_chunk_size=asset_manager.proxy_chunk_size)
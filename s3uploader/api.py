@@ -10,12 +10,23 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import base64
+import calendar
+import functools
+import json
+import math
+import time
+from urllib import parse
+
 import flask
 import flask_restful
 
+from s3uploader import admission
 from s3uploader import constants
 from s3uploader import exceptions
+from s3uploader import metrics
 from s3uploader import s3
+from s3uploader import state
 
 
 app = flask.Flask(__name__)
@@ -28,62 +39,525 @@ def error_handler(error):
     pass
 
 
-class Asset(flask_restful.Resource):
+def parse_timeout(timeout):
+    """Return timeout as a positive integer, None if it is invalid."""
+    # TODO(armax): could use Flask-inputs but it's more hassle
+    # than it's worth for the simplicity of the app.
+    try:
+        timeout = int(timeout)
+        if timeout <= 0:
+            raise ValueError()
+    except (TypeError, ValueError):
+        LOG.error('Timeout cannot be parsed: %s', timeout)
+        return
+    return timeout
+
+
+def parse_flag(value):
+    """Return value as a boolean, None if it is invalid."""
+    if value is None or value.lower() in ('', '0', 'false', 'no'):
+        return False
+    if value.lower() in ('1', 'true', 'yes'):
+        return True
+
+
+def url_expires_at(url):
+    """Return when a presigned URL expires, None if it cannot tell."""
+    query = dict(parse.parse_qsl(parse.urlsplit(url).query))
+    try:
+        if 'X-Amz-Date' in query:
+            # SigV4: signed at X-Amz-Date, for X-Amz-Expires seconds
+            signed_at = calendar.timegm(
+                time.strptime(query['X-Amz-Date'], '%Y%m%dT%H%M%SZ'))
+            return signed_at + int(query['X-Amz-Expires'])
+        if 'Expires' in query:
+            return int(query['Expires'])
+    except (KeyError, ValueError):
+        return
+
+
+def redirect_headers(url, clock=time.time):
+    """Return the headers redirecting to a presigned download URL.
+
+    The redirect can be cached for as long as the URL remains valid, which
+    is less than the requested timeout if the URL is a cached one. The URL
+    may be signed against a replica depending on the client's region,
+    hence caches must key the redirect on it too.
+    """
+    expires_at = url_expires_at(url)
+    if expires_at is None:
+        cache_control = 'no-cache'
+    else:
+        cache_control = 'public, max-age=%d' % max(expires_at - clock(), 0)
+    return [('Location', url), ('Cache-Control', cache_control),
+            ('Vary', constants.REGION_HEADER)]
+
+
+def asset_status(asset):
+    """Return the status of an asset as reported by batch lookups."""
+    if asset.error is None:
+        return 'ready' if asset.url else 'not_ready'
+    if isinstance(asset.error, exceptions.AssetNotFoundError):
+        return 'not_found'
+    if isinstance(asset.error, exceptions.AssetAccessDeniedError):
+        return 'access_denied'
+    if isinstance(asset.error, exceptions.AssetTimeoutError):
+        return 'timeout'
+    return 'error'
+
+
+def _is_int(value, minimum, maximum):
+    return (isinstance(value, int) and not isinstance(value, bool) and
+            minimum <= value <= maximum)
+
+
+def upload_status_error(content, size_required=False):
+    """Return what is wrong with the body marking an upload completed."""
+    if not isinstance(content, dict) or 'Status' not in content:
+        # TODO(armax): return messages should be localized
+        return 'Body must contain "Status" key'
+    elif content['Status'] != 'Uploaded':
+        return 'Status can only accept "Uploaded"'
+    size = content.get('Size')
+    if size is None and size_required:
+        return 'Body must contain "Size" key'
+    if size is not None and not _is_int(size, 0, float('inf')):
+        return 'Size must be a non-negative integer'
+
+
+def multipart_error(content):
+    """Return what is wrong with the body starting a multipart upload."""
+    if not isinstance(content, dict) or not _is_int(
+            content.get('size'), 0, constants.MULTIPART_MAX_SIZE):
+        return ('size must be an integer between 0 and %d' %
+                constants.MULTIPART_MAX_SIZE)
+    part_size = content.get('part_size')
+    if part_size is not None and not _is_int(
+            part_size, constants.MULTIPART_MIN_PART_SIZE,
+            constants.MULTIPART_MAX_PART_SIZE):
+        return ('part_size must be an integer between %d and %d' % (
+            constants.MULTIPART_MIN_PART_SIZE,
+            constants.MULTIPART_MAX_PART_SIZE))
+
+
+def parse_part_numbers(value):
+    """Return a comma-separated list of part numbers, None if invalid."""
+    if not value:
+        return []
+    try:
+        part_numbers = [int(n) for n in value.split(',')]
+    except ValueError:
+        return
+    if (len(part_numbers) > constants.MULTIPART_MAX_PARTS or
+            not all(0 < n <= constants.MULTIPART_MAX_PARTS
+                    for n in part_numbers)):
+        return
+    return part_numbers
+
+
+def multipart_upload(upload, uploaded_parts=False):
+    """Return the representation of a MultipartUpload."""
+    result = {'id': upload.asset_id, 'upload_id': upload.upload_id}
+    if upload.part_size is not None:
+        result['part_size'] = upload.part_size
+    result['parts'] = [{'part_number': part_number, 'upload_url': url}
+                       for part_number, url in upload.part_urls]
+    if uploaded_parts:
+        result['uploaded_parts'] = [
+            {'part_number': part['PartNumber'], 'size': part['Size'],
+             'etag': part['ETag']} for part in upload.parts]
+    return result
+
+
+def parse_timestamp(value):
+    """Return a Unix timestamp as a float, None if it is invalid."""
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return
+    if math.isfinite(value) and value >= 0:
+        return value
+
+
+def encode_cursor(cursor):
+    """Return the opaque form of the cursor of a listing."""
+    return base64.urlsafe_b64encode(json.dumps(
+        cursor, separators=(',', ':')).encode('utf-8')).decode(
+            'ascii').rstrip('=')
+
+
+def parse_cursor(value):
+    """Return the cursor of a listing from its opaque form, None if it
+    is invalid, see s3.AssetManager.list_assets.
+    """
+    try:
+        cursor = json.loads(base64.urlsafe_b64decode(
+            value + '=' * (-len(value) % 4)).decode('utf-8'))
+    except ValueError:
+        return
+    if not isinstance(cursor, dict) or len(cursor) != 1:
+        return
+    after = cursor.get('after')
+    if isinstance(after, list) and len(after) == 2 and isinstance(
+            after[0], (int, float)) and isinstance(after[1], str):
+        return cursor
+    if isinstance(cursor.get('token'), str):
+        return cursor
+
+
+def listing_options(args):
+    """Return the arguments of s3.AssetManager.list_assets from the query
+    of a listing, along with what is wrong with it if anything.
+    """
+    options = {}
+    limit = args.get('limit', constants.LIST_PAGE_SIZE)
+    try:
+        options['limit'] = int(limit)
+    except (TypeError, ValueError):
+        options['limit'] = 0
+    if not 0 < options['limit'] <= constants.LIST_MAX_PAGE_SIZE:
+        return options, ('limit must be an integer between 1 and %d' %
+                         constants.LIST_MAX_PAGE_SIZE)
+    options['status'] = args.get('status') or None
+    if options['status'] not in (None, state.CREATED, state.UPLOADED):
+        return options, 'status must be either created or uploaded'
+    for name in ('created_after', 'created_before'):
+        options[name] = args.get(name)
+        if options[name] is not None:
+            options[name] = parse_timestamp(options[name])
+            if options[name] is None:
+                return options, '%s must be a Unix timestamp' % name
+    if args.get('cursor'):
+        options['cursor'] = parse_cursor(args['cursor'])
+        if options['cursor'] is None:
+            return options, 'cursor is invalid'
+    return options, None
 
+
+def listed_asset(asset_state):
+    """Return the representation of an AssetState in a listing."""
+    result = {'id': asset_state.asset_id,
+              'status': asset_state.status or 'unknown'}
+    for name in ('size', 'created_at', 'uploaded_at'):
+        if getattr(asset_state, name) is not None:
+            result[name] = getattr(asset_state, name)
+    return result
+
+
+def asset_listing(states, next_cursor=None):
+    """Yield the JSON listing of a page of assets, an asset at a time."""
+    yield '{"assets": ['
+    for index, asset_state in enumerate(states):
+        yield (', ' if index else '') + json.dumps(listed_asset(asset_state))
+    yield '], "next_cursor": %s}\n' % json.dumps(
+        encode_cursor(next_cursor) if next_cursor else None)
+
+
+def instrumented(handler):
+    """Record the latency and the status of the requests to handler."""
+    @functools.wraps(handler)
+    def wrapper(*args, **kwargs):
+        rule = flask.request.url_rule
+        with metrics.RequestTimer(rule.rule if rule else flask.request.path,
+                                  flask.request.method) as timer:
+            result = handler(*args, **kwargs)
+            if isinstance(result, tuple):
+                timer.status = result[1]
+            elif isinstance(result, flask.Response):
+                timer.status = result.status_code
+            return result
+    return wrapper
+
+
+def admitted(name):
+    """Have the requests to handler wait for a slot of the limiter of the
+    endpoint name, if it is limited, see s3uploader.admission.
+    """
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(*args, **kwargs):
+            limiter = admission.get_limiter(name)
+            if limiter is None:
+                return handler(*args, **kwargs)
+            with limiter.admit():
+                return handler(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def metrics_view():
+    """Return the metrics of this process in the Prometheus format."""
+    return flask.Response(metrics.REGISTRY.render(),
+                          content_type=metrics.CONTENT_TYPE)
+
+
+class Resource(flask_restful.Resource):
+
+    method_decorators = [instrumented]
+
+
+class Asset(Resource):
+
+    @admitted('get_asset')
     def get(self, asset_id):
         """Return an S3 signed URL for dowload of a given asset.
 
-        :returns: 400 if the timeout is not a positive integer.
+        The URL is signed against a replica of the asset in the region of
+        the X-Client-Region header, if there is one. With redirect=true,
+        the URL is also returned as a 307 redirect, which can be cached
+        for as long as the URL is valid.
+
+        :returns: 400 if the timeout is not a positive integer, or redirect
+                  is not a boolean.
         :returns: 409 if the asset is not ready for download.
+        :returns: 503 if too many requests are in progress.
 
         """
-        timeout = flask.request.args.get('timeout', constants.DOWNLOAD_TIMEOUT)
-        # TODO(armax): could use Flask-inputs but it's more hassle
-        # than it's worth for the simplicity of the app.
-        try:
-            timeout = int(timeout)
-            if timeout <= 0:
-                raise ValueError()
-        except ValueError:
-            LOG.error('Timeout cannot be parsed: %s', timeout)
+        timeout = parse_timeout(
+            flask.request.args.get('timeout', constants.DOWNLOAD_TIMEOUT))
+        if timeout is None:
             # TODO(armax): return messages should be localized
             return 'timeout must be a positive integer', 400
+        redirect = parse_flag(flask.request.args.get('redirect'))
+        if redirect is None:
+            return 'redirect must be a boolean', 400
 
-        asset_manager = s3.AssetManager()
-        asset = asset_manager.get_asset(asset_id, timeout)
+        asset_manager = s3.get_asset_manager()
+        asset = asset_manager.get_asset(
+            asset_id, timeout,
+            region=flask.request.headers.get(constants.REGION_HEADER))
         if asset and asset.url:
+            if redirect:
+                return ({'download_url': asset.url}, 307,
+                        redirect_headers(asset.url))
             return {'download_url': asset.url}
         elif not asset.url:
             return 'asset is not ready for download', 409
 
+    @admitted('put_asset')
     def put(self, asset_id):
         """Mark an asset upload operation as completed.
 
-        :returns: 400 if the timeout is not a positive integer.
+        The body may carry the Size of the asset in bytes, which is kept
+        along with its state when a state database is configured.
+
+        :returns: 400 if the status is not "Uploaded" or the size is not a
+                  non-negative integer.
+        :returns: 503 if too many requests are in progress.
 
         """
         content = flask.request.get_json(force=True)
         # TODO(armax): could use Flask-inputs but it's more hassle
         # than it's worth for the simplicity of the app.
-        if 'Status' not in content:
-            # TODO(armax): return messages should be localized
-            return 'Body must contain "Status" key', 400
-        elif content['Status'] != 'Uploaded':
-            return 'Status can only accept "Uploaded"', 400
+        error = upload_status_error(content)
+        if error:
+            return error, 400
 
-        asset_manager = s3.AssetManager()
-        asset_manager.update_asset(asset_id)
+        asset_manager = s3.get_asset_manager()
+        asset_manager.update_asset(asset_id, content.get('Size'))
         return 'done'
 
 
-class Assets(flask_restful.Resource):
+class AssetContent(Resource):
+
+    def get(self, asset_id):
+        """Stream the content of a given asset, for clients that cannot
+        reach S3.
+
+        The Range and If-None-Match headers are passed on to S3, for
+        partial and conditional downloads.
+
+        :returns: 404 if the download proxy is disabled.
+        :returns: 409 if the asset is not ready for download.
+        :returns: 416 if the range is not satisfiable.
+
+        """
+        asset_manager = s3.get_asset_manager()
+        download = asset_manager.open_download(
+            asset_id, flask.request.headers.get('Range'),
+            flask.request.headers.get('If-None-Match'))
+        if download is None:
+            return 'asset is not ready for download', 409
+        # NOTE(armax): the response closes the download, even if the client
+        # goes away half-way.
+        return flask.Response(download, status=download.status,
+                              headers=download.headers,
+                              direct_passthrough=True)
+
+
+class Assets(Resource):
+
+    def get(self):
+        """List the assets a page at a time.
+
+        Assets are listed by creation time from the state database, if
+        there is one, otherwise in the key order of the bucket, see
+        s3.AssetManager.list_assets. The query may carry the limit of
+        assets per page, the cursor of the page (the next_cursor of the
+        previous one), and filter the assets by status (created or
+        uploaded) and by creation time (created_after, included, and
+        created_before, excluded). The listing is streamed as it is
+        encoded.
+
+        :returns: 400 if the limit is not a positive integer within the page
+                  limit, the status or the creation times are invalid, or
+                  the cursor is not one of this listing.
+
+        """
+        options, error = listing_options(flask.request.args)
+        if error:
+            return error, 400
+
+        asset_manager = s3.get_asset_manager()
+        states, next_cursor = asset_manager.list_assets(**options)
+        return flask.Response(asset_listing(states, next_cursor),
+                              content_type='application/json')
 
     def post(self):
         """Return an S3 signed URL for uploading a new asset."""
-        asset_manager = s3.AssetManager()
+        asset_manager = s3.get_asset_manager()
         asset = asset_manager.create_asset()
 
         if asset and asset.url:
             return {'upload_url': asset.url, 'id': asset.asset_id}
         else:
             raise exceptions.AssetError()
+
+
+class AssetsBatch(Resource):
+
+    def post(self):
+        """Return S3 signed URLs for uploading several new assets.
+
+        :returns: 400 if the count is not a positive integer within the
+                  batch limit.
+
+        """
+        content = flask.request.get_json(force=True, silent=True)
+        count = content.get('count') if isinstance(content, dict) else None
+        if (not isinstance(count, int) or isinstance(count, bool) or
+                not 0 < count <= constants.BATCH_MAX_SIZE):
+            return ('count must be an integer between 1 and %d' %
+                    constants.BATCH_MAX_SIZE), 400
+
+        asset_manager = s3.get_asset_manager()
+        assets = asset_manager.create_assets(count)
+        if not assets or not all(asset.url for asset in assets):
+            raise exceptions.AssetError()
+        return {'assets': [{'upload_url': asset.url, 'id': asset.asset_id}
+                           for asset in assets]}
+
+
+class AssetsBatchGet(Resource):
+
+    def post(self):
+        """Return S3 signed URLs for download of several assets.
+
+        Each asset is reported with a status among ready (along with its
+        download_url), not_ready, not_found, access_denied, timeout and
+        error.
+
+        :returns: 400 if the IDs are not a list of strings within the batch
+                  limit, or if the timeout is not a positive integer.
+
+        """
+        content = flask.request.get_json(force=True, silent=True)
+        if not isinstance(content, dict):
+            content = {}
+        asset_ids = content.get('ids')
+        if (not isinstance(asset_ids, list) or
+                not 0 < len(asset_ids) <= constants.BATCH_MAX_SIZE or
+                not all(isinstance(i, str) for i in asset_ids)):
+            return ('ids must be a list of up to %d asset IDs' %
+                    constants.BATCH_MAX_SIZE), 400
+        timeout = parse_timeout(
+            content.get('timeout', constants.DOWNLOAD_TIMEOUT))
+        if timeout is None:
+            return 'timeout must be a positive integer', 400
+
+        asset_manager = s3.get_asset_manager()
+        results = []
+        for asset in asset_manager.get_assets(
+                asset_ids, timeout,
+                region=flask.request.headers.get(constants.REGION_HEADER)):
+            result = {'id': asset.asset_id, 'status': asset_status(asset)}
+            if asset.url:
+                result['download_url'] = asset.url
+            results.append(result)
+        return {'assets': results}
+
+
+class AssetsMultipart(Resource):
+
+    def post(self):
+        """Start the multipart upload of a new asset.
+
+        The body carries the size of the asset in bytes, and optionally the
+        part_size to split it into; an S3 signed URL is returned to PUT
+        each part, which can be uploaded in parallel.
+
+        :returns: 400 if the size or the part size is not an integer within
+                  the S3 limits.
+
+        """
+        content = flask.request.get_json(force=True, silent=True)
+        error = multipart_error(content)
+        if error:
+            return error, 400
+
+        asset_manager = s3.get_asset_manager()
+        upload = asset_manager.create_multipart_asset(
+            content['size'], content.get('part_size'))
+        return multipart_upload(upload)
+
+
+class AssetMultipartUpload(Resource):
+
+    def get(self, asset_id, upload_id):
+        """Return the parts of a multipart upload uploaded so far.
+
+        Fresh S3 signed URLs are returned for the comma-separated
+        part_numbers, if any, so that an interrupted upload can resume.
+
+        :returns: 400 if the part numbers are invalid.
+        :returns: 404 if the upload cannot be found.
+
+        """
+        part_numbers = parse_part_numbers(
+            flask.request.args.get('part_numbers'))
+        if part_numbers is None:
+            return ('part_numbers must be a comma-separated list of '
+                    'integers between 1 and %d' %
+                    constants.MULTIPART_MAX_PARTS), 400
+
+        asset_manager = s3.get_asset_manager()
+        upload = asset_manager.get_multipart_upload(
+            asset_id, upload_id, part_numbers)
+        return multipart_upload(upload, uploaded_parts=True)
+
+    def put(self, asset_id, upload_id):
+        """Complete a multipart upload, and mark the asset uploaded.
+
+        The body must carry the Size of the asset in bytes, so that an
+        upload missing its last parts is not taken for a complete one.
+
+        :returns: 400 if the status is not "Uploaded" or the size is not a
+                  non-negative integer.
+        :returns: 409 if a part is missing, or the size does not match.
+
+        """
+        content = flask.request.get_json(force=True)
+        error = upload_status_error(content, size_required=True)
+        if error:
+            return error, 400
+
+        asset_manager = s3.get_asset_manager()
+        asset_manager.complete_multipart_asset(
+            asset_id, upload_id, content.get('Size'))
+        return 'done'
+
+    def delete(self, asset_id, upload_id):
+        """Abort a multipart upload, dropping the parts uploaded so far."""
+        asset_manager = s3.get_asset_manager()
+        asset_manager.abort_multipart_asset(asset_id, upload_id)
+        return 'done'
@@ -0,0 +1,382 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""ASGI flavour of the API, see s3uploader.api (Python 3.5+ only).
+
+The routes, status codes and bodies are the same as the Flask API, but
+requests waiting on S3 do not hold a thread: a single process can serve
+thousands of them concurrently.
+"""
+
+import asyncio
+import contextlib
+import json
+import re
+from urllib import parse
+
+from werkzeug import exceptions as werkzeug_exc
+
+from s3uploader import admission
+from s3uploader import aio
+from s3uploader import api
+from s3uploader import constants
+from s3uploader import exceptions
+from s3uploader import metrics
+from s3uploader import s3
+
+
+LOG = s3.LOG
+
+
+def _json_body(body):
+    try:
+        return json.loads(body.decode('utf-8'))
+    except ValueError:
+        raise werkzeug_exc.BadRequest()
+
+
+class Application(object):
+
+    def __init__(self, asset_manager=None, limiters=None):
+        self.asset_manager = asset_manager
+        # the AsyncLimiters of the limited handlers, by name
+        self.limiters = limiters
+        self.routes = [
+            (re.compile(r'^/asset$'), '/asset',
+             {'GET': self.list_assets, 'POST': self.post_assets}),
+            (re.compile(r'^/asset/(?P<asset_id>[^/]+)$'),
+             '/asset/<string:asset_id>',
+             {'GET': self.get_asset, 'PUT': self.put_asset}),
+            (re.compile(r'^/asset/(?P<asset_id>[^/]+)/content$'),
+             '/asset/<string:asset_id>/content',
+             {'GET': self.get_asset_content}),
+            (re.compile(r'^/assets:batch$'), '/assets:batch',
+             {'POST': self.post_batch}),
+            (re.compile(r'^/assets:batchGet$'), '/assets:batchGet',
+             {'POST': self.post_batch_get}),
+            (re.compile(r'^/asset:multipart$'), '/asset:multipart',
+             {'POST': self.post_multipart}),
+            (re.compile(r'^/asset/(?P<asset_id>[^/]+)/multipart/'
+                        r'(?P<upload_id>[^/]+)$'),
+             '/asset/<string:asset_id>/multipart/<string:upload_id>',
+             {'GET': self.get_multipart, 'PUT': self.put_multipart,
+              'DELETE': self.delete_multipart}),
+            (re.compile(r'^/metrics$'), None, {'GET': self.get_metrics}),
+        ]
+        self._exit_stack = None
+        self._startup_lock = None
+
+    async def startup(self):
+        """Read the configuration, build the admission limiters, and the
+        asset manager unless one was given, or it is to be built on first
+        use (S3UPLOADER_WARM_UP).
+        """
+        if self.limiters is None:
+            self.limiters = admission.build_limiters(
+                s3.get_config(), admission.AsyncLimiter)
+        if self.asset_manager is None and s3.get_config().warm_up:
+            await self._build()
+
+    async def _build(self):
+        if self._startup_lock is None:
+            self._startup_lock = asyncio.Lock()
+        async with self._startup_lock:
+            if self.asset_manager is None:
+                self._exit_stack = contextlib.AsyncExitStack()
+                self.asset_manager = await aio.build_asset_manager(
+                    s3.get_config(), self._exit_stack)
+
+    async def shutdown(self):
+        if self._exit_stack is not None:
+            await self._exit_stack.aclose()
+            self._exit_stack = None
+            self.asset_manager = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            status, data, headers = await self._dispatch(scope, receive)
+            if isinstance(data, aio.AsyncDownload):
+                await self._stream(data, send)
+                return
+            if isinstance(data, TextResponse):
+                body, content_type = data.body, data.content_type
+            else:
+                body = (json.dumps(data) + '\n').encode('utf-8')
+                content_type = 'application/json'
+            headers = [(b'content-type', content_type.encode('latin-1')),
+                       (b'content-length', str(len(body)).encode())] + [
+                (k.lower().encode('latin-1'), v.encode('latin-1'))
+                for k, v in headers]
+            await send({'type': 'http.response.start', 'status': status,
+                        'headers': headers})
+            await send({'type': 'http.response.body', 'body': body})
+
+    async def _stream(self, download, send):
+        """Send a download a chunk at a time, see api.AssetContent."""
+        try:
+            await send({'type': 'http.response.start',
+                        'status': download.status,
+                        'headers': [(k.lower().encode('latin-1'),
+                                     v.encode('latin-1'))
+                                    for k, v in download.headers]})
+            async for chunk in download:
+                await send({'type': 'http.response.body', 'body': chunk,
+                            'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            download.close()
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                try:
+                    await self.startup()
+                except Exception as e:
+                    await send({'type': 'lifespan.startup.failed',
+                                'message': str(e)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _dispatch(self, scope, receive):
+        """Return the status, the data and the headers of a response."""
+        for pattern, endpoint, methods in self.routes:
+            match = pattern.match(scope['path'])
+            if match:
+                break
+        else:
+            return self._error(werkzeug_exc.NotFound())
+        handler = methods.get(scope['method'])
+        if handler is None:
+            return self._error(werkzeug_exc.MethodNotAllowed(list(methods)))
+
+        request = Request(scope, receive)
+        if endpoint is None:
+            # not an API call, e.g. the metrics
+            return 200, await handler(request), []
+        try:
+            with metrics.RequestTimer(endpoint, scope['method']) as timer:
+                if self.asset_manager is None:
+                    await self._build()
+                limiter = (self.limiters or {}).get(handler.__name__)
+                async with contextlib.AsyncExitStack() as stack:
+                    if limiter is not None:
+                        await stack.enter_async_context(limiter.admit())
+                    result = await handler(request, **match.groupdict())
+                if isinstance(result, tuple):
+                    timer.status = result[0]
+        except werkzeug_exc.HTTPException as e:
+            return self._error(e)
+        except Exception:
+            LOG.exception('Unexpected error serving %s', scope['path'])
+            return self._error(exceptions.AssetError())
+        if isinstance(result, tuple):
+            # (status, data), along with the headers if any
+            headers = result[2] if len(result) > 2 else []
+            return result[0], result[1], headers
+        return 200, result, []
+
+    def _error(self, e):
+        headers = [(k, v) for k, v in e.get_headers()
+                   if k.lower() != 'content-type']
+        return e.code, {'message': e.description}, headers
+
+    async def get_metrics(self, request):
+        """See api.metrics_view."""
+        return TextResponse(metrics.REGISTRY.render().encode('utf-8'),
+                            metrics.CONTENT_TYPE)
+
+    async def get_asset(self, request, asset_id):
+        """See api.Asset.get."""
+        timeout = api.parse_timeout(
+            request.args.get('timeout', constants.DOWNLOAD_TIMEOUT))
+        if timeout is None:
+            return 400, 'timeout must be a positive integer'
+        redirect = api.parse_flag(request.args.get('redirect'))
+        if redirect is None:
+            return 400, 'redirect must be a boolean'
+
+        asset = await self.asset_manager.get_asset(
+            asset_id, timeout, region=request.headers.get(
+                constants.REGION_HEADER.lower()))
+        if asset and asset.url:
+            if redirect:
+                return (307, {'download_url': asset.url},
+                        api.redirect_headers(asset.url))
+            return {'download_url': asset.url}
+        return 409, 'asset is not ready for download'
+
+    async def get_asset_content(self, request, asset_id):
+        """See api.AssetContent.get."""
+        download = await self.asset_manager.open_download(
+            asset_id, request.headers.get('range'),
+            request.headers.get('if-none-match'))
+        if download is None:
+            return 409, 'asset is not ready for download'
+        return download.status, download
+
+    async def put_asset(self, request, asset_id):
+        """See api.Asset.put."""
+        content = _json_body(await request.body())
+        error = api.upload_status_error(content)
+        if error:
+            return 400, error
+
+        await self.asset_manager.update_asset(asset_id, content.get('Size'))
+        return 'done'
+
+    async def list_assets(self, request):
+        """See api.Assets.get."""
+        options, error = api.listing_options(request.args)
+        if error:
+            return 400, error
+
+        states, next_cursor = await self.asset_manager.list_assets(**options)
+        # NOTE(armax): the page is bounded, it is sent in one go.
+        return TextResponse(''.join(api.asset_listing(
+            states, next_cursor)).encode('utf-8'), 'application/json')
+
+    async def post_assets(self, request):
+        """See api.Assets.post."""
+        asset = await self.asset_manager.create_asset()
+        if asset and asset.url:
+            return {'upload_url': asset.url, 'id': asset.asset_id}
+        raise exceptions.AssetError()
+
+    async def post_batch(self, request):
+        """See api.AssetsBatch.post."""
+        content = _json_body(await request.body())
+        count = content.get('count') if isinstance(content, dict) else None
+        if (not isinstance(count, int) or isinstance(count, bool) or
+                not 0 < count <= constants.BATCH_MAX_SIZE):
+            return 400, ('count must be an integer between 1 and %d' %
+                         constants.BATCH_MAX_SIZE)
+
+        assets = await self.asset_manager.create_assets(count)
+        if not assets or not all(asset.url for asset in assets):
+            raise exceptions.AssetError()
+        return {'assets': [{'upload_url': asset.url, 'id': asset.asset_id}
+                           for asset in assets]}
+
+    async def post_batch_get(self, request):
+        """See api.AssetsBatchGet.post."""
+        content = _json_body(await request.body())
+        if not isinstance(content, dict):
+            content = {}
+        asset_ids = content.get('ids')
+        if (not isinstance(asset_ids, list) or
+                not 0 < len(asset_ids) <= constants.BATCH_MAX_SIZE or
+                not all(isinstance(i, str) for i in asset_ids)):
+            return 400, ('ids must be a list of up to %d asset IDs' %
+                         constants.BATCH_MAX_SIZE)
+        timeout = api.parse_timeout(
+            content.get('timeout', constants.DOWNLOAD_TIMEOUT))
+        if timeout is None:
+            return 400, 'timeout must be a positive integer'
+
+        results = []
+        for asset in await self.asset_manager.get_assets(
+                asset_ids, timeout, region=request.headers.get(
+                    constants.REGION_HEADER.lower())):
+            result = {'id': asset.asset_id, 'status': api.asset_status(asset)}
+            if asset.url:
+                result['download_url'] = asset.url
+            results.append(result)
+        return {'assets': results}
+
+    async def post_multipart(self, request):
+        """See api.AssetsMultipart.post."""
+        content = _json_body(await request.body())
+        error = api.multipart_error(content)
+        if error:
+            return 400, error
+
+        upload = await self.asset_manager.create_multipart_asset(
+            content['size'], content.get('part_size'))
+        return api.multipart_upload(upload)
+
+    async def get_multipart(self, request, asset_id, upload_id):
+        """See api.AssetMultipartUpload.get."""
+        part_numbers = api.parse_part_numbers(
+            request.args.get('part_numbers'))
+        if part_numbers is None:
+            return 400, ('part_numbers must be a comma-separated list of '
+                         'integers between 1 and %d' %
+                         constants.MULTIPART_MAX_PARTS)
+
+        upload = await self.asset_manager.get_multipart_upload(
+            asset_id, upload_id, part_numbers)
+        return api.multipart_upload(upload, uploaded_parts=True)
+
+    async def put_multipart(self, request, asset_id, upload_id):
+        """See api.AssetMultipartUpload.put."""
+        content = _json_body(await request.body())
+        error = api.upload_status_error(content, size_required=True)
+        if error:
+            return 400, error
+
+        await self.asset_manager.complete_multipart_asset(
+            asset_id, upload_id, content.get('Size'))
+        return 'done'
+
+    async def delete_multipart(self, request, asset_id, upload_id):
+        """See api.AssetMultipartUpload.delete."""
+        await self.asset_manager.abort_multipart_asset(asset_id, upload_id)
+        return 'done'
+
+
+class TextResponse(object):
+    """A response body that is not to be JSON encoded."""
+
+    def __init__(self, body, content_type):
+        self.body = body
+        self.content_type = content_type
+
+
+class Request(object):
+    """The bits of an ASGI HTTP request the handlers care about."""
+
+    def __init__(self, scope, receive):
+        self.scope = scope
+        self._receive = receive
+        self._body = None
+
+    @property
+    def headers(self):
+        """The request headers, by lowercase name."""
+        return dict((k.decode('latin-1').lower(), v.decode('latin-1'))
+                    for k, v in self.scope.get('headers', []))
+
+    @property
+    def args(self):
+        query = self.scope.get('query_string', b'').decode('latin-1')
+        return dict(parse.parse_qsl(query))
+
+    async def body(self):
+        if self._body is None:
+            chunks = []
+            more_body = True
+            while more_body:
+                message = await self._receive()
+                chunks.append(message.get('body', b''))
+                more_body = message.get('more_body', False)
+            self._body = b''.join(chunks)
+        return self._body
+
+
+app = Application()
@@ -0,0 +1,199 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import collections
+import threading
+import time
+
+from s3uploader import metrics
+
+
+class LRUCache(object):
+    """A bounded, thread-safe LRU mapping whose entries expire.
+
+    Its size and evictions are exported as metrics, labelled with name.
+    """
+
+    def __init__(self, max_size, clock=time.monotonic, name='lru'):
+        if max_size <= 0:
+            raise ValueError('max_size must be a positive integer')
+        self.max_size = max_size
+        self.name = name
+        self._clock = clock
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        """Return the value cached for key, None if missing or expired."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return
+            value, expires_at = entry
+            if expires_at <= self._clock():
+                del self._data[key]
+                self._report_size()
+                return
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._set(key, value, ttl)
+
+    def add(self, key, value, ttl):
+        """Set key unless it is cached already, return whether it was set."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[1] > self._clock():
+                return False
+            self._set(key, value, ttl)
+            return True
+
+    def _set(self, key, value, ttl):
+        self._data[key] = (value, self._clock() + ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+            metrics.CACHE_EVENTS.inc(self.name, 'eviction')
+        self._report_size()
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+            self._report_size()
+
+    def _report_size(self):
+        metrics.CACHE_SIZE.set(len(self._data), self.name)
+
+
+class RedisBackend(object):
+    """Cache backend to share entries across workers through Redis.
+
+    Redis evicts entries on its own, hence neither the size of the cache
+    nor its evictions are exported as metrics.
+    """
+
+    def __init__(self, client, prefix='s3uploader:'):
+        self.client = client
+        self.prefix = prefix
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        # NOTE(armax): imported on first use, see s3.create_client.
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError('the redis package is required to use %s'
+                               % url)
+        return cls(redis.StrictRedis.from_url(url), **kwargs)
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        if value is not None:
+            return value.decode('utf-8')
+
+    def set(self, key, value, ttl):
+        self.client.setex(self.prefix + key, max(int(ttl), 1), value)
+
+    def add(self, key, value, ttl):
+        return bool(self.client.set(self.prefix + key, value,
+                                    ex=max(int(ttl), 1), nx=True))
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+
+class ReadinessCache(object):
+    """Remember whether assets are ready for download.
+
+    Once an asset has been uploaded it stays so, hence a positive answer
+    can be cached for a long time, whereas a negative one needs to expire
+    quickly for clients to see uploads being completed.
+    """
+
+    name = 'readiness'
+
+    READY = '1'
+    NOT_READY = '0'
+
+    def __init__(self, backend, ready_ttl, not_ready_ttl):
+        self.backend = backend
+        self.ready_ttl = ready_ttl
+        self.not_ready_ttl = not_ready_ttl
+
+    def get(self, asset_id):
+        """Return True/False if the readiness is known, None otherwise."""
+        value = self.backend.get(asset_id)
+        if value is None:
+            metrics.CACHE_EVENTS.inc(self.name, 'miss')
+            return
+        metrics.CACHE_EVENTS.inc(self.name, 'hit')
+        return value == self.READY
+
+    def set(self, asset_id, ready):
+        if ready:
+            self.backend.set(asset_id, self.READY, self.ready_ttl)
+        else:
+            self.backend.set(asset_id, self.NOT_READY, self.not_ready_ttl)
+
+    def observe(self, asset_id, ready):
+        """Remember what a lookup found, unless it is stale.
+
+        The upload of an asset may be completed while its status is being
+        looked up: not ready is only cached if nothing is known meanwhile,
+        so that an asset once ready never looks not ready again.
+        """
+        if ready:
+            self.set(asset_id, True)
+        else:
+            self.backend.add(asset_id, self.NOT_READY, self.not_ready_ttl)
+
+    def invalidate(self, asset_id):
+        self.backend.delete(asset_id)
+
+
+class PresignedURLCache(object):
+    """Hand out the same presigned URL while it is valid long enough.
+
+    A URL signed for a timeout is reused as long as at least min_validity
+    (a fraction of the timeout) of its lifetime is left. Besides saving
+    the signing work, this gives CDNs and browsers identical URLs to cache.
+    """
+
+    name = 'url'
+
+    def __init__(self, backend, min_validity, clock=time.monotonic):
+        if not 0 <= min_validity < 1:
+            raise ValueError('min_validity must be within [0, 1)')
+        self.backend = backend
+        self.min_validity = min_validity
+        self._clock = clock
+
+    def get(self, asset_id, timeout):
+        """Return a (url, expires_at) tuple, None if none can be reused."""
+        entry = self.backend.get((asset_id, timeout))
+        if entry is None:
+            metrics.CACHE_EVENTS.inc(self.name, 'miss')
+            return
+        metrics.CACHE_EVENTS.inc(self.name, 'hit')
+        return entry
+
+    def set(self, asset_id, timeout, url):
+        """Remember url, signed now to expire in timeout seconds."""
+        expires_at = self._clock() + timeout
+        self.backend.set((asset_id, timeout), (url, expires_at),
+                         timeout * (1 - self.min_validity))
+        return url, expires_at
@@ -0,0 +1,372 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Deadlines, retries and hedging of the S3 calls.
+
+Each S3 call gets a latency budget, within which throttled and failed
+attempts are retried with exponential backoff. Reads are idempotent: when
+an attempt is slower than most (a percentile of the recent attempts), a
+duplicate one is fired and the first to answer wins, which cuts the tail
+latency for a small share of extra requests.
+
+Writes are never abandoned half-way, their budget only bounds the retries.
+"""
+
+import asyncio
+import collections
+from concurrent import futures
+import random
+import threading
+import time
+
+from botocore import exceptions as boto_exc
+
+from s3uploader import constants
+from s3uploader import exceptions
+from s3uploader import metrics
+
+
+# NOTE(armax): get_object completes once the response headers are in, its
+# body is streamed afterwards: the attempts that lose to a hedged one have
+# their body closed, see _release.
+READS = frozenset(['get_object', 'get_object_tagging', 'list_objects_v2',
+                   'list_parts'])
+
+RETRYABLE_CODES = frozenset([
+    'InternalError', 'RequestTimeout', 'ServiceUnavailable', 'SlowDown',
+    'Throttling', 'ThrottlingException',
+])
+
+
+def is_retryable(error):
+    """Return whether a failed attempt is worth retrying."""
+    if isinstance(error, (boto_exc.ConnectionError,
+                          boto_exc.HTTPClientError)):
+        return True
+    if isinstance(error, boto_exc.ClientError):
+        response = error.response or {}
+        status = response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+        return (response.get('Error', {}).get('Code') in RETRYABLE_CODES or
+                (status or 0) >= 500)
+    return False
+
+
+class CallPolicy(object):
+    """How long a call may take, and how it is retried and hedged.
+
+    :param deadline: the latency budget of a call in seconds, 0 for none.
+    :param retries: how many times a failed attempt is retried.
+    :param backoff: the base delay between attempts, doubled every time
+                    (the actual delay is picked at random below it).
+    :param hedge: whether slow attempts get a duplicate one, for reads.
+    """
+
+    def __init__(self, deadline, retries, backoff, hedge=False):
+        self.deadline = deadline
+        self.retries = retries
+        self.backoff = backoff
+        self.hedge = hedge
+
+    def delay(self, attempt):
+        return random.uniform(0, self.backoff * 2 ** (attempt - 1))
+
+
+READ_POLICY = CallPolicy(constants.READ_DEADLINE, constants.READ_RETRIES,
+                         constants.READ_BACKOFF, hedge=True)
+WRITE_POLICY = CallPolicy(constants.WRITE_DEADLINE, constants.WRITE_RETRIES,
+                          constants.WRITE_BACKOFF)
+
+
+class LatencyTracker(object):
+    """Tell how long an attempt may take before it gets hedged.
+
+    That is a percentile of the latencies of the last attempts of the same
+    operation, recomputed every few samples; initial_delay is used until
+    enough of them were observed.
+    """
+
+    REFRESH_EVERY = 32
+
+    def __init__(self, percentile=constants.HEDGE_PERCENTILE,
+                 window=constants.HEDGE_WINDOW,
+                 min_samples=constants.HEDGE_MIN_SAMPLES,
+                 initial_delay=constants.HEDGE_INITIAL_DELAY,
+                 min_delay=constants.HEDGE_MIN_DELAY):
+        self.percentile = percentile
+        self.window = window
+        self.min_samples = min_samples
+        self.initial_delay = initial_delay
+        self.min_delay = min_delay
+        # operation -> [samples, samples since refresh, threshold]
+        self._operations = {}
+        self._lock = threading.Lock()
+
+    def observe(self, operation, elapsed):
+        with self._lock:
+            entry = self._operations.get(operation)
+            if entry is None:
+                entry = self._operations[operation] = [
+                    collections.deque(maxlen=self.window), 0,
+                    self.initial_delay]
+            entry[0].append(elapsed)
+            entry[1] += 1
+            if entry[1] < self.REFRESH_EVERY or (
+                    len(entry[0]) < self.min_samples):
+                return
+            entry[1] = 0
+            samples = sorted(entry[0])
+        index = min(int(len(samples) * self.percentile / 100.0),
+                    len(samples) - 1)
+        entry[2] = max(samples[index], self.min_delay)
+
+    def threshold(self, operation):
+        """Return the seconds after which an attempt is hedged."""
+        entry = self._operations.get(operation)
+        return entry[2] if entry is not None else self.initial_delay
+
+
+class Caller(object):
+    """Call S3 client methods within their policy.
+
+    Reads are run by a thread pool, which the calling thread waits on
+    until they complete, their hedging delay or their deadline. An attempt
+    outliving its deadline keeps its worker until the client gives up on
+    it: reads should go through a client whose timeouts do not outlive
+    their deadlines, see s3.create_read_client.
+
+    :param read_client: the client reads go through, client by default.
+    """
+
+    def __init__(self, client, read_policy=READ_POLICY,
+                 write_policy=WRITE_POLICY, deadlines=None, tracker=None,
+                 workers=constants.CALL_WORKERS, clock=time.monotonic,
+                 sleep=time.sleep, read_client=None):
+        self.client = client
+        self.read_client = read_client or client
+        self.read_policy = read_policy
+        self.write_policy = write_policy
+        self.deadlines = deadlines or {}
+        self.tracker = tracker or LatencyTracker()
+        self.workers = workers
+        self._clock = clock
+        self._sleep = sleep
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        self._busy = 0
+        self._busy_lock = threading.Lock()
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            with self._executor_lock:
+                if self._executor is None:
+                    self._executor = futures.ThreadPoolExecutor(
+                        max_workers=self.workers)
+        return self._executor
+
+    def policy(self, operation):
+        """Return the policy of operation, and its deadline."""
+        policy = (self.read_policy if operation in READS
+                  else self.write_policy)
+        return policy, self.deadlines.get(operation, policy.deadline)
+
+    def _until(self, *times):
+        """Return the seconds left until the earliest of times."""
+        times = [t for t in times if t is not None]
+        if times:
+            return max(min(times) - self._clock(), 0)
+
+    def __call__(self, operation, **kwargs):
+        """Call the client's operation method with kwargs.
+
+        :raises AssetTimeoutError: if the deadline was exceeded.
+        :raises: the error of the last attempt, once retries are exhausted.
+        """
+        policy, deadline = self.policy(operation)
+        expires_at = self._clock() + deadline if deadline else None
+        method = getattr(
+            self.read_client if operation in READS else self.client,
+            operation)
+        attempt = 0
+        while True:
+            try:
+                if operation in READS and (expires_at or policy.hedge):
+                    return self._read(operation, method, kwargs, policy,
+                                      expires_at)
+                return self._attempt(operation, method, kwargs)
+            except Exception as e:
+                if attempt >= policy.retries or not is_retryable(e):
+                    raise
+                attempt += 1
+                delay = policy.delay(attempt)
+                if expires_at is not None and (
+                        self._clock() + delay >= expires_at):
+                    raise _timeout(operation)
+                metrics.S3_CALL_EVENTS.inc(operation, 'retried')
+                self._sleep(delay)
+
+    def _attempt(self, operation, method, kwargs):
+        started_at = time.perf_counter()
+        result = method(**kwargs)
+        self.tracker.observe(operation, time.perf_counter() - started_at)
+        return result
+
+    def _submit(self, operation, method, kwargs):
+        """Run an attempt on an idle worker, None if there is none."""
+        with self._busy_lock:
+            if self._busy >= self.workers:
+                return
+            self._busy += 1
+        attempt = self.executor.submit(
+            self._attempt, operation, method, kwargs)
+        attempt.add_done_callback(self._release_worker)
+        return attempt
+
+    def _release_worker(self, attempt):
+        with self._busy_lock:
+            self._busy -= 1
+
+    def _read(self, operation, method, kwargs, policy, expires_at):
+        attempt = self._submit(operation, method, kwargs)
+        if attempt is None:
+            # NOTE(armax): every worker is busy, e.g. with the attempts
+            # abandoned while S3 browns out: queueing behind them would
+            # only time out, and a hedge would make it worse. Attempt in
+            # this thread instead, bounded by the client's timeouts.
+            metrics.S3_CALL_EVENTS.inc(operation, 'saturated')
+            return self._attempt(operation, method, kwargs)
+        pending = set([attempt])
+        hedge_at = None
+        if policy.hedge:
+            hedge_at = self._clock() + self.tracker.threshold(operation)
+        error = None
+        try:
+            while pending:
+                done, pending = futures.wait(
+                    pending, return_when=futures.FIRST_COMPLETED,
+                    timeout=self._until(expires_at, hedge_at))
+                for attempt in done:
+                    if attempt.exception() is None:
+                        _release(done - set([attempt]))
+                        return attempt.result()
+                    error = attempt.exception()
+                if expires_at is not None and self._clock() >= expires_at:
+                    raise _timeout(operation)
+                if hedge_at is not None and self._clock() >= hedge_at:
+                    # the slow attempt may be answered yet, keep waiting
+                    hedge_at = None
+                    attempt = None
+                    if pending:
+                        attempt = self._submit(operation, method, kwargs)
+                    if attempt is not None:
+                        metrics.S3_CALL_EVENTS.inc(operation, 'hedged')
+                        pending.add(attempt)
+            raise error
+        finally:
+            _release(pending)
+
+
+class AsyncCaller(Caller):
+    """Call aiobotocore client methods within their policy.
+
+    The attempts that lost to a hedged one, or outlived their deadline,
+    are cancelled.
+    """
+
+    def __init__(self, client, read_policy=READ_POLICY,
+                 write_policy=WRITE_POLICY, deadlines=None, tracker=None,
+                 clock=time.monotonic, sleep=asyncio.sleep):
+        super(AsyncCaller, self).__init__(
+            client, read_policy=read_policy, write_policy=write_policy,
+            deadlines=deadlines, tracker=tracker, workers=None, clock=clock,
+            sleep=sleep)
+
+    async def __call__(self, operation, **kwargs):
+        """See Caller.__call__."""
+        policy, deadline = self.policy(operation)
+        expires_at = self._clock() + deadline if deadline else None
+        method = getattr(self.client, operation)
+        attempt = 0
+        while True:
+            try:
+                if operation in READS and (expires_at or policy.hedge):
+                    return await self._read(operation, method, kwargs,
+                                            policy, expires_at)
+                return await self._attempt(operation, method, kwargs)
+            except Exception as e:
+                if attempt >= policy.retries or not is_retryable(e):
+                    raise
+                attempt += 1
+                delay = policy.delay(attempt)
+                if expires_at is not None and (
+                        self._clock() + delay >= expires_at):
+                    raise _timeout(operation)
+                metrics.S3_CALL_EVENTS.inc(operation, 'retried')
+                await self._sleep(delay)
+
+    async def _attempt(self, operation, method, kwargs):
+        started_at = time.perf_counter()
+        result = await method(**kwargs)
+        self.tracker.observe(operation, time.perf_counter() - started_at)
+        return result
+
+    async def _read(self, operation, method, kwargs, policy, expires_at):
+        pending = set([asyncio.ensure_future(
+            self._attempt(operation, method, kwargs))])
+        hedge_at = None
+        if policy.hedge:
+            hedge_at = self._clock() + self.tracker.threshold(operation)
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED,
+                    timeout=self._until(expires_at, hedge_at))
+                for attempt in done:
+                    if attempt.exception() is None:
+                        _release(done - set([attempt]))
+                        return attempt.result()
+                    error = attempt.exception()
+                if expires_at is not None and self._clock() >= expires_at:
+                    raise _timeout(operation)
+                if hedge_at is not None and self._clock() >= hedge_at:
+                    hedge_at = None
+                    if pending:
+                        metrics.S3_CALL_EVENTS.inc(operation, 'hedged')
+                        pending.add(asyncio.ensure_future(
+                            self._attempt(operation, method, kwargs)))
+            raise error
+        finally:
+            for attempt in pending:
+                attempt.cancel()
+            _release(pending)
+
+
+def _release(attempts):
+    """Close the bodies streamed by attempts whose result goes unused, as
+    soon as they complete.
+    """
+    for attempt in attempts:
+        attempt.add_done_callback(_close_body)
+
+
+def _close_body(attempt):
+    if attempt.cancelled() or attempt.exception() is not None:
+        return
+    result = attempt.result()
+    if isinstance(result, dict) and 'Body' in result:
+        result['Body'].close()
+
+
+def _timeout(operation):
+    metrics.S3_CALL_EVENTS.inc(operation, 'deadline_exceeded')
+    return exceptions.AssetTimeoutError()
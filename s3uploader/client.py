@@ -0,0 +1,389 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Upload and download assets through the API, in parallel.
+
+Files are memory-mapped and streamed to S3 a block at a time, so that
+they are never loaded in memory as a whole. Files of at least
+multipart_threshold bytes are uploaded in parts, in parallel, with the
+multipart endpoints; downloads are split into ranged GETs, run in
+parallel and written in place.
+
+S3 transfers run in a thread pool of the given concurrency, separate
+from the one orchestrating the files, so that a file waiting for its
+parts never holds a transfer slot.
+"""
+
+from concurrent import futures
+import json
+import mmap
+import os
+import random
+import threading
+import time
+import uuid
+
+import urllib3
+
+from s3uploader import constants
+
+
+class TransferError(Exception):
+    """A request to the API or to S3 failed, even after retries."""
+
+    def __init__(self, status, message):
+        super(TransferError, self).__init__(
+            '%s: %s' % (status or 'connection error', message))
+        self.status = status
+
+
+class Progress(object):
+    """Thread-safe transfer counters, and their throughput."""
+
+    def __init__(self, clock=time.monotonic):
+        self.total_bytes = 0
+        self.done_bytes = 0
+        self.files = 0
+        self.done_files = 0
+        self.failed_files = 0
+        self._clock = clock
+        self._started_at = clock()
+        self._lock = threading.Lock()
+
+    def add_file(self, size=0):
+        with self._lock:
+            self.files += 1
+            self.total_bytes += size
+
+    def add_total(self, size):
+        """Account for bytes to transfer found out along the way."""
+        with self._lock:
+            self.total_bytes += size
+
+    def add_bytes(self, count):
+        with self._lock:
+            self.done_bytes += count
+
+    def file_done(self, failed=False):
+        with self._lock:
+            if failed:
+                self.failed_files += 1
+            else:
+                self.done_files += 1
+
+    @property
+    def throughput(self):
+        """Bytes transferred per second so far."""
+        return self.done_bytes / max(self._clock() - self._started_at, 1e-6)
+
+    def report(self):
+        report = '%d/%d files, %s/%s, %s/s' % (
+            self.done_files, self.files, _human(self.done_bytes),
+            _human(self.total_bytes), _human(self.throughput))
+        if self.failed_files:
+            report += ', %d failed' % self.failed_files
+        return report
+
+
+def _human(count):
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if count < 1024:
+            break
+        count /= 1024.0
+    else:
+        unit = 'TiB'
+    return '%.1f %s' % (count, unit)
+
+
+class _Reader(object):
+    """Read a sequence of byte strings and buffer slices as one stream.
+
+    Only one block at a time is copied out of the buffers, e.g. out of a
+    memory-mapped file.
+    """
+
+    def __init__(self, *pieces):
+        # (buffer, start, end) triples
+        self._pieces = [(piece, 0, len(piece)) if isinstance(piece, bytes)
+                        else piece for piece in pieces]
+        self._index = 0
+        self._position = self._pieces[0][1] if self._pieces else 0
+
+    def __len__(self):
+        return sum(end - start for _, start, end in self._pieces)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = len(self)
+        while self._index < len(self._pieces):
+            data, _, end = self._pieces[self._index]
+            if self._position < end:
+                block = data[self._position:min(self._position + size, end)]
+                self._position += len(block)
+                return block
+            self._index += 1
+            if self._index < len(self._pieces):
+                self._position = self._pieces[self._index][1]
+        return b''
+
+
+def _form_body(fields, filename, data, size):
+    """Return a multipart/form-data body factory for a presigned POST.
+
+    The factory returns a fresh reader, so that requests can be retried.
+    """
+    boundary = uuid.uuid4().hex
+    preamble = b''.join(
+        ('--%s\r\nContent-Disposition: form-data; name="%s"\r\n\r\n%s\r\n'
+         % (boundary, name, value)).encode('utf-8')
+        for name, value in fields.items())
+    # NOTE(armax): S3 ignores whatever follows the file field, it must
+    # come last.
+    preamble += (
+        '--%s\r\nContent-Disposition: form-data; name="file"; '
+        'filename="%s"\r\nContent-Type: application/octet-stream\r\n\r\n'
+        % (boundary, filename.replace('"', '_'))).encode('utf-8')
+    epilogue = ('\r\n--%s--\r\n' % boundary).encode('utf-8')
+
+    def body():
+        return _Reader(preamble, (data, 0, size), epilogue)
+
+    headers = {
+        'Content-Type': 'multipart/form-data; boundary=%s' % boundary,
+        'Content-Length': str(len(preamble) + size + len(epilogue)),
+    }
+    return body, headers
+
+
+def _map(f, size):
+    if not size:
+        return b''
+    return mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+
+
+def _message(response):
+    try:
+        body = json.loads(response.data.decode('utf-8'))
+    except ValueError:
+        return response.data[:200].decode('utf-8', 'replace')
+    if isinstance(body, dict):
+        return body.get('message', body)
+    return body
+
+
+class Client(object):
+
+    def __init__(self, endpoint, concurrency=constants.CLIENT_CONCURRENCY,
+                 retries=constants.CLIENT_RETRIES,
+                 part_size=constants.MULTIPART_PART_SIZE,
+                 multipart_threshold=constants.MULTIPART_PART_SIZE,
+                 chunk_size=constants.CLIENT_CHUNK_SIZE,
+                 url_timeout=constants.CLIENT_URL_TIMEOUT,
+                 progress=None, http=None):
+        self.endpoint = endpoint.rstrip('/')
+        self.concurrency = concurrency
+        self.retries = retries
+        self.part_size = part_size
+        self.multipart_threshold = multipart_threshold
+        self.chunk_size = chunk_size
+        self.url_timeout = url_timeout
+        self.progress = progress or Progress()
+        # NOTE(armax): the API calls and every transfer can run at once.
+        self.http = http or urllib3.PoolManager(maxsize=concurrency * 2)
+        self._files = futures.ThreadPoolExecutor(max_workers=concurrency)
+        self._transfers = futures.ThreadPoolExecutor(max_workers=concurrency)
+
+    def close(self):
+        self._files.shutdown()
+        self._transfers.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def upload_files(self, paths):
+        """Upload files as new assets, in parallel.
+
+        Yield a (path, asset ID, error) tuple for each file as it is done,
+        the asset ID is None if the upload failed.
+        """
+        jobs = {}
+        for path in paths:
+            self.progress.add_file(os.path.getsize(path))
+            jobs[self._files.submit(self.upload_file, path)] = path
+        for job in futures.as_completed(jobs):
+            try:
+                yield jobs[job], job.result(), None
+            except (TransferError, EnvironmentError) as e:
+                self.progress.file_done(failed=True)
+                yield jobs[job], None, e
+            else:
+                self.progress.file_done()
+
+    def upload_file(self, path):
+        """Upload a file as a new asset, return its ID."""
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            data = _map(f, size)
+            try:
+                if size >= self.multipart_threshold:
+                    return self._upload_parts(data, size)
+                return self._upload(os.path.basename(path), data, size)
+            finally:
+                if size:
+                    data.close()
+
+    def _upload(self, filename, data, size):
+        asset = self._api('POST', '/asset')
+        post = asset['upload_url']
+        body, headers = _form_body(post['fields'], filename, data, size)
+        self._transfers.submit(
+            self._request, 'POST', post['url'], body, headers).result()
+        self.progress.add_bytes(size)
+        self._api('PUT', '/asset/%s' % asset['id'],
+                  {'Status': 'Uploaded', 'Size': size})
+        return asset['id']
+
+    def _upload_parts(self, data, size):
+        upload = self._api('POST', '/asset:multipart',
+                           {'size': size, 'part_size': self.part_size})
+        path = '/asset/%s/multipart/%s' % (upload['id'], upload['upload_id'])
+        part_size = upload['part_size']
+        jobs = []
+        for part in upload['parts']:
+            start = (part['part_number'] - 1) * part_size
+            jobs.append(self._transfers.submit(
+                self._upload_part, part['upload_url'], data, start,
+                min(start + part_size, size)))
+        try:
+            for job in jobs:
+                job.result()
+        except Exception:
+            for job in jobs:
+                job.cancel()
+            futures.wait(jobs)
+            try:
+                self._api('DELETE', path)
+            except TransferError:
+                pass
+            raise
+        self._api('PUT', path, {'Status': 'Uploaded', 'Size': size})
+        return upload['id']
+
+    def _upload_part(self, url, data, start, end):
+        self._request('PUT', url, lambda: _Reader((data, start, end)),
+                      {'Content-Length': str(end - start)})
+        self.progress.add_bytes(end - start)
+
+    def download_assets(self, asset_ids, directory):
+        """Download assets into directory, in parallel.
+
+        Yield an (asset ID, path, error) tuple for each asset as it is
+        done, the path is None if the download failed.
+        """
+        jobs = {}
+        for asset_id in asset_ids:
+            path = os.path.join(directory, asset_id)
+            self.progress.add_file()
+            jobs[self._files.submit(self.download, asset_id, path)] = (
+                asset_id, path)
+        for job in futures.as_completed(jobs):
+            asset_id, path = jobs[job]
+            try:
+                job.result()
+            except (TransferError, EnvironmentError) as e:
+                self.progress.file_done(failed=True)
+                yield asset_id, None, e
+            else:
+                self.progress.file_done()
+                yield asset_id, path, None
+
+    def download(self, asset_id, path):
+        """Download an asset into path with parallel ranged GETs."""
+        url = self._api('GET', '/asset/%s?timeout=%d' % (
+            asset_id, self.url_timeout))['download_url']
+        try:
+            first = self._transfers.submit(
+                self._request, 'GET', url, None,
+                {'Range': 'bytes=0-%d' % (self.chunk_size - 1)}).result()
+        except TransferError as e:
+            if e.status != 416:
+                raise
+            # an empty object has no range to satisfy
+            open(path, 'wb').close()
+            return
+        content_range = first.headers.get('Content-Range')
+        size = (int(content_range.rpartition('/')[2]) if content_range
+                else len(first.data))
+        self.progress.add_total(size)
+
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, size)
+            os.pwrite(fd, first.data, 0)
+            self.progress.add_bytes(len(first.data))
+            jobs = [self._transfers.submit(self._download_range, url, fd,
+                                           start, min(start + self.chunk_size,
+                                                      size))
+                    for start in range(len(first.data), size,
+                                       self.chunk_size)]
+            try:
+                for job in jobs:
+                    job.result()
+            finally:
+                for job in jobs:
+                    job.cancel()
+                futures.wait(jobs)
+        finally:
+            os.close(fd)
+
+    def _download_range(self, url, fd, start, end):
+        response = self._request('GET', url, None,
+                                 {'Range': 'bytes=%d-%d' % (start, end - 1)})
+        if len(response.data) != end - start:
+            raise TransferError(response.status, 'short read at %d' % start)
+        os.pwrite(fd, response.data, start)
+        self.progress.add_bytes(end - start)
+
+    def _api(self, method, path, content=None):
+        body = None
+        headers = {}
+        if content is not None:
+            body = json.dumps(content).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        response = self._request(method, self.endpoint + path, body, headers)
+        return json.loads(response.data.decode('utf-8'))
+
+    def _request(self, method, url, body=None, headers=None):
+        """Issue a request, retrying connection errors and 5xx responses.
+
+        body may be a function returning a fresh body for each attempt.
+        """
+        for attempt in range(self.retries + 1):
+            if attempt:
+                # exponential backoff, with jitter
+                time.sleep(random.uniform(0, 0.1 * 2 ** attempt))
+            try:
+                response = self.http.request(
+                    method, url, body=body() if callable(body) else body,
+                    headers=headers, retries=False, redirect=False)
+            except urllib3.exceptions.HTTPError as e:
+                error = TransferError(None, e)
+                continue
+            if response.status < 400:
+                return response
+            error = TransferError(response.status, _message(response))
+            if response.status < 500 and response.status != 429:
+                break
+        raise error
@@ -0,0 +1,35 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import argparse
+
+from s3uploader import asgi
+from s3uploader import s3
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Serve the S3 uploader API with asyncio.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    args = parser.parse_args()
+
+    try:
+        s3.get_config()
+    except ValueError as e:
+        raise SystemExit('invalid configuration: %s' % e)
+    try:
+        import uvicorn
+    except ImportError:
+        raise SystemExit('the uvicorn package is required to serve the API '
+                         'with asyncio')
+    uvicorn.run(asgi.app, host=args.host, port=args.port, lifespan='on')
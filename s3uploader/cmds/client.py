@@ -0,0 +1,113 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Upload files and directories as assets, or download assets.
+
+    s3uploader-client --endpoint http://localhost:5000 upload videos/
+    s3uploader-client --endpoint http://localhost:5000 download <id>...
+
+Uploads print the ID and the path of each asset on standard output, while
+the progress is reported on standard error.
+"""
+
+import argparse
+import os
+import sys
+import threading
+
+from s3uploader import client
+from s3uploader import constants
+
+
+def _walk(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    full_path = os.path.join(root, name)
+                    if os.path.isfile(full_path):
+                        yield full_path
+        else:
+            yield path
+
+
+def _report(progress, done, interval, out=sys.stderr):
+    tty = out.isatty()
+    while not done.wait(interval):
+        out.write(('\r%s\033[K' if tty else '%s\n') % progress.report())
+        out.flush()
+    out.write(('\r%s\033[K\n' if tty else '%s\n') % progress.report())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--endpoint', default=os.environ.get(
+        'S3UPLOADER_ENDPOINT', 'http://localhost:5000'),
+        help='URL of the API (default: $S3UPLOADER_ENDPOINT)')
+    parser.add_argument('--concurrency', type=int,
+                        default=constants.CLIENT_CONCURRENCY,
+                        help='number of transfers run at once')
+    parser.add_argument('--retries', type=int,
+                        default=constants.CLIENT_RETRIES)
+    parser.add_argument('--part-size', type=int,
+                        default=constants.MULTIPART_PART_SIZE,
+                        help='size of the parts of multipart uploads')
+    parser.add_argument('--multipart-threshold', type=int,
+                        default=constants.MULTIPART_PART_SIZE,
+                        help='size from which files are uploaded in parts')
+    parser.add_argument('--chunk-size', type=int,
+                        default=constants.CLIENT_CHUNK_SIZE,
+                        help='size of the ranges downloaded in parallel')
+    parser.add_argument('--quiet', action='store_true',
+                        help='do not report the progress')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+    upload = commands.add_parser('upload', help='upload files as assets')
+    upload.add_argument('paths', nargs='+', metavar='path')
+    download = commands.add_parser('download', help='download assets')
+    download.add_argument('asset_ids', nargs='+', metavar='asset_id')
+    download.add_argument('--output', default='.',
+                          help='directory to download the assets into')
+    args = parser.parse_args(argv)
+
+    progress = client.Progress()
+    done = threading.Event()
+    if not args.quiet:
+        reporter = threading.Thread(target=_report,
+                                    args=(progress, done, 1.0))
+        reporter.daemon = True
+        reporter.start()
+    failed = 0
+    with client.Client(args.endpoint, concurrency=args.concurrency,
+                       retries=args.retries, part_size=args.part_size,
+                       multipart_threshold=args.multipart_threshold,
+                       chunk_size=args.chunk_size,
+                       progress=progress) as api_client:
+        if args.command == 'upload':
+            results = ((path, asset_id, error) for path, asset_id, error in
+                       api_client.upload_files(_walk(args.paths)))
+        else:
+            results = ((path, asset_id, error) for asset_id, path, error in
+                       api_client.download_assets(args.asset_ids,
+                                                  args.output))
+        for path, asset_id, error in results:
+            if error is not None:
+                failed += 1
+                sys.stderr.write('%s: %s\n' % (path or asset_id, error))
+            elif args.command == 'upload':
+                print('%s\t%s' % (asset_id, path))
+            sys.stdout.flush()
+    done.set()
+    if not args.quiet:
+        reporter.join()
+    return 1 if failed else 0
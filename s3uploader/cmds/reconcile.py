@@ -0,0 +1,229 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Bulk-index the state of the bucket's objects into the state database.
+
+The bucket is walked a page of list_objects_v2 at a time, and the tags of
+the objects in a page are fetched concurrently. Progress is checkpointed
+in the state database after each page, so that an interrupted run can be
+resumed where it stopped.
+
+With a time-ordered key layout, incremental runs only list the keys of
+the assets created since the last run (give or take a lookback period),
+rather than the whole bucket.
+
+With several locations configured, each one is reconciled on its own,
+see --location.
+"""
+
+import argparse
+from concurrent import futures
+import itertools
+import logging
+import time
+
+from werkzeug import exceptions as werkzeug_exc
+
+from s3uploader import constants
+from s3uploader import keys
+from s3uploader import routing
+from s3uploader import s3
+from s3uploader import state
+
+
+LOG = logging.getLogger(__name__)
+
+TOKEN = 'reconciler.continuation_token'
+RANGE = 'reconciler.range'
+RUN_STARTED_AT = 'reconciler.run_started_at'
+LAST_RUN_STARTED_AT = 'reconciler.last_run_started_at'
+
+
+class Reconciler(object):
+
+    def __init__(self, storage_manager, state_store, readiness_cache=None,
+                 workers=constants.RECONCILER_WORKERS,
+                 page_size=constants.RECONCILER_PAGE_SIZE,
+                 key_layout=None, lookback=constants.RECONCILER_LOOKBACK,
+                 location=None, clock=time.time):
+        self.storage_manager = storage_manager
+        self.state_store = state_store
+        self.readiness_cache = readiness_cache
+        self.workers = workers
+        self.page_size = page_size
+        self.key_layout = key_layout or keys.FlatLayout()
+        # NOTE(armax): an asset may be uploaded long after it was created,
+        # and its ID handed out.
+        self.lookback = lookback
+        # the name of the location of the bucket, see routing.split
+        self.location = location
+        self.listed = 0
+        self.indexed = 0
+        self.skipped = 0
+        self.failed = 0
+        self._clock = clock
+
+    def _get_metadata(self, name):
+        return self.state_store.get_metadata(routing.join(self.location, name))
+
+    def _set_metadata(self, name, value):
+        self.state_store.set_metadata(routing.join(self.location, name), value)
+
+    def run(self, resume=True, incremental=False):
+        """Walk the bucket, return the number of objects listed."""
+        started_at = began = self._clock()
+        token = None
+        first_range = 0
+        if resume:
+            token = self._get_metadata(TOKEN)
+            first_range = int(self._get_metadata(RANGE) or 0)
+        if token or first_range:
+            # keep the original start time of the interrupted run
+            started_at = float(
+                self._get_metadata(RUN_STARTED_AT) or started_at)
+            LOG.info('Resuming from listing %d, continuation token %s',
+                     first_range, token)
+        else:
+            self._set_metadata(RUN_STARTED_AT, repr(started_at))
+        newer_than = None
+        if incremental:
+            last_run = self._get_metadata(LAST_RUN_STARTED_AT)
+            newer_than = float(last_run) if last_run else None
+        ranges = self.key_layout.ranges(
+            newer_than - self.lookback if newer_than is not None else None)
+
+        with futures.ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for index, listing in itertools.islice(
+                    enumerate(ranges), first_range, None):
+                while True:
+                    objects, token = self.storage_manager.list_objects(
+                        page_size=self.page_size, continuation_token=token,
+                        **listing)
+                    self._index_page(pool, objects, newer_than)
+                    self._set_metadata(TOKEN, token)
+                    elapsed = max(self._clock() - began, 1e-6)
+                    LOG.info('Listed %d objects (%d indexed, %d skipped, '
+                             '%d failed), %.1f objects/s', self.listed,
+                             self.indexed, self.skipped, self.failed,
+                             self.listed / elapsed)
+                    if not token:
+                        break
+                self._set_metadata(RANGE, str(index + 1))
+        self._set_metadata(RANGE, None)
+        self._set_metadata(LAST_RUN_STARTED_AT, repr(started_at))
+        return self.listed
+
+    def _index_page(self, pool, objects, newer_than):
+        pending = []
+        for obj in objects:
+            self.listed += 1
+            asset_id = self.key_layout.asset_id(obj['Key'])
+            if asset_id is None:
+                # not an asset of ours
+                self.skipped += 1
+                continue
+            modified = s3.object_timestamp(obj.get('LastModified'))
+            if newer_than is not None and modified is not None and (
+                    modified < newer_than):
+                self.skipped += 1
+                continue
+            known = self.state_store.get(
+                routing.join(self.location, asset_id))
+            if known is not None and known.uploaded:
+                # once uploaded, always uploaded: no need to ask S3 again
+                self.skipped += 1
+                continue
+            pending.append((asset_id, obj))
+        for (asset_id, obj), uploaded in zip(pending, pool.map(
+                self._get_upload_status, [p[0] for p in pending])):
+            if uploaded is None:
+                self.failed += 1
+                continue
+            self.state_store.record(state.AssetState(
+                routing.join(self.location, asset_id),
+                state.UPLOADED if uploaded else state.CREATED,
+                size=obj.get('Size'),
+                created_at=s3.object_created_at(asset_id, obj)))
+            # NOTE(armax): the S3 managers of the locations only ever see
+            # the IDs within their location, so does their readiness cache.
+            if self.readiness_cache is not None:
+                self.readiness_cache.observe(asset_id, uploaded)
+            self.indexed += 1
+
+    def _get_upload_status(self, asset_id):
+        try:
+            return self.storage_manager.get_upload_status(asset_id)
+        except werkzeug_exc.HTTPException as e:
+            # e.g. the object was deleted since it was listed
+            LOG.warning('Cannot get the status of %s: %s', asset_id, e)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int,
+                        default=constants.RECONCILER_WORKERS,
+                        help='number of tagging requests run concurrently')
+    parser.add_argument('--page-size', type=int,
+                        default=constants.RECONCILER_PAGE_SIZE)
+    parser.add_argument('--restart', action='store_true',
+                        help='ignore the checkpoint of an interrupted run')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only index objects modified since the start '
+                             'of the last completed run')
+    parser.add_argument('--lookback', type=int,
+                        default=constants.RECONCILER_LOOKBACK,
+                        help='with a sharded key layout, how long before the '
+                             'last run incremental runs list assets created '
+                             '(in seconds)')
+    parser.add_argument('--location',
+                        help='the name of the location to reconcile, see '
+                             'S3UPLOADER_LOCATIONS (by default AWS_BUCKET)')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+    config = s3.Config()
+    if not config.state_db:
+        raise SystemExit('S3UPLOADER_STATE_DB must point to the state '
+                         'database to build')
+    if args.location is not None:
+        for location in config.locations:
+            if location.name == args.location:
+                break
+        else:
+            raise SystemExit('%s is not a location of S3UPLOADER_LOCATIONS'
+                             % args.location)
+        config = location.apply(config)
+    client = s3.create_client(config)
+    key_layout = s3.build_key_layout(config)
+    storage_manager = s3.S3Manager(config=config, client=client,
+                                   caller=s3.build_caller(
+                                       config, client,
+                                       read_client=s3.create_read_client(
+                                           config)),
+                                   key_layout=key_layout)
+    reconciler = Reconciler(
+        storage_manager, state.SQLiteStateStore(config.state_db),
+        # NOTE(armax): an in-process cache would die with this process,
+        # only a shared one is worth warming up.
+        readiness_cache=(s3.build_readiness_cache(config)
+                         if config.readiness_cache_url else None),
+        workers=args.workers, page_size=args.page_size,
+        key_layout=key_layout, lookback=args.lookback,
+        location=args.location)
+    started_at = time.time()
+    listed = reconciler.run(resume=not args.restart,
+                            incremental=args.incremental)
+    elapsed = time.time() - started_at
+    print('%d objects listed, %d indexed, %d skipped, %d failed in %.1fs '
+          '(%.1f objects/s)' % (listed, reconciler.indexed,
+                                reconciler.skipped, reconciler.failed,
+                                elapsed, listed / max(elapsed, 1e-6)))
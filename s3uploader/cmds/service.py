@@ -10,10 +10,21 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import argparse
+import multiprocessing
+
 import flask
 import flask_restful
 
+from s3uploader import admission
 from s3uploader import api
+from s3uploader import constants
+from s3uploader import s3
+
+try:
+    from gunicorn.app import base as gunicorn_base
+except ImportError:
+    gunicorn_base = None
 
 
 app = flask.Flask(__name__)
@@ -21,9 +32,121 @@ api_blueprint = flask.Blueprint('api', __name__)
 api_service = flask_restful.Api(api_blueprint)
 
 api_service.add_resource(api.Asset, '/asset/<string:asset_id>')
+api_service.add_resource(api.AssetContent,
+                         '/asset/<string:asset_id>/content')
 api_service.add_resource(api.Assets, '/asset')
+api_service.add_resource(api.AssetsBatch, '/assets:batch')
+api_service.add_resource(api.AssetsBatchGet, '/assets:batchGet')
+api_service.add_resource(api.AssetsMultipart, '/asset:multipart')
+api_service.add_resource(
+    api.AssetMultipartUpload,
+    '/asset/<string:asset_id>/multipart/<string:upload_id>')
 app.register_blueprint(api_blueprint)
+app.add_url_rule('/metrics', 'metrics', api.metrics_view)
+
+
+def post_fork(server, worker):
+    # NOTE(armax): with the app preloaded, the master may have built the
+    # shared asset manager: its client and connection pool must not be
+    # shared with the workers (os.register_at_fork takes care of it as
+    # well, on Python 3.7+).
+    s3.reset_asset_manager()
+    admission.reset_limiters()
+
+
+def post_worker_init(worker):
+    # build this worker's S3 client before it accepts its first request,
+    # unless it is to be built on first use
+    try:
+        if s3.get_config().warm_up:
+            s3.warm_up()
+    except Exception:
+        s3.LOG.exception('Cannot build the asset manager, it will be built '
+                         'on the first request')
+
+
+def server_options(args):
+    """Return the gunicorn settings matching the command line."""
+    return {
+        'bind': '%s:%d' % (args.host, args.port),
+        'workers': args.workers,
+        'worker_class': 'gthread',
+        'threads': args.threads,
+        'backlog': args.backlog,
+        'keepalive': args.keepalive,
+        'timeout': args.timeout,
+        'graceful_timeout': args.graceful_timeout,
+        'max_requests': args.max_requests,
+        'max_requests_jitter': args.max_requests // 10,
+        'preload_app': True,
+        'post_fork': post_fork,
+        'post_worker_init': post_worker_init,
+    }
+
+
+if gunicorn_base is not None:
+    class Server(gunicorn_base.BaseApplication):
+        """Serve app with pre-forked, multi-threaded gunicorn workers."""
+
+        def __init__(self, application, options):
+            self.application = application
+            self.options = options
+            super(Server, self).__init__()
+
+        def load_config(self):
+            for name, value in self.options.items():
+                self.cfg.set(name, value)
+
+        def load(self):
+            return self.application
+
 
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Serve the S3 uploader API.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--workers', type=int,
+                        default=multiprocessing.cpu_count(),
+                        help='number of worker processes (default: one per '
+                             'CPU)')
+    parser.add_argument('--threads', type=int,
+                        default=constants.SERVER_THREADS,
+                        help='number of threads per worker')
+    parser.add_argument('--backlog', type=int,
+                        default=constants.SERVER_BACKLOG,
+                        help='maximum number of pending connections')
+    parser.add_argument('--keepalive', type=int,
+                        default=constants.SERVER_KEEPALIVE,
+                        help='seconds to wait for the next request on a '
+                             'keep-alive connection')
+    parser.add_argument('--timeout', type=int,
+                        default=constants.SERVER_TIMEOUT,
+                        help='seconds after which a silent worker is '
+                             'restarted')
+    parser.add_argument('--graceful-timeout', type=int,
+                        default=constants.SERVER_GRACEFUL_TIMEOUT,
+                        help='seconds workers get to drain their requests '
+                             'on reload or shutdown')
+    parser.add_argument('--max-requests', type=int, default=0,
+                        help='restart workers after this many requests '
+                             '(default: never)')
+    parser.add_argument('--dev', action='store_true',
+                        help="use Flask's single-process development server")
+    args = parser.parse_args(argv)
 
-def main():
-    app.run(debug=False)
+    try:
+        s3.get_config()
+    except ValueError as e:
+        raise SystemExit('invalid configuration: %s' % e)
+    if gunicorn_base is None and not args.dev:
+        # NOTE(armax): gunicorn is an extra, keep serving deployments that
+        # predate it the way they used to be served.
+        s3.LOG.warning('The gunicorn package is not installed, serving the '
+                       "API with Flask's development server: install the "
+                       'production extra to serve it in production')
+        args.dev = True
+    if args.dev:
+        app.run(host=args.host, port=args.port, debug=False)
+        return
+    Server(app, server_options(args)).run()
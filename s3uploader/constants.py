@@ -11,3 +11,112 @@
 # under the License.
 
 DOWNLOAD_TIMEOUT = 60
+
+# the request header telling the caller's AWS region, to sign download URLs
+# against a nearby replica, see s3uploader.routing
+REGION_HEADER = 'X-Client-Region'
+
+# production server settings, see cmds.service
+SERVER_THREADS = 16
+SERVER_BACKLOG = 2048
+SERVER_KEEPALIVE = 5
+SERVER_TIMEOUT = 60
+SERVER_GRACEFUL_TIMEOUT = 30
+
+# botocore connection pool settings, see s3.Config
+MAX_POOL_CONNECTIONS = 10
+CONNECT_TIMEOUT = 60
+READ_TIMEOUT = 60
+
+# S3 call deadlines (in seconds), retries and hedging, see s3uploader.calls
+READ_DEADLINE = 5.0
+READ_RETRIES = 2
+READ_BACKOFF = 0.025
+WRITE_DEADLINE = 15.0
+WRITE_RETRIES = 3
+WRITE_BACKOFF = 0.1
+HEDGE_PERCENTILE = 95
+HEDGE_WINDOW = 1000
+HEDGE_MIN_SAMPLES = 100
+HEDGE_INITIAL_DELAY = 0.5
+HEDGE_MIN_DELAY = 0.01
+CALL_WORKERS = 64
+
+# number of hex digits of the key prefixes, see keys.ShardedLayout; an
+# incremental reconcile lists each of the 16 ** length prefixes
+KEY_PREFIX_LENGTH = 2
+MAX_KEY_PREFIX_LENGTH = 4
+
+# how old an asset must be (in seconds) to be downloaded from a replica,
+# see routing.RoutingManager
+REPLICATION_LAG = 900
+
+# write-behind of the upload completions, see s3uploader.journal: number
+# of completions applied at once, how often the journal is polled, how long
+# a completion may take to apply (longer than the write deadline and its
+# retries) before it is applied again, and the retry backoff
+JOURNAL_WORKERS = 16
+JOURNAL_POLL_INTERVAL = 1.0
+JOURNAL_LEASE = 60
+JOURNAL_BACKOFF = 0.5
+JOURNAL_MAX_BACKOFF = 60
+
+# admission control settings, see s3uploader.admission: the endpoints that
+# can be limited, how many requests may wait for a slot and for how long (in
+# seconds), the Retry-After of the rejected ones, and the latency (in
+# seconds) above which an adaptive limit is cut by the backoff ratio
+LIMITED_ENDPOINTS = ('get_asset', 'put_asset')
+ADMISSION_QUEUE_SIZE = 64
+ADMISSION_QUEUE_TIMEOUT = 0.5
+ADMISSION_RETRY_AFTER = 1
+ADMISSION_LATENCY_TARGET = 1.0
+ADMISSION_BACKOFF_RATIO = 0.9
+
+# download proxy settings, see s3.Download: the size of the chunks the
+# objects are streamed in, i.e. the memory each download holds
+PROXY_CHUNK_SIZE = 64 * 1024
+
+# readiness cache settings, see s3.build_readiness_cache
+READINESS_CACHE_SIZE = 10000
+READINESS_TTL = 3600
+NOT_READY_TTL = 5
+
+# presigned URL cache settings, see s3.build_url_cache
+URL_CACHE_SIZE = 0
+URL_CACHE_MIN_VALIDITY = 0.8
+
+# batch requests settings: maximum number of assets per request, and
+# number of assets looked up concurrently
+BATCH_MAX_SIZE = 100
+BATCH_WORKERS = 8
+
+# asset listing settings: the default and maximum number of assets per page
+LIST_PAGE_SIZE = 100
+LIST_MAX_PAGE_SIZE = 1000
+
+# bucket reconciler settings, see cmds.reconcile
+RECONCILER_PAGE_SIZE = 1000
+RECONCILER_WORKERS = 32
+RECONCILER_LOOKBACK = 86400
+
+# slow request log settings: threshold in seconds (0 disables the log),
+# and share of the requests traced, see metrics.configure_slow_log
+SLOW_REQUEST_THRESHOLD = 0
+SLOW_REQUEST_SAMPLE_RATE = 0.1
+
+# multipart upload settings: the default part size, how long presigned part
+# URLs are valid for, and the S3 limits
+MULTIPART_PART_SIZE = 64 * 1024 * 1024
+MULTIPART_URL_TIMEOUT = 3600
+MULTIPART_MIN_PART_SIZE = 5 * 1024 * 1024
+MULTIPART_MAX_PART_SIZE = 5 * 1024 * 1024 * 1024
+MULTIPART_MAX_PARTS = 10000
+MULTIPART_MAX_SIZE = 5 * 1024 * 1024 * 1024 * 1024
+
+# client settings, see s3uploader.client: number of transfers run at once,
+# retries of a failed request, size of the ranges downloaded in parallel,
+# and how long download URLs are requested for
+CLIENT_CONCURRENCY = 8
+CLIENT_RETRIES = 3
+CLIENT_CHUNK_SIZE = 8 * 1024 * 1024
+CLIENT_URL_TIMEOUT = 3600
@@ -21,6 +21,14 @@ class AssetError(exceptions.HTTPException):
         super(AssetError, self).__init__()
 
 
+class AssetTimeoutError(AssetError):
+    code = 504
+    description = 'S3 did not answer in time, please try later'
+
+    def __init__(self):
+        super(AssetTimeoutError, self).__init__()
+
+
 class AssetNotFoundError(exceptions.HTTPException):
     code = 404
     description = 'asset cannot be found, check asset ID'
@@ -35,3 +43,33 @@ class AssetAccessDeniedError(exceptions.HTTPException):
 
     def __init__(self):
         super(AssetAccessDeniedError, self).__init__()
+
+
+class AssetRangeNotSatisfiableError(exceptions.HTTPException):
+    code = 416
+    description = 'range is not satisfiable, check the asset size'
+
+    def __init__(self):
+        super(AssetRangeNotSatisfiableError, self).__init__()
+
+
+class AssetUploadIncompleteError(exceptions.HTTPException):
+    code = 409
+    description = 'asset upload is incomplete, check its parts'
+
+    def __init__(self):
+        super(AssetUploadIncompleteError, self).__init__()
+
+
+class AssetOverloadedError(AssetError):
+    code = 503
+    description = 'too many requests in progress, please try later'
+
+    def __init__(self, retry_after=1):
+        super(AssetOverloadedError, self).__init__()
+        self.retry_after = retry_after
+
+    def get_headers(self, *args, **kwargs):
+        headers = super(AssetOverloadedError, self).get_headers(
+            *args, **kwargs)
+        return headers + [('Retry-After', str(self.retry_after))]
@@ -0,0 +1,247 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Write-behind of the upload completions.
+
+Marking an upload completed costs an S3 write, which clients would
+otherwise wait on. Instead, completions can be appended to a local,
+durable journal (a SQLite database) and acknowledged at once, while a
+background writer applies them to S3 with bounded concurrency, and
+retries the failed ones with exponential backoff.
+
+Entries are leased to the writer applying them: the entries of a process
+that died (or was killed) become due again once their lease expires, and
+are replayed by any process sharing the journal.
+"""
+
+from concurrent import futures
+import itertools
+import logging
+import random
+import sqlite3
+import threading
+import time
+
+from werkzeug import exceptions as werkzeug_exc
+
+from s3uploader import constants
+from s3uploader import metrics
+
+
+LOG = logging.getLogger(__name__)
+
+
+_memory_databases = itertools.count()
+
+
+class Journal(object):
+    """A durable queue of asset IDs, in a SQLite database in WAL mode."""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS entries (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            asset_id TEXT NOT NULL,
+            appended_at REAL NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            due_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS entries_due_at ON entries (due_at);
+    """
+
+    def __init__(self, path, clock=time.time):
+        self.path = path
+        self._uri = False
+        if path == ':memory:':
+            # NOTE(armax): see state.SQLiteStateStore.
+            self.path = ('file:s3uploader-journal-%d?mode=memory&cache=shared'
+                         % next(_memory_databases))
+            self._uri = True
+        self._clock = clock
+        self._local = threading.local()
+        self._keepalive = self._connection()
+        self._keepalive.executescript(self.SCHEMA)
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30,
+                                         isolation_level=None,
+                                         uri=self._uri)
+            connection.execute('PRAGMA journal_mode=WAL')
+            # NOTE(armax): entries are acknowledged once appended, they
+            # must survive a power loss.
+            connection.execute('PRAGMA synchronous=FULL')
+            self._local.connection = connection
+        return connection
+
+    def append(self, asset_id):
+        now = self._clock()
+        self._connection().execute(
+            'INSERT INTO entries (asset_id, appended_at, due_at) '
+            'VALUES (?, ?, ?)', (asset_id, now, now))
+
+    def claim(self, limit, lease):
+        """Lease up to limit due entries for lease seconds.
+
+        Return them as (seq, asset ID, attempts so far) tuples, oldest
+        first.
+        """
+        now = self._clock()
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            entries = connection.execute(
+                'SELECT seq, asset_id, attempts FROM entries '
+                'WHERE due_at <= ? ORDER BY due_at, seq LIMIT ?',
+                (now, limit)).fetchall()
+            connection.executemany(
+                'UPDATE entries SET due_at = ? WHERE seq = ?',
+                [(now + lease, entry[0]) for entry in entries])
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+        return entries
+
+    def done(self, seq):
+        self._connection().execute('DELETE FROM entries WHERE seq = ?',
+                                   (seq,))
+
+    def retry(self, seq, delay):
+        self._connection().execute(
+            'UPDATE entries SET attempts = attempts + 1, due_at = ? '
+            'WHERE seq = ?', (self._clock() + delay, seq))
+
+    def stats(self):
+        """Return the number of entries, and the age of the oldest one."""
+        count, oldest = self._connection().execute(
+            'SELECT COUNT(*), MIN(appended_at) FROM entries').fetchone()
+        return count, (self._clock() - oldest if oldest is not None else 0.0)
+
+
+class WriteBehind(object):
+    """Journal upload completions, and apply them in the background.
+
+    :param journal: the Journal the completions are appended to.
+    :param apply: the function applying a completion, given the asset ID,
+                  e.g. S3Manager.update_upload_status. Errors with a 4xx
+                  code (e.g. the asset does not exist) are not retried.
+    :param workers: how many completions are applied concurrently.
+    :param lease: how long a completion may take to apply before it is
+                  deemed lost, and applied again.
+    """
+
+    def __init__(self, journal, apply, workers=constants.JOURNAL_WORKERS,
+                 poll_interval=constants.JOURNAL_POLL_INTERVAL,
+                 lease=constants.JOURNAL_LEASE,
+                 backoff=constants.JOURNAL_BACKOFF,
+                 max_backoff=constants.JOURNAL_MAX_BACKOFF):
+        self.journal = journal
+        self.apply = apply
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._executor = None
+        self._thread = None
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._reported_at = 0
+
+    def append(self, asset_id):
+        """Journal the completion of an asset's upload."""
+        self.journal.append(asset_id)
+        self._wakeup.set()
+
+    def start(self):
+        self._executor = futures.ThreadPoolExecutor(max_workers=self.workers)
+        self._thread = threading.Thread(target=self._run,
+                                        name='s3uploader-write-behind')
+        # NOTE(armax): whatever is in flight at exit is replayed later.
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """Stop claiming entries, and wait for those in flight."""
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._executor.shutdown()
+
+    def run_once(self):
+        """Claim due entries up to the free workers, return how many."""
+        with self._lock:
+            free = self.workers - self._in_flight
+        if free <= 0:
+            return 0
+        entries = self.journal.claim(free, self.lease)
+        with self._lock:
+            self._in_flight += len(entries)
+        for entry in entries:
+            self._executor.submit(self._apply, *entry).add_done_callback(
+                self._done)
+        return len(entries)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.clear()
+            try:
+                claimed = self.run_once()
+                self._report()
+            except Exception:
+                LOG.exception('Cannot read the journal')
+                claimed = 0
+            if not claimed:
+                self._wakeup.wait(self.poll_interval)
+
+    def _apply(self, seq, asset_id, attempts):
+        try:
+            self.apply(asset_id)
+        except werkzeug_exc.HTTPException as e:
+            if (e.code or 500) < 500:
+                LOG.error('Dropping the completion of %s: %s', asset_id, e)
+                metrics.JOURNAL_ENTRIES.inc('dropped')
+                self.journal.done(seq)
+                return
+            self._retry(seq, asset_id, attempts, e)
+        except Exception as e:
+            self._retry(seq, asset_id, attempts, e)
+        else:
+            metrics.JOURNAL_ENTRIES.inc('applied')
+            self.journal.done(seq)
+
+    def _retry(self, seq, asset_id, attempts, error):
+        delay = random.uniform(
+            0, min(self.backoff * 2 ** attempts, self.max_backoff))
+        LOG.warning('Cannot apply the completion of %s (attempt %d), '
+                    'retrying in %.1fs: %s', asset_id, attempts + 1, delay,
+                    error)
+        metrics.JOURNAL_ENTRIES.inc('retried')
+        self.journal.retry(seq, delay)
+
+    def _done(self, future):
+        with self._lock:
+            self._in_flight -= 1
+        self._wakeup.set()
+
+    def _report(self):
+        now = time.monotonic()
+        if now - self._reported_at < self.poll_interval:
+            return
+        self._reported_at = now
+        depth, lag = self.journal.stats()
+        metrics.JOURNAL_DEPTH.set(depth)
+        metrics.JOURNAL_LAG.set(lag)
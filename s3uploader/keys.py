@@ -0,0 +1,151 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""How asset IDs map to the keys of their S3 objects.
+
+S3 scales the request rate of a bucket by splitting it into partitions
+along key prefixes. Random keys at the bucket root leave it no say in
+where to split, and tell nothing about when the asset was created.
+
+The sharded layout hands out time-ordered IDs (UUIDv7) and stores each
+object under a prefix derived from the hash of its ID, e.g.
+3f/0190b7a5-8c1e-7d3a-9f2b-6c0e4a1d2b3c: requests spread evenly across
+the prefixes, while keys within a prefix are sorted by creation time, so
+that recent assets can be listed without walking the whole bucket.
+
+IDs that are not UUIDv7, as handed out by the flat layout, always map to
+keys at the bucket root: assets created before switching layouts resolve
+as they always did.
+"""
+
+import os
+import time
+import uuid
+import zlib
+
+from s3uploader import constants
+
+
+def uuid7(clock=time.time):
+    """Return a UUIDv7 (RFC 9562): a timestamp in ms, then random bits."""
+    timestamp = int(clock() * 1000) & 0xffffffffffff
+    value = int.from_bytes(os.urandom(10), 'big')
+    value = (timestamp << 80 | 0x7 << 76 | (value >> 68) << 64 |
+             0x2 << 62 | value & 0x3fffffffffffffff)
+    return uuid.UUID(int=value)
+
+
+def uuid7_floor(timestamp):
+    """Return the lowest UUIDv7 of the millisecond timestamp falls in."""
+    return uuid.UUID(int=max(int(timestamp * 1000), 0) << 80 |
+                     0x7 << 76 | 0x2 << 62)
+
+
+def is_uuid7(asset_id):
+    try:
+        value = uuid.UUID(asset_id)
+    except ValueError:
+        return False
+    # NOTE(armax): the canonical form only, there is one key per asset.
+    return value.version == 7 and str(value) == asset_id
+
+
+def uuid7_timestamp(asset_id):
+    """Return when a UUIDv7 asset ID was handed out, None if it is not one."""
+    if not is_uuid7(asset_id):
+        return
+    return (uuid.UUID(asset_id).int >> 80) / 1000.0
+
+
+class KeyLayout(object):
+    """Interface of the key layouts."""
+
+    def new_id(self):
+        """Return the ID of a new asset."""
+        raise NotImplementedError()
+
+    def key(self, asset_id):
+        """Return the S3 key of an asset."""
+        return asset_id
+
+    def asset_id(self, key):
+        """Return the ID of the asset stored at key, None if none is."""
+        return key
+
+    def ranges(self, since=None):
+        """Return an iterable of the listings covering the assets created
+        since then.
+
+        Each one is a dict of list_objects keyword arguments (prefix,
+        start_after and delimiter).
+        """
+        return [{}]
+
+
+class FlatLayout(KeyLayout):
+    """Random IDs, which are the keys of their objects at the bucket root."""
+
+    def new_id(self):
+        return str(uuid.uuid4())
+
+
+class ShardedLayout(KeyLayout):
+    """Time-ordered IDs, stored under hash prefixes.
+
+    :param prefix_length: the number of hex digits of the prefixes, which
+                          makes for 16 ** prefix_length of them, at most
+                          MAX_KEY_PREFIX_LENGTH. It must not change once
+                          assets were created, as their keys would not
+                          resolve anymore.
+    """
+
+    def __init__(self, prefix_length, clock=time.time):
+        if not 1 <= prefix_length <= constants.MAX_KEY_PREFIX_LENGTH:
+            raise ValueError('prefix_length must be between 1 and %d'
+                             % constants.MAX_KEY_PREFIX_LENGTH)
+        self.prefix_length = prefix_length
+        self._clock = clock
+
+    def new_id(self):
+        return str(uuid7(self._clock))
+
+    def prefix(self, asset_id):
+        return ('%08x' % zlib.crc32(asset_id.encode('utf-8')))[
+            :self.prefix_length]
+
+    def key(self, asset_id):
+        if not is_uuid7(asset_id):
+            return asset_id
+        return '%s/%s' % (self.prefix(asset_id), asset_id)
+
+    def asset_id(self, key):
+        prefix, _, asset_id = key.rpartition('/')
+        if not prefix:
+            return key
+        if self.key(asset_id) == key:
+            return asset_id
+
+    def prefixes(self):
+        for i in range(16 ** self.prefix_length):
+            yield '%0*x' % (self.prefix_length, i)
+
+    def ranges(self, since=None):
+        if since is None:
+            yield {}
+            return
+        start_after = str(uuid7_floor(since))
+        # NOTE(armax): keys at the root, created before switching layouts,
+        # are in no particular order: they are always listed in full.
+        yield {'delimiter': '/'}
+        for prefix in self.prefixes():
+            yield {'prefix': prefix + '/',
+                   'start_after': '%s/%s' % (prefix, start_after)}
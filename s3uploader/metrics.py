@@ -0,0 +1,377 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Latency histograms, counters and gauges in the Prometheus format.
+
+Recording a sample costs a clock read, a bisect and a short critical
+section, so every API request and S3 operation is measured. Metrics are
+kept per process.
+
+A sampled share of the requests can also be traced: the S3 operations
+they go through are timed individually, and requests slower than a
+threshold are logged along with that breakdown.
+"""
+
+import bisect
+import contextvars
+import functools
+import inspect
+import logging
+import random
+import threading
+import time
+
+from werkzeug import exceptions as werkzeug_exc
+
+
+LOG = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace(
+        '\n', r'\n').replace('"', r'\"')
+
+
+def _format_labels(names, values, extra=''):
+    labels = ','.join('%s="%s"' % (name, _escape(value))
+                      for name, value in zip(names, values))
+    if extra:
+        labels = labels + ',' + extra if labels else extra
+    return '{%s}' % labels if labels else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class _Metric(object):
+
+    kind = None
+
+    def __init__(self, name, description, labelnames=()):
+        self.name = name
+        self.description = description
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.description),
+                 '# TYPE %s %s' % (self.name, self.kind)]
+        with self._lock:
+            items = sorted(self._values.items())
+            lines.extend(self._render(labels, value)
+                         for labels, value in items)
+        return '\n'.join(lines)
+
+    def _render(self, labels, value):
+        return '%s%s %s' % (self.name,
+                            _format_labels(self.labelnames, labels),
+                            _format_value(value))
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+class Counter(_Metric):
+
+    kind = 'counter'
+
+    def inc(self, *labels, **kwargs):
+        amount = kwargs.get('amount', 1)
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        return self._values.get(labels, 0)
+
+
+class Gauge(Counter):
+
+    kind = 'gauge'
+
+    def dec(self, *labels):
+        self.inc(*labels, amount=-1)
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(_Metric):
+
+    kind = 'histogram'
+
+    def __init__(self, name, description, labelnames=(), buckets=BUCKETS):
+        super(Histogram, self).__init__(name, description, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            sample = self._values.get(labels)
+            if sample is None:
+                # per bucket counts (the last one is +Inf), sum
+                sample = self._values[labels] = [
+                    [0] * (len(self.buckets) + 1), 0.0]
+            sample[0][index] += 1
+            sample[1] += value
+
+    def count(self, *labels):
+        sample = self._values.get(labels)
+        return sum(sample[0]) if sample else 0
+
+    def _render(self, labels, sample):
+        counts, total = sample
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            lines.append('%s_bucket%s %d' % (
+                self.name, _format_labels(
+                    self.labelnames, labels,
+                    'le="%s"' % _format_value(bound)), cumulative))
+        formatted = _format_labels(self.labelnames, labels)
+        lines.append('%s_sum%s %s' % (self.name, formatted,
+                                      _format_value(total)))
+        lines.append('%s_count%s %d' % (self.name, formatted, cumulative))
+        return '\n'.join(lines)
+
+
+class Registry(object):
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Return all the metrics in the Prometheus text format."""
+        return ''.join(metric.render() + '\n' for metric in self.metrics)
+
+    def clear(self):
+        for metric in self.metrics:
+            metric.clear()
+
+
+REGISTRY = Registry()
+
+REQUEST_SECONDS = REGISTRY.register(Histogram(
+    's3uploader_request_duration_seconds',
+    'Time spent serving API requests.',
+    ('endpoint', 'method', 'status')))
+REQUESTS_IN_FLIGHT = REGISTRY.register(Gauge(
+    's3uploader_requests_in_flight',
+    'API requests being served.',
+    ('endpoint', 'method')))
+S3_OPERATION_SECONDS = REGISTRY.register(Histogram(
+    's3uploader_s3_operation_duration_seconds',
+    'Time spent in S3 manager operations.',
+    ('operation', 'outcome')))
+S3_ERRORS = REGISTRY.register(Counter(
+    's3uploader_s3_errors_total',
+    'Errors returned by S3, by error code.',
+    ('code',)))
+S3_CALL_EVENTS = REGISTRY.register(Counter(
+    's3uploader_s3_call_events_total',
+    'S3 call attempts hedged, retried or not pooled (saturated), and '
+    'deadlines exceeded.',
+    ('operation', 'event')))
+COALESCED_CALLS = REGISTRY.register(Counter(
+    's3uploader_coalesced_calls_total',
+    'Calls that joined an identical call in flight instead of making '
+    'their own.',
+    ('operation',)))
+CACHE_EVENTS = REGISTRY.register(Counter(
+    's3uploader_cache_events_total',
+    'Cache lookups hit or missed, and entries evicted, by cache.',
+    ('cache', 'event')))
+CACHE_SIZE = REGISTRY.register(Gauge(
+    's3uploader_cache_size',
+    'Entries held by the in-process caches.',
+    ('cache',)))
+PROXY_BYTES = REGISTRY.register(Counter(
+    's3uploader_proxy_bytes_total',
+    'Bytes of asset content streamed to clients by the download proxy.'))
+ADMISSION_LIMIT = REGISTRY.register(Gauge(
+    's3uploader_admission_limit',
+    'Requests an endpoint may serve concurrently.',
+    ('endpoint',)))
+ADMISSION_QUEUED = REGISTRY.register(Gauge(
+    's3uploader_admission_queued',
+    'Requests waiting for an endpoint to serve them.',
+    ('endpoint',)))
+ADMISSION_REJECTED = REGISTRY.register(Counter(
+    's3uploader_admission_rejected_total',
+    'Requests shed because the queue of an endpoint was full, or they '
+    'waited in it too long.',
+    ('endpoint', 'reason')))
+JOURNAL_DEPTH = REGISTRY.register(Gauge(
+    's3uploader_journal_depth',
+    'Upload completions journaled and not yet applied to S3.'))
+JOURNAL_LAG = REGISTRY.register(Gauge(
+    's3uploader_journal_lag_seconds',
+    'Age of the oldest upload completion not yet applied to S3.'))
+JOURNAL_ENTRIES = REGISTRY.register(Counter(
+    's3uploader_journal_entries_total',
+    'Journaled upload completions applied to S3, retried or dropped.',
+    ('outcome',)))
+
+
+def outcome(error):
+    """Return the outcome label of an operation that raised error."""
+    if error is None:
+        return 'ok'
+    return type(error).__name__
+
+
+class Trace(object):
+    """The timings of the operations run while serving a request."""
+
+    # NOTE(armax): operations run concurrently for a batch request may get
+    # nested under one another in the breakdown; those run by the batch
+    # thread pool do not show up at all.
+
+    def __init__(self, name):
+        self.name = name
+        self.spans = []
+        self._stack = [self.spans]
+
+    def push(self):
+        self._stack.append([])
+
+    def pop(self, name, elapsed):
+        children = self._stack.pop()
+        self._stack[-1].append((name, elapsed, children))
+
+    def format(self, spans=None):
+        return ', '.join(
+            '%s %.1fms%s' % (name, elapsed * 1000,
+                             ' (%s)' % self.format(children)
+                             if children else '')
+            for name, elapsed, children in (
+                self.spans if spans is None else spans))
+
+
+_trace = contextvars.ContextVar('s3uploader_trace', default=None)
+_slow_log = {'threshold': 0.0, 'sample_rate': 1.0}
+
+
+def configure_slow_log(threshold, sample_rate=1.0):
+    """Log the requests slower than threshold seconds (0 disables it).
+
+    Only a sample_rate share of the requests is traced.
+    """
+    _slow_log['threshold'] = threshold
+    _slow_log['sample_rate'] = sample_rate
+
+
+def timed(operation):
+    """Decorate a function (or a coroutine function) to record its timing.
+
+    Exceptions raised by the function are recorded as its outcome.
+    """
+    def decorator(f):
+        if inspect.iscoroutinefunction(f):
+            @functools.wraps(f)
+            async def async_wrapper(*args, **kwargs):
+                timing = _Timing(operation)
+                try:
+                    result = await f(*args, **kwargs)
+                except Exception as e:
+                    timing.stop(e)
+                    raise
+                timing.stop()
+                return result
+            return async_wrapper
+
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            timing = _Timing(operation)
+            try:
+                result = f(*args, **kwargs)
+            except Exception as e:
+                timing.stop(e)
+                raise
+            timing.stop()
+            return result
+        return wrapper
+    return decorator
+
+
+class _Timing(object):
+
+    __slots__ = ('operation', 'trace', 'started_at')
+
+    def __init__(self, operation):
+        self.operation = operation
+        self.trace = _trace.get()
+        if self.trace is not None:
+            self.trace.push()
+        self.started_at = time.perf_counter()
+
+    def stop(self, error=None):
+        elapsed = time.perf_counter() - self.started_at
+        S3_OPERATION_SECONDS.observe(elapsed, self.operation, outcome(error))
+        if self.trace is not None:
+            self.trace.pop(self.operation, elapsed)
+
+
+class RequestTimer(object):
+    """Measure the serving of an API request.
+
+    The status must be set before the timer is stopped; exceptions set it
+    to their HTTP status code, 500 if they have none.
+    """
+
+    def __init__(self, endpoint, method):
+        self.endpoint = endpoint
+        self.method = method
+        self.status = 200
+        self._trace = None
+        self._token = None
+        self._started_at = None
+
+    def __enter__(self):
+        REQUESTS_IN_FLIGHT.inc(self.endpoint, self.method)
+        if _slow_log['threshold'] and (
+                random.random() < _slow_log['sample_rate']):
+            self._trace = Trace('%s %s' % (self.method, self.endpoint))
+            self._token = _trace.set(self._trace)
+        self._started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        elapsed = time.perf_counter() - self._started_at
+        if exc_value is not None:
+            self.status = getattr(exc_value, 'code', None) or 500
+            if not isinstance(exc_value, werkzeug_exc.HTTPException):
+                self.status = 500
+        REQUESTS_IN_FLIGHT.dec(self.endpoint, self.method)
+        REQUEST_SECONDS.observe(elapsed, self.endpoint, self.method,
+                                str(self.status))
+        if self._trace is not None:
+            _trace.reset(self._token)
+            if elapsed >= _slow_log['threshold']:
+                LOG.warning('Slow request %s %s in %.1fms: %s',
+                            self._trace.name, self.status, elapsed * 1000,
+                            self._trace.format() or 'no S3 operation')
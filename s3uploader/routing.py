@@ -0,0 +1,336 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Spread the assets across several buckets, possibly in several regions.
+
+Each location is a bucket in a region. New assets are placed on the
+locations by weighted rendezvous hashing of their ID, and the name of
+their location is recorded in the asset ID, e.g. eu.0190b7a5-8c1e-..., so
+that later lookups need no search. IDs without a location, handed out
+before locations were configured, belong to the default location, i.e.
+AWS_BUCKET in AWS_REGION.
+
+A location may be replicated to others (by S3 replication, set up outside
+of this service): download URLs are then signed against the replica in
+the caller's region, if any, once the asset is old enough to have been
+replicated.
+"""
+
+import asyncio
+import copy
+import hashlib
+import math
+import re
+import time
+
+from werkzeug import exceptions as werkzeug_exc
+
+from s3uploader import constants
+from s3uploader import exceptions
+from s3uploader import keys
+
+
+SEPARATOR = '.'
+# between the location being listed and its continuation token
+TOKEN_SEPARATOR = ':'
+NAME_PATTERN = re.compile(r'^[a-z0-9][a-z0-9-]*$')
+
+
+class Location(object):
+    """A bucket in a region, which gets new assets as per its weight."""
+
+    def __init__(self, name, bucket, region, weight=1):
+        self.name = name
+        self.bucket = bucket
+        self.region = region
+        self.weight = weight
+
+    def apply(self, config):
+        """Return a copy of config pointing to this location."""
+        config = copy.copy(config)
+        config.bucket = self.bucket
+        config.region = self.region
+        return config
+
+
+def split(asset_id):
+    """Return the location of an asset (None for the default one), and
+    its ID within the location.
+    """
+    location, separator, local_id = asset_id.partition(SEPARATOR)
+    if not separator:
+        return None, asset_id
+    return location, local_id
+
+
+def join(location, asset_id):
+    if location is None:
+        return asset_id
+    return location + SEPARATOR + asset_id
+
+
+class Placement(object):
+    """Pick the location of new assets, by weighted rendezvous hashing.
+
+    :param weights: the weight of each location by name, the locations of
+                    weight 0 get no new assets.
+    """
+
+    def __init__(self, weights):
+        self.weights = dict((name, weight) for name, weight in weights.items()
+                            if weight > 0)
+        if not self.weights:
+            raise ValueError('at least one location must have a positive '
+                             'weight')
+        self._names = sorted(self.weights)
+
+    def place(self, asset_id):
+        return max(self._names, key=lambda name: self._score(name, asset_id))
+
+    def _score(self, name, asset_id):
+        digest = hashlib.blake2b(
+            (name + SEPARATOR + asset_id).encode('utf-8'),
+            digest_size=8).digest()
+        # a uniform number within (0, 1)
+        value = (int.from_bytes(digest, 'big') + 0.5) / 2.0 ** 64
+        return -self.weights[name] / math.log(value)
+
+
+class RoutedLayout(keys.KeyLayout):
+    """Prefix the IDs handed out by layout with their location.
+
+    The S3 keys are up to the layout of each location, which only ever
+    sees IDs within the location.
+    """
+
+    def __init__(self, layout, placement):
+        self.layout = layout
+        self.placement = placement
+
+    def new_id(self):
+        asset_id = self.layout.new_id()
+        return join(self.placement.place(asset_id), asset_id)
+
+
+class RoutingManager(object):
+    """Route the calls about an asset to the S3Manager of its location.
+
+    :param managers: the S3Manager of each location by name, the one of
+                     the default location under None.
+    :param replicas: the names of the replicas of each location, if any.
+    :param replication_lag: how old an asset must be (in seconds) for its
+                            replicas to be trusted, only known of assets
+                            with time-ordered IDs.
+    """
+
+    def __init__(self, managers, replicas=None,
+                 replication_lag=constants.REPLICATION_LAG, clock=time.time):
+        self.managers = managers
+        self.replicas = replicas or {}
+        self.replication_lag = replication_lag
+        self._clock = clock
+
+    @property
+    def executor(self):
+        return self.managers[None].executor
+
+    def _route(self, asset_id):
+        """Return the location of an asset, its manager and local ID."""
+        location, local_id = split(asset_id)
+        manager = self.managers.get(location)
+        if manager is None:
+            raise exceptions.AssetNotFoundError()
+        return location, manager, local_id
+
+    def _reader(self, location, manager, asset_id, region):
+        """Return the manager to sign download URLs with."""
+        if region is None or manager.config.region == region:
+            return manager
+        for name in self.replicas.get(location, ()):
+            replica = self.managers[name]
+            if replica.config.region != region:
+                continue
+            created_at = keys.uuid7_timestamp(asset_id)
+            if created_at is None or (
+                    self._clock() - created_at < self.replication_lag):
+                # NOTE(armax): the replica may not have got it yet, or
+                # there is no telling when the asset was created.
+                return manager
+            return replica
+        return manager
+
+    def get_url_for_upload(self, asset_id):
+        _, manager, asset_id = self._route(asset_id)
+        return manager.get_url_for_upload(asset_id)
+
+    def get_urls_for_upload(self, asset_ids):
+        return [self.get_url_for_upload(asset_id) for asset_id in asset_ids]
+
+    def update_upload_status(self, asset_id):
+        _, manager, asset_id = self._route(asset_id)
+        return manager.update_upload_status(asset_id)
+
+    def get_upload_status(self, asset_id):
+        _, manager, asset_id = self._route(asset_id)
+        return manager.get_upload_status(asset_id)
+
+    def remember_uploaded(self, asset_id):
+        _, manager, asset_id = self._route(asset_id)
+        return manager.remember_uploaded(asset_id)
+
+    def get_url_for_download(self, asset_id, timeout, region=None):
+        """See S3Manager.get_url_for_download.
+
+        The readiness of an asset is always up to its location, which the
+        uploads go to.
+        """
+        location, manager, asset_id = self._route(asset_id)
+        reader = self._reader(location, manager, asset_id, region)
+        if reader is manager:
+            return manager.get_url_for_download(asset_id, timeout)
+        if not manager.get_upload_status(asset_id):
+            return
+        return reader.presign_download(asset_id, timeout)
+
+    def get_urls_for_download(self, asset_ids, timeout, region=None):
+        """See S3Manager.get_urls_for_download."""
+        def _get_url(asset_id):
+            try:
+                return self.get_url_for_download(
+                    asset_id, timeout, region), None
+            except werkzeug_exc.HTTPException as e:
+                return None, e
+
+        return list(self.executor.map(_get_url, asset_ids))
+
+    def presign_download(self, asset_id, timeout, region=None):
+        location, manager, asset_id = self._route(asset_id)
+        return self._reader(location, manager, asset_id,
+                            region).presign_download(asset_id, timeout)
+
+    def open_download(self, asset_id, byte_range=None, if_none_match=None,
+                      chunk_size=constants.PROXY_CHUNK_SIZE):
+        _, manager, asset_id = self._route(asset_id)
+        return manager.open_download(asset_id, byte_range, if_none_match,
+                                     chunk_size)
+
+    def list_assets(self, page_size, continuation_token=None):
+        """List the buckets of the locations one after the other, see
+        s3.S3Manager.list_assets.
+
+        Replicas are not listed, nor is a bucket listed twice. The token
+        tells the location being listed along with its own token.
+        """
+        location, token = self._list_position(continuation_token)
+        states, token = self.managers[location].list_assets(page_size, token)
+        return self._listed_page(location, states, token)
+
+    def _listed_locations(self):
+        # the buckets of the replicas are copies of listed ones
+        seen = set(id(self.managers[name])
+                   for names in self.replicas.values() for name in names)
+        listed = []
+        # the default location last, it may be a named one as well
+        for name in sorted(self.managers, key=lambda name: (
+                name is None, name or '')):
+            if id(self.managers[name]) not in seen:
+                seen.add(id(self.managers[name]))
+                listed.append(name)
+        return listed
+
+    def _list_position(self, continuation_token):
+        """Return the location to list, and its continuation token."""
+        if not continuation_token:
+            return self._listed_locations()[0], None
+        location, separator, token = continuation_token.partition(
+            TOKEN_SEPARATOR)
+        location = location or None
+        if not separator or location not in self._listed_locations():
+            raise werkzeug_exc.BadRequest('cursor is invalid')
+        return location, token or None
+
+    def _listed_page(self, location, states, token):
+        for asset_state in states:
+            asset_state.asset_id = join(location, asset_state.asset_id)
+        if token is None:
+            listed = self._listed_locations()
+            index = listed.index(location) + 1
+            if index == len(listed):
+                return states, None
+            # the next location, from its start
+            location, token = listed[index], ''
+        return states, (location or '') + TOKEN_SEPARATOR + token
+
+    def create_multipart_upload(self, asset_id):
+        _, manager, asset_id = self._route(asset_id)
+        return manager.create_multipart_upload(asset_id)
+
+    def get_urls_for_part_upload(self, asset_id, upload_id, part_numbers,
+                                 timeout):
+        _, manager, asset_id = self._route(asset_id)
+        return manager.get_urls_for_part_upload(
+            asset_id, upload_id, part_numbers, timeout)
+
+    def list_parts(self, asset_id, upload_id):
+        _, manager, asset_id = self._route(asset_id)
+        return manager.list_parts(asset_id, upload_id)
+
+    def complete_multipart_upload(self, asset_id, upload_id, size=None):
+        _, manager, asset_id = self._route(asset_id)
+        return manager.complete_multipart_upload(asset_id, upload_id, size)
+
+    def abort_multipart_upload(self, asset_id, upload_id):
+        _, manager, asset_id = self._route(asset_id)
+        return manager.abort_multipart_upload(asset_id, upload_id)
+
+
+class AsyncRoutingManager(RoutingManager):
+    """Route the calls about an asset to the AsyncS3Manager of its location.
+
+    The calls handled by a single location return its coroutines as is.
+    """
+
+    async def get_urls_for_upload(self, asset_ids):
+        return [await self.get_url_for_upload(asset_id)
+                for asset_id in asset_ids]
+
+    async def get_url_for_download(self, asset_id, timeout, region=None):
+        location, manager, asset_id = self._route(asset_id)
+        reader = self._reader(location, manager, asset_id, region)
+        if reader is manager:
+            return await manager.get_url_for_download(asset_id, timeout)
+        if not await manager.get_upload_status(asset_id):
+            return
+        # NOTE(armax): presigning does not involve any I/O.
+        return reader.s3_manager.presign_download(asset_id, timeout)
+
+    async def get_urls_for_download(self, asset_ids, timeout, region=None):
+        semaphore = asyncio.Semaphore(
+            self.managers[None].s3_manager.batch_workers)
+
+        async def _get_url(asset_id):
+            async with semaphore:
+                try:
+                    url = await self.get_url_for_download(
+                        asset_id, timeout, region)
+                    return url, None
+                except werkzeug_exc.HTTPException as e:
+                    return None, e
+
+        return await asyncio.gather(*[_get_url(i) for i in asset_ids])
+
+    async def list_assets(self, page_size, continuation_token=None):
+        """See RoutingManager.list_assets."""
+        location, token = self._list_position(continuation_token)
+        states, token = await self.managers[location].list_assets(
+            page_size, token)
+        return self._listed_page(location, states, token)
@@ -10,68 +10,583 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import calendar
+from concurrent import futures
+import logging
 import os
-import uuid
+import threading
 
-import boto3
 from botocore import exceptions as boto_exc
-import flask
+from werkzeug import exceptions as werkzeug_exc
+from werkzeug import http
 
+from s3uploader import cache
+from s3uploader import calls
+from s3uploader import constants
 from s3uploader import exceptions
+from s3uploader import journal
+from s3uploader import keys
+from s3uploader import metrics
+from s3uploader import routing
+from s3uploader import sigv4
+from s3uploader import singleflight
+from s3uploader import state
 
 
-app = flask.Flask(__name__)
-LOG = app.logger
+LOG = logging.getLogger(__name__)
 
 
 class Config(object):
     # TODO(armax): make this more sophisticated if need be.
     # or replace in favor of Boto3 default ~/.aws/config
-    def __init__(self):
-        self.bucket = os.environ['AWS_BUCKET']
-        self.access_key_id = os.environ['AWS_ACCESS_KEY_ID']
-        self.access_key = os.environ['AWS_SECRET_ACCESS_KEY']
-        self.region = os.environ['AWS_REGION']
+    def __init__(self, environ=None):
+        environ = os.environ if environ is None else environ
+        self.bucket = environ['AWS_BUCKET']
+        self.access_key_id = environ['AWS_ACCESS_KEY_ID']
+        self.access_key = environ['AWS_SECRET_ACCESS_KEY']
+        self.region = environ['AWS_REGION']
+        self.endpoint_url = environ.get('S3UPLOADER_ENDPOINT_URL') or None
+        self.max_pool_connections = _get_int(
+            environ, 'S3UPLOADER_MAX_POOL_CONNECTIONS',
+            constants.MAX_POOL_CONNECTIONS)
+        self.connect_timeout = _get_int(
+            environ, 'S3UPLOADER_CONNECT_TIMEOUT', constants.CONNECT_TIMEOUT)
+        self.read_timeout = _get_int(
+            environ, 'S3UPLOADER_READ_TIMEOUT', constants.READ_TIMEOUT)
+        self.readiness_cache_size = _get_int(
+            environ, 'S3UPLOADER_READINESS_CACHE_SIZE',
+            constants.READINESS_CACHE_SIZE)
+        self.readiness_ttl = _get_int(
+            environ, 'S3UPLOADER_READINESS_TTL', constants.READINESS_TTL)
+        self.not_ready_ttl = _get_int(
+            environ, 'S3UPLOADER_NOT_READY_TTL', constants.NOT_READY_TTL)
+        self.readiness_cache_url = environ.get(
+            'S3UPLOADER_READINESS_CACHE_URL')
+        self.url_cache_size = _get_int(
+            environ, 'S3UPLOADER_URL_CACHE_SIZE', constants.URL_CACHE_SIZE)
+        self.url_cache_min_validity = _get_float(
+            environ, 'S3UPLOADER_URL_CACHE_MIN_VALIDITY',
+            constants.URL_CACHE_MIN_VALIDITY)
+        self.batch_workers = _get_int(
+            environ, 'S3UPLOADER_BATCH_WORKERS', constants.BATCH_WORKERS)
+        self.state_db = environ.get('S3UPLOADER_STATE_DB')
+        self.state_write_through = _get_bool(
+            environ, 'S3UPLOADER_STATE_WRITE_THROUGH', True)
+        self.proxy = _get_bool(environ, 'S3UPLOADER_PROXY', False)
+        self.proxy_chunk_size = _get_int(
+            environ, 'S3UPLOADER_PROXY_CHUNK_SIZE', constants.PROXY_CHUNK_SIZE)
+        if self.proxy_chunk_size <= 0:
+            raise ValueError('S3UPLOADER_PROXY_CHUNK_SIZE must be positive')
+        self.warm_up = _get_bool(environ, 'S3UPLOADER_WARM_UP', True)
+        self.journal = environ.get('S3UPLOADER_JOURNAL')
+        if self.journal and not (self.readiness_cache_url or self.state_db):
+            # NOTE(armax): until it is applied, a completion is only known
+            # of by the readiness cache, or the database: the other
+            # workers would keep answering not ready with their own cache.
+            raise ValueError('S3UPLOADER_JOURNAL requires either '
+                             'S3UPLOADER_READINESS_CACHE_URL or '
+                             'S3UPLOADER_STATE_DB')
+        self.journal_workers = _get_int(
+            environ, 'S3UPLOADER_JOURNAL_WORKERS', constants.JOURNAL_WORKERS)
+        self.presigner = environ.get('S3UPLOADER_PRESIGNER') or 'botocore'
+        if self.presigner not in ('botocore', 'native'):
+            raise ValueError('S3UPLOADER_PRESIGNER must be either botocore '
+                             'or native, got %r' % self.presigner)
+        self.multipart_part_size = _get_int(
+            environ, 'S3UPLOADER_MULTIPART_PART_SIZE',
+            constants.MULTIPART_PART_SIZE)
+        if not (constants.MULTIPART_MIN_PART_SIZE <=
+                self.multipart_part_size <=
+                constants.MULTIPART_MAX_PART_SIZE):
+            raise ValueError('S3UPLOADER_MULTIPART_PART_SIZE must be between '
+                             '%d and %d bytes' % (
+                                 constants.MULTIPART_MIN_PART_SIZE,
+                                 constants.MULTIPART_MAX_PART_SIZE))
+        self.multipart_url_timeout = _get_int(
+            environ, 'S3UPLOADER_MULTIPART_URL_TIMEOUT',
+            constants.MULTIPART_URL_TIMEOUT)
+        self.slow_request_threshold = _get_float(
+            environ, 'S3UPLOADER_SLOW_REQUEST_THRESHOLD',
+            constants.SLOW_REQUEST_THRESHOLD)
+        self.slow_request_sample_rate = _get_float(
+            environ, 'S3UPLOADER_SLOW_REQUEST_SAMPLE_RATE',
+            constants.SLOW_REQUEST_SAMPLE_RATE)
+        self.key_layout = environ.get('S3UPLOADER_KEY_LAYOUT') or 'flat'
+        if self.key_layout not in ('flat', 'sharded'):
+            raise ValueError('S3UPLOADER_KEY_LAYOUT must be either flat or '
+                             'sharded, got %r' % self.key_layout)
+        self.key_prefix_length = _get_int(
+            environ, 'S3UPLOADER_KEY_PREFIX_LENGTH',
+            constants.KEY_PREFIX_LENGTH)
+        if not (1 <= self.key_prefix_length <=
+                constants.MAX_KEY_PREFIX_LENGTH):
+            raise ValueError('S3UPLOADER_KEY_PREFIX_LENGTH must be between '
+                             '1 and %d' % constants.MAX_KEY_PREFIX_LENGTH)
+        self.read_deadline = _get_float(
+            environ, 'S3UPLOADER_READ_DEADLINE', constants.READ_DEADLINE)
+        self.read_retries = _get_int(
+            environ, 'S3UPLOADER_READ_RETRIES', constants.READ_RETRIES)
+        self.read_backoff = _get_float(
+            environ, 'S3UPLOADER_READ_BACKOFF', constants.READ_BACKOFF)
+        self.write_deadline = _get_float(
+            environ, 'S3UPLOADER_WRITE_DEADLINE', constants.WRITE_DEADLINE)
+        self.write_retries = _get_int(
+            environ, 'S3UPLOADER_WRITE_RETRIES', constants.WRITE_RETRIES)
+        self.write_backoff = _get_float(
+            environ, 'S3UPLOADER_WRITE_BACKOFF', constants.WRITE_BACKOFF)
+        self.deadlines = _get_deadlines(environ, 'S3UPLOADER_DEADLINES')
+        self.hedge_percentile = _get_float(
+            environ, 'S3UPLOADER_HEDGE_PERCENTILE',
+            constants.HEDGE_PERCENTILE)
+        if not 0 <= self.hedge_percentile < 100:
+            raise ValueError('S3UPLOADER_HEDGE_PERCENTILE must be within '
+                             '[0, 100)')
+        self.locations = _get_locations(environ, 'S3UPLOADER_LOCATIONS')
+        if self.locations and not any(
+                location.weight for location in self.locations):
+            raise ValueError('S3UPLOADER_LOCATIONS must have a location of '
+                             'positive weight')
+        self.replicas = _get_replicas(
+            environ, 'S3UPLOADER_REPLICAS',
+            [location.name for location in self.locations])
+        self.replication_lag = _get_int(
+            environ, 'S3UPLOADER_REPLICATION_LAG', constants.REPLICATION_LAG)
+        self.concurrency_limits = _get_limits(
+            environ, 'S3UPLOADER_CONCURRENCY_LIMITS')
+        self.queue_size = _get_int(
+            environ, 'S3UPLOADER_QUEUE_SIZE', constants.ADMISSION_QUEUE_SIZE)
+        self.queue_timeout = _get_float(
+            environ, 'S3UPLOADER_QUEUE_TIMEOUT',
+            constants.ADMISSION_QUEUE_TIMEOUT)
+        if self.queue_size < 0 or self.queue_timeout < 0:
+            raise ValueError('S3UPLOADER_QUEUE_SIZE and '
+                             'S3UPLOADER_QUEUE_TIMEOUT must not be negative')
+        self.retry_after = _get_int(
+            environ, 'S3UPLOADER_RETRY_AFTER', constants.ADMISSION_RETRY_AFTER)
+        self.adaptive_limits = _get_bool(
+            environ, 'S3UPLOADER_ADAPTIVE_LIMITS', False)
+        self.latency_target = _get_float(
+            environ, 'S3UPLOADER_LATENCY_TARGET',
+            constants.ADMISSION_LATENCY_TARGET)
+        if self.latency_target <= 0:
+            raise ValueError('S3UPLOADER_LATENCY_TARGET must be positive')
+
+
+def _get_locations(environ, name):
+    """Parse locations, e.g. eu=assets-eu@eu-west-1*2,us=assets-us@us-east-1
+
+    The weight follows the optional *, 1 by default.
+    """
+    locations = []
+    for item in environ.get(name, '').split(','):
+        if not item.strip():
+            continue
+        location, _, rest = item.strip().partition('=')
+        bucket, _, rest = rest.partition('@')
+        region, _, weight = rest.partition('*')
+        try:
+            weight = int(weight) if weight else 1
+        except ValueError:
+            weight = -1
+        if (not routing.NAME_PATTERN.match(location) or not bucket or
+                not region or weight < 0 or
+                location in [other.name for other in locations]):
+            raise ValueError('%s must be a comma-separated list of '
+                             'name=bucket@region[*weight], got %r' % (
+                                 name, environ[name]))
+        locations.append(routing.Location(location, bucket, region, weight))
+    return locations
+
+
+def _get_replicas(environ, name, locations):
+    """Parse the replicas of locations, e.g. eu=eu-us|eu-ap,us=us-eu"""
+    replicas = {}
+    for item in environ.get(name, '').split(','):
+        if not item.strip():
+            continue
+        location, _, names = item.strip().partition('=')
+        names = names.split('|')
+        if not set([location] + names).issubset(locations):
+            raise ValueError('%s must be a comma-separated list of '
+                             'location=replica[|replica...] of the locations '
+                             'of S3UPLOADER_LOCATIONS, got %r' % (
+                                 name, environ[name]))
+        replicas[location] = names
+    return replicas
+
+
+def _get_deadlines(environ, name):
+    """Parse per-operation deadlines, e.g. list_objects_v2=30,..."""
+    deadlines = {}
+    for item in environ.get(name, '').split(','):
+        if not item.strip():
+            continue
+        operation, _, value = item.partition('=')
+        try:
+            deadlines[operation.strip()] = float(value)
+        except ValueError:
+            raise ValueError('%s must be a comma-separated list of '
+                             'operation=seconds, got %r' % (
+                                 name, environ[name]))
+    return deadlines
+
+
+def _get_limits(environ, name):
+    """Parse per-endpoint concurrency limits, e.g. get_asset=64,..."""
+    limits = {}
+    for item in environ.get(name, '').split(','):
+        if not item.strip():
+            continue
+        endpoint, _, value = item.partition('=')
+        endpoint = endpoint.strip()
+        try:
+            limit = int(value)
+        except ValueError:
+            limit = 0
+        if endpoint not in constants.LIMITED_ENDPOINTS or limit <= 0:
+            raise ValueError('%s must be a comma-separated list of '
+                             'endpoint=limit of the endpoints %s, got %r' % (
+                                 name, ', '.join(constants.LIMITED_ENDPOINTS),
+                                 environ[name]))
+        limits[endpoint] = limit
+    return limits
+
+
+def _get_int(environ, name, default):
+    value = environ.get(name)
+    if value is None or value == '':
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError('%s must be an integer, got %r' % (name, value))
+
+
+def _get_bool(environ, name, default):
+    value = environ.get(name)
+    if value is None or value == '':
+        return default
+    if value.lower() in ('1', 'true', 'yes', 'on'):
+        return True
+    if value.lower() in ('0', 'false', 'no', 'off'):
+        return False
+    raise ValueError('%s must be a boolean, got %r' % (name, value))
+
+
+def _get_float(environ, name, default):
+    value = environ.get(name)
+    if value is None or value == '':
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        raise ValueError('%s must be a number, got %r' % (name, value))
 
 
 class Asset(object):
 
-    def __init__(self, url=None, asset_id=None):
+    def __init__(self, url=None, asset_id=None, error=None):
         self.url = url
         self.asset_id = asset_id
+        self.error = error
+
+
+class MultipartUpload(object):
+
+    def __init__(self, asset_id, upload_id, part_size=None, part_urls=None,
+                 parts=None):
+        self.asset_id = asset_id
+        self.upload_id = upload_id
+        self.part_size = part_size
+        # (part number, presigned URL) pairs
+        self.part_urls = part_urls or []
+        # the parts uploaded so far, as returned by S3Manager.list_parts
+        self.parts = parts or []
+
+
+class Download(object):
+    """The content of an asset (or a range of it), streamed from S3.
+
+    Iterating yields the body a chunk at a time, then closes it: a
+    download holds no more than chunk_size bytes in memory.
+
+    :param status: the HTTP status to answer with, 200, 206 (a range) or
+                   304 (not modified, no body).
+    :param headers: the HTTP headers to answer with, as (name, value).
+    """
+
+    def __init__(self, asset_id, status, headers, body=None,
+                 chunk_size=constants.PROXY_CHUNK_SIZE):
+        self.asset_id = asset_id
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.chunk_size = chunk_size
+
+    def __iter__(self):
+        if self.body is None:
+            return
+        try:
+            while True:
+                chunk = self.body.read(self.chunk_size)
+                if not chunk:
+                    break
+                metrics.PROXY_BYTES.inc(amount=len(chunk))
+                yield chunk
+        except Exception:
+            LOG.exception('Download of %s interrupted', self.asset_id)
+            raise
+        finally:
+            self.close()
+
+    def close(self):
+        if self.body is not None:
+            self.body.close()
+            self.body = None
+
+
+# get_object response field -> the HTTP header passed through to clients
+DOWNLOAD_HEADERS = [
+    ('ContentType', 'Content-Type'),
+    ('ContentLength', 'Content-Length'),
+    ('ContentRange', 'Content-Range'),
+    ('ETag', 'ETag'),
+    ('LastModified', 'Last-Modified'),
+]
+
+
+def download_headers(response):
+    """Return the HTTP headers of a get_object response."""
+    headers = [('Accept-Ranges', 'bytes')]
+    for field, name in DOWNLOAD_HEADERS:
+        value = response.get(field)
+        if value is None:
+            continue
+        if field == 'LastModified':
+            value = http.http_date(value)
+        headers.append((name, str(value)))
+    return headers
 
 
 class AssetManager(object):
 
-    def __init__(self, storage_manager=None):
+    def __init__(self, storage_manager=None, state_store=None,
+                 part_size=constants.MULTIPART_PART_SIZE,
+                 part_url_timeout=constants.MULTIPART_URL_TIMEOUT,
+                 key_layout=None, write_behind=None, proxy=False,
+                 proxy_chunk_size=constants.PROXY_CHUNK_SIZE):
         self.storage_manager = storage_manager or S3Manager()
+        self.state_store = state_store
+        self.write_behind = write_behind
+        self.proxy = proxy
+        self.proxy_chunk_size = proxy_chunk_size
+        self.part_size = part_size
+        self.part_url_timeout = part_url_timeout
+        self.key_layout = key_layout or keys.FlatLayout()
 
     def create_asset(self):
         asset_id = self._generate_uuid()
         url = self.storage_manager.get_url_for_upload(asset_id)
+        if self.state_store is not None:
+            self.state_store.create(asset_id)
         return Asset(url, asset_id)
 
-    def update_asset(self, asset_id):
-        self.storage_manager.update_upload_status(asset_id)
+    def create_assets(self, count):
+        asset_ids = [self._generate_uuid() for _ in range(count)]
+        urls = self.storage_manager.get_urls_for_upload(asset_ids)
+        if self.state_store is not None:
+            for asset_id in asset_ids:
+                self.state_store.create(asset_id)
+        return [Asset(url, asset_id) for url, asset_id in zip(urls, asset_ids)]
+
+    def update_asset(self, asset_id, size=None):
+        if self.state_store is not None:
+            self.state_store.mark_uploaded(asset_id, size)
+        elif self.write_behind is not None:
+            self.write_behind.append(asset_id)
+            self.storage_manager.remember_uploaded(asset_id)
+        else:
+            self.storage_manager.update_upload_status(asset_id)
+
+    def get_asset(self, asset_id, timeout, region=None):
+        """Return the asset, with its download URL if it is ready.
 
-    def get_asset(self, asset_id, timeout):
-        url = self.storage_manager.get_url_for_download(asset_id, timeout)
+        :param region: the caller's region, to download from a replica in
+                       that region if there is one.
+        """
+        if self.state_store is not None:
+            state = self.state_store.get(asset_id)
+            if state is None:
+                raise exceptions.AssetNotFoundError()
+            url = None
+            if state.uploaded:
+                try:
+                    url = self.storage_manager.presign_download(
+                        asset_id, timeout, region=region)
+                except boto_exc.BotoCoreError as e:
+                    LOG.error(e)
+                    raise exceptions.AssetError()
+            return Asset(url, asset_id)
+        url = self.storage_manager.get_url_for_download(
+            asset_id, timeout, region=region)
         return Asset(url, asset_id)
 
+    def open_download(self, asset_id, byte_range=None, if_none_match=None):
+        """Return the Download of an asset if it is ready, None otherwise.
+
+        :param byte_range: the HTTP Range to download, if any.
+        :param if_none_match: the HTTP If-None-Match condition, if any.
+        :raises NotFound: if the download proxy is disabled.
+        """
+        if not self.proxy:
+            raise werkzeug_exc.NotFound()
+        if self.state_store is not None:
+            state = self.state_store.get(asset_id)
+            if state is None:
+                raise exceptions.AssetNotFoundError()
+            uploaded = state.uploaded
+        else:
+            uploaded = self.storage_manager.get_upload_status(asset_id)
+        if not uploaded:
+            return
+        return self.storage_manager.open_download(
+            asset_id, byte_range, if_none_match, self.proxy_chunk_size)
+
+    def get_assets(self, asset_ids, timeout, region=None):
+        if self.state_store is not None:
+            def _get_asset(asset_id):
+                try:
+                    return self.get_asset(asset_id, timeout, region)
+                except werkzeug_exc.HTTPException as e:
+                    return Asset(None, asset_id, e)
+
+            return list(self.storage_manager.executor.map(
+                _get_asset, asset_ids))
+        results = self.storage_manager.get_urls_for_download(
+            asset_ids, timeout, region=region)
+        return [Asset(url, asset_id, error)
+                for (url, error), asset_id in zip(results, asset_ids)]
+
+    def list_assets(self, limit, cursor=None, status=None,
+                    created_after=None, created_before=None):
+        """Return a page of up to limit AssetStates, and the cursor of the
+        next page, None after the last one.
+
+        Pages are read from the state database by creation time if there
+        is one. Otherwise a page of the bucket is listed in key order,
+        which is random with the flat layout, and in creation order only
+        within each prefix with the sharded one. The status of the listed
+        assets is what the readiness cache knows of them (None if
+        nothing), and the filters may leave a page with fewer assets than
+        limit.
+
+        :param cursor: the cursor returned along with the previous page.
+        :raises BadRequest: if the cursor is not one of this listing.
+        """
+        cursor = cursor or {}
+        if self.state_store is not None:
+            return self._list_stored_assets(limit, cursor, status,
+                                            created_after, created_before)
+        if cursor and 'token' not in cursor:
+            raise werkzeug_exc.BadRequest('cursor is invalid')
+        states, token = self.storage_manager.list_assets(
+            limit, cursor.get('token'))
+        return [asset_state for asset_state in states if state_matches(
+            asset_state, status, created_after, created_before)], (
+            {'token': token} if token else None)
+
+    def _list_stored_assets(self, limit, cursor, status, created_after,
+                            created_before):
+        if cursor and 'after' not in cursor:
+            raise werkzeug_exc.BadRequest('cursor is invalid')
+        after = cursor.get('after')
+        states = self.state_store.list(
+            limit + 1, tuple(after) if after else None, status,
+            created_after, created_before)
+        if len(states) <= limit:
+            return states, None
+        states = states[:limit]
+        return states, {'after': [states[-1].created_at,
+                                  states[-1].asset_id]}
+
+    def create_multipart_asset(self, size, part_size=None):
+        """Start the multipart upload of an asset of size bytes.
+
+        The part size is raised if need be to fit the upload in the maximum
+        number of parts S3 allows.
+        """
+        part_size, part_numbers = self._plan_parts(size, part_size)
+        asset_id = self._generate_uuid()
+        upload_id = self.storage_manager.create_multipart_upload(asset_id)
+        if self.state_store is not None:
+            self.state_store.create(asset_id)
+        urls = self.storage_manager.get_urls_for_part_upload(
+            asset_id, upload_id, part_numbers, self.part_url_timeout)
+        return MultipartUpload(asset_id, upload_id, part_size,
+                               list(zip(part_numbers, urls)))
+
+    def get_multipart_upload(self, asset_id, upload_id, part_numbers=()):
+        """Return the parts uploaded so far, e.g. to resume an upload.
+
+        Fresh upload URLs are returned for the given part numbers.
+        """
+        parts = self.storage_manager.list_parts(asset_id, upload_id)
+        urls = []
+        if part_numbers:
+            urls = self.storage_manager.get_urls_for_part_upload(
+                asset_id, upload_id, part_numbers, self.part_url_timeout)
+        return MultipartUpload(asset_id, upload_id,
+                               part_urls=list(zip(part_numbers, urls)),
+                               parts=parts)
+
+    def complete_multipart_asset(self, asset_id, upload_id, size=None):
+        """Assemble the parts of an asset, and mark it uploaded."""
+        size = self.storage_manager.complete_multipart_upload(
+            asset_id, upload_id, size)
+        self.update_asset(asset_id, size)
+
+    def abort_multipart_asset(self, asset_id, upload_id):
+        self.storage_manager.abort_multipart_upload(asset_id, upload_id)
+
+    def _plan_parts(self, size, part_size=None):
+        part_size = max(part_size or self.part_size,
+                        -(-size // constants.MULTIPART_MAX_PARTS))
+        return part_size, range(1, max(-(-size // part_size), 1) + 1)
+
     def _generate_uuid(self):
-        return str(uuid.uuid4())
+        return self.key_layout.new_id()
 
 
 class S3Manager(object):
 
-    def __init__(self, config=None, client=None):
+    def __init__(self, config=None, client=None, readiness_cache=None,
+                 url_cache=None, batch_workers=constants.BATCH_WORKERS,
+                 presigner=None, caller=None, key_layout=None):
         self.config = config or Config()
-        self.client = client or boto3.client(
-            's3',
-            aws_access_key_id=self.config.access_key_id,
-            aws_secret_access_key=self.config.access_key,
-            region_name=self.config.region)
+        self.client = client or create_client(self.config)
+        self.caller = caller or calls.Caller(self.client)
+        self.key_layout = key_layout or keys.FlatLayout()
+        self.readiness_cache = readiness_cache
+        self.url_cache = url_cache
+        self.presigner = presigner
+        self.batch_workers = batch_workers
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        # NOTE(armax): a popular asset gets looked up by many clients at
+        # once, only one S3 request is made for all of them.
+        self._lookups = singleflight.Group('get_object_tagging')
 
+    @property
+    def executor(self):
+        """Bounded thread pool to run S3 requests concurrently."""
+        if self._executor is None:
+            with self._executor_lock:
+                if self._executor is None:
+                    self._executor = futures.ThreadPoolExecutor(
+                        max_workers=self.batch_workers)
+        return self._executor
+
+    @metrics.timed('get_url_for_upload')
     def get_url_for_upload(self, asset_id):
         """Return data to allow clients to upload an S3 object."""
         # NOTE(armax): presigned POSTs are more convoluted than presigned
@@ -86,74 +601,713 @@ class S3Manager(object):
         #     post["url"], data=post["fields"], files=myfiles)
         #
         try:
+            if self.presigner is not None:
+                return self.presigner.presign_post(
+                    self.key_layout.key(asset_id))
             return self.client.generate_presigned_post(
                 Bucket=self.config.bucket,
-                Key=asset_id)
+                Key=self.key_layout.key(asset_id))
         except boto_exc.BotoCoreError:
             # FIXME(armax): narrow down the catch
             raise exceptions.AssetError()
 
+    @metrics.timed('get_urls_for_upload')
+    def get_urls_for_upload(self, asset_ids):
+        """Return data to allow clients to upload several S3 objects."""
+        # NOTE(armax): presigning does not hit S3, there's nothing to gain
+        # from running these concurrently.
+        return [self.get_url_for_upload(asset_id) for asset_id in asset_ids]
+
+    @metrics.timed('update_upload_status')
     def update_upload_status(self, asset_id):
         """Mark the S3 object's upload completed."""
         try:
-            self.client.put_object_tagging(
+            self.caller(
+                'put_object_tagging',
                 Bucket=self.config.bucket,
-                Key=asset_id,
-                Tagging={
-                    'TagSet': [
-                        {'Key': 'Status', 'Value': 'Uploaded'}
-                    ]
-                })
+                Key=self.key_layout.key(asset_id),
+                Tagging=UPLOADED_TAGGING)
+            self.remember_uploaded(asset_id)
         except boto_exc.ClientError as e:
             LOG.error(e)
-            if 'Error' in e.response:
-                raise ERROR_MAP.get(e.response['Error']['Code'],
-                                    exceptions.AssetError())
-                raise exceptions.AssetNotFoundError()
-            raise exceptions.AssetError()
+            # NOTE(armax): a journaled completion is remembered before it
+            # is applied, and retried after transient errors: only forget
+            # it once it is known to fail for good.
+            if self.readiness_cache is not None and (
+                    not calls.is_retryable(e)):
+                self.readiness_cache.invalidate(asset_id)
+            raise asset_error(e)
         except boto_exc.BotoCoreError as e:
             LOG.error(e)
             raise exceptions.AssetError()
 
-    def get_url_for_download(self, asset_id, timeout):
-        """Return URL for download if the asset is ready, None otherwise."""
+    def remember_uploaded(self, asset_id):
+        """Tell the readers that the upload of an asset was completed,
+        ahead of its S3 object being tagged so, if need be.
+        """
+        self._lookups.forget(asset_id)
+        if self.readiness_cache is not None:
+            self.readiness_cache.set(asset_id, True)
+
+    @metrics.timed('get_url_for_download')
+    def get_url_for_download(self, asset_id, timeout, region=None):
+        """Return URL for download if the asset is ready, None otherwise.
+
+        The caller's region is of no use to a single bucket, see
+        routing.RoutingManager.
+        """
         try:
             # check if this is marked uploaded
-            tags = self.client.get_object_tagging(
-                Bucket=self.config.bucket,
-                Key=asset_id)
-            uploaded = False
-            if tags:
-                for tag in tags['TagSet']:
-                    key = tag.get('Key')
-                    value = tag.get('Value')
-                    if key == 'Status' and value == 'Uploaded':
-                        uploaded = True
-                        break
-            if not uploaded:
+            if not self._is_uploaded(asset_id):
                 return
 
             # if so, then return URL for download
-            return self.client.generate_presigned_url(
-                ClientMethod='get_object',
+            return self.presign_download(asset_id, timeout)
+        except boto_exc.ClientError as e:
+            LOG.error(e)
+            raise asset_error(e)
+        except boto_exc.BotoCoreError as e:
+            LOG.error(e)
+            raise exceptions.AssetError()
+
+    @metrics.timed('get_urls_for_download')
+    def get_urls_for_download(self, asset_ids, timeout, region=None):
+        """Return a (url, error) tuple for each of the given assets.
+
+        The url is None if the asset is not ready for download, and error
+        is the AssetError-like exception raised while looking it up.
+        """
+        def _get_url(asset_id):
+            try:
+                return self.get_url_for_download(asset_id, timeout), None
+            except werkzeug_exc.HTTPException as e:
+                return None, e
+
+        return list(self.executor.map(_get_url, asset_ids))
+
+    @metrics.timed('get_upload_status')
+    def get_upload_status(self, asset_id):
+        """Return whether the S3 object's upload was completed."""
+        try:
+            return self._is_uploaded(asset_id)
+        except boto_exc.ClientError as e:
+            LOG.error(e)
+            raise asset_error(e)
+        except boto_exc.BotoCoreError as e:
+            LOG.error(e)
+            raise exceptions.AssetError()
+
+    @metrics.timed('open_download')
+    def open_download(self, asset_id, byte_range=None, if_none_match=None,
+                      chunk_size=constants.PROXY_CHUNK_SIZE):
+        """Start streaming the S3 object, see AssetManager.open_download.
+
+        The readiness of the asset is up to the caller.
+        """
+        kwargs = get_object_conditions(byte_range, if_none_match)
+        try:
+            response = self.caller(
+                'get_object',
+                Bucket=self.config.bucket,
+                Key=self.key_layout.key(asset_id),
+                **kwargs)
+        except boto_exc.ClientError as e:
+            if is_not_modified(e):
+                return Download(asset_id, 304, not_modified_headers(e))
+            LOG.error(e)
+            raise asset_error(e)
+        except boto_exc.BotoCoreError as e:
+            LOG.error(e)
+            raise exceptions.AssetError()
+        return Download(asset_id, 206 if response.get('ContentRange') else 200,
+                        download_headers(response), response['Body'],
+                        chunk_size)
+
+    @metrics.timed('list_objects')
+    def list_objects(self, page_size=1000, continuation_token=None,
+                     start_after=None, prefix=None, delimiter=None):
+        """Return a page of the bucket's objects, and the next page token.
+
+        The token is None once the last page was returned. Objects are
+        listed by key, see keys.KeyLayout.asset_id.
+        """
+        kwargs = {'Bucket': self.config.bucket, 'MaxKeys': page_size}
+        if continuation_token:
+            kwargs['ContinuationToken'] = continuation_token
+        if start_after:
+            kwargs['StartAfter'] = start_after
+        if prefix:
+            kwargs['Prefix'] = prefix
+        if delimiter:
+            kwargs['Delimiter'] = delimiter
+        try:
+            response = self.caller('list_objects_v2', **kwargs)
+        except boto_exc.ClientError as e:
+            LOG.error(e)
+            raise asset_error(e)
+        except boto_exc.BotoCoreError as e:
+            LOG.error(e)
+            raise exceptions.AssetError()
+        next_token = None
+        if response.get('IsTruncated'):
+            next_token = response.get('NextContinuationToken')
+        return response.get('Contents', []), next_token
+
+    @metrics.timed('list_assets')
+    def list_assets(self, page_size, continuation_token=None):
+        """Return the AssetStates of a page of the bucket's objects, and
+        the next page token, see list_objects.
+
+        Only what the readiness cache knows of the status of the assets is
+        reported: telling would cost an S3 request per asset.
+        """
+        objects, token = self.list_objects(page_size, continuation_token)
+        return listed_states(objects, self.key_layout,
+                             self.readiness_cache), token
+
+    @metrics.timed('create_multipart_upload')
+    def create_multipart_upload(self, asset_id):
+        """Start a multipart upload of the S3 object, return its ID."""
+        try:
+            response = self.caller(
+                'create_multipart_upload',
+                Bucket=self.config.bucket,
+                Key=self.key_layout.key(asset_id))
+        except boto_exc.ClientError as e:
+            LOG.error(e)
+            raise asset_error(e)
+        except boto_exc.BotoCoreError as e:
+            LOG.error(e)
+            raise exceptions.AssetError()
+        return response['UploadId']
+
+    @metrics.timed('get_urls_for_part_upload')
+    def get_urls_for_part_upload(self, asset_id, upload_id, part_numbers,
+                                 timeout):
+        """Return URLs for clients to PUT parts of a multipart upload."""
+        key = self.key_layout.key(asset_id)
+        try:
+            if self.presigner is not None:
+                return [self.presigner.presign_upload_part(
+                    key, upload_id, part_number, timeout)
+                    for part_number in part_numbers]
+            return [self.client.generate_presigned_url(
+                ClientMethod='upload_part',
                 Params={
                     'Bucket': self.config.bucket,
-                    'Key': asset_id
+                    'Key': key,
+                    'UploadId': upload_id,
+                    'PartNumber': part_number
                 },
                 ExpiresIn=timeout,
-                HttpMethod='GET')
+                HttpMethod='PUT') for part_number in part_numbers]
+        except boto_exc.BotoCoreError:
+            raise exceptions.AssetError()
+
+    @metrics.timed('list_parts')
+    def list_parts(self, asset_id, upload_id):
+        """Return the parts uploaded so far, by ascending part number."""
+        kwargs = {'Bucket': self.config.bucket,
+                  'Key': self.key_layout.key(asset_id),
+                  'UploadId': upload_id}
+        parts = []
+        try:
+            while True:
+                response = self.caller('list_parts', **kwargs)
+                parts.extend(response.get('Parts', []))
+                if not response.get('IsTruncated'):
+                    return parts
+                kwargs['PartNumberMarker'] = response['NextPartNumberMarker']
         except boto_exc.ClientError as e:
             LOG.error(e)
-            if 'Error' in e.response:
-                raise ERROR_MAP.get(e.response['Error']['Code'],
-                                    exceptions.AssetError())
+            raise asset_error(e)
+        except boto_exc.BotoCoreError as e:
+            LOG.error(e)
             raise exceptions.AssetError()
+
+    @metrics.timed('complete_multipart_upload')
+    def complete_multipart_upload(self, asset_id, upload_id, size=None):
+        """Assemble the uploaded parts, return the size of the S3 object.
+
+        :raises AssetUploadIncompleteError: if a part is missing, or the
+                                            parts do not add up to size.
+        """
+        parts = self.list_parts(asset_id, upload_id)
+        total = check_parts(parts, size)
+        try:
+            self.caller(
+                'complete_multipart_upload',
+                Bucket=self.config.bucket,
+                Key=self.key_layout.key(asset_id),
+                UploadId=upload_id,
+                MultipartUpload=completed_parts(parts))
+        except boto_exc.ClientError as e:
+            LOG.error(e)
+            raise asset_error(e)
         except boto_exc.BotoCoreError as e:
             LOG.error(e)
             raise exceptions.AssetError()
+        return total
+
+    @metrics.timed('abort_multipart_upload')
+    def abort_multipart_upload(self, asset_id, upload_id):
+        """Drop a multipart upload along with its uploaded parts."""
+        try:
+            self.caller(
+                'abort_multipart_upload',
+                Bucket=self.config.bucket,
+                Key=self.key_layout.key(asset_id),
+                UploadId=upload_id)
+        except boto_exc.ClientError as e:
+            LOG.error(e)
+            raise asset_error(e)
+        except boto_exc.BotoCoreError as e:
+            LOG.error(e)
+            raise exceptions.AssetError()
+
+    @metrics.timed('presign_download')
+    def presign_download(self, asset_id, timeout, region=None):
+        """Return URL for download, regardless of the asset's status."""
+        if self.url_cache is not None:
+            entry = self.url_cache.get(asset_id, timeout)
+            if entry is not None:
+                return entry[0]
+        if self.presigner is not None:
+            url = self.presigner.presign_get(
+                self.key_layout.key(asset_id), timeout)
+        else:
+            url = self.client.generate_presigned_url(
+                ClientMethod='get_object',
+                Params={
+                    'Bucket': self.config.bucket,
+                    'Key': self.key_layout.key(asset_id)
+                },
+                ExpiresIn=timeout,
+                HttpMethod='GET')
+        if self.url_cache is not None:
+            self.url_cache.set(asset_id, timeout, url)
+        return url
+
+    @metrics.timed('is_uploaded')
+    def _is_uploaded(self, asset_id):
+        if self.readiness_cache is not None:
+            uploaded = self.readiness_cache.get(asset_id)
+            if uploaded is not None:
+                return uploaded
+        return self._lookups.do(asset_id, self._fetch_upload_status,
+                                asset_id)
+
+    def _fetch_upload_status(self, asset_id):
+        tags = self.caller(
+            'get_object_tagging',
+            Bucket=self.config.bucket,
+            Key=self.key_layout.key(asset_id))
+        uploaded = is_marked_uploaded(tags)
+        if self.readiness_cache is not None:
+            self.readiness_cache.observe(asset_id, uploaded)
+        return uploaded
+
+
+UPLOADED_TAGGING = {
+    'TagSet': [
+        {'Key': 'Status', 'Value': 'Uploaded'}
+    ]
+}
+
+
+def is_marked_uploaded(tags):
+    """Return whether a get_object_tagging response marks an upload."""
+    if tags:
+        for tag in tags['TagSet']:
+            key = tag.get('Key')
+            value = tag.get('Value')
+            if key == 'Status' and value == 'Uploaded':
+                return True
+    return False
+
+
+def object_timestamp(value):
+    """Return the LastModified datetime of an S3 object as a timestamp."""
+    if value is None:
+        return
+    return float(calendar.timegm(value.utctimetuple()))
+
+
+def object_created_at(asset_id, obj):
+    """Return when the asset of a listed S3 object was created.
+
+    Assets with time-ordered IDs were created when their ID was handed
+    out, the others when their object was last modified.
+    """
+    created_at = keys.uuid7_timestamp(asset_id)
+    if created_at is None:
+        created_at = object_timestamp(obj.get('LastModified'))
+    return created_at
+
+
+def listed_states(objects, key_layout, readiness_cache=None):
+    """Return the AssetStates of a page of list_objects, as far as the
+    readiness cache knows, see S3Manager.list_assets.
+    """
+    states = []
+    for obj in objects:
+        asset_id = key_layout.asset_id(obj['Key'])
+        if asset_id is None:
+            # not an asset of ours
+            continue
+        uploaded = None
+        if readiness_cache is not None:
+            uploaded = readiness_cache.get(asset_id)
+        states.append(state.AssetState(
+            asset_id,
+            None if uploaded is None else (
+                state.UPLOADED if uploaded else state.CREATED),
+            size=obj.get('Size'),
+            created_at=object_created_at(asset_id, obj)))
+    return states
+
+
+def state_matches(asset_state, status=None, created_after=None,
+                  created_before=None):
+    """Return whether an AssetState passes the filters of a listing."""
+    if status is not None and asset_state.status != status:
+        return False
+    created_at = asset_state.created_at
+    if created_after is not None and (
+            created_at is None or created_at < created_after):
+        return False
+    if created_before is not None and (
+            created_at is None or created_at >= created_before):
+        return False
+    return True
+
+
+def get_object_conditions(byte_range=None, if_none_match=None):
+    """Return the get_object arguments passing the HTTP conditions on."""
+    kwargs = {}
+    if byte_range:
+        kwargs['Range'] = byte_range
+    if if_none_match:
+        kwargs['IfNoneMatch'] = if_none_match
+    return kwargs
+
+
+def is_not_modified(e):
+    """Return whether a get_object ClientError means not modified."""
+    return e.response.get('ResponseMetadata', {}).get(
+        'HTTPStatusCode') == 304 or e.response.get(
+            'Error', {}).get('Code') == '304'
+
+
+def not_modified_headers(e):
+    headers = e.response.get('ResponseMetadata', {}).get('HTTPHeaders', {})
+    if 'etag' in headers:
+        return [('ETag', headers['etag'])]
+    return []
+
+
+def check_parts(parts, size=None):
+    """Return the size of a multipart upload's parts, if it is complete.
+
+    :raises AssetUploadIncompleteError: if a part is missing, or the parts
+                                        do not add up to size.
+    """
+    # NOTE(armax): S3 would happily assemble whatever parts it has got,
+    # make sure there is no gap left by a failed part upload.
+    total = sum(part['Size'] for part in parts)
+    if (not parts or
+            [part['PartNumber'] for part in parts] !=
+            list(range(1, len(parts) + 1)) or
+            size is not None and size != total):
+        raise exceptions.AssetUploadIncompleteError()
+    return total
+
+
+def completed_parts(parts):
+    """Return the MultipartUpload argument of complete_multipart_upload."""
+    return {'Parts': [{'PartNumber': part['PartNumber'],
+                       'ETag': part['ETag']} for part in parts]}
+
+
+def asset_error(e):
+    """Return the AssetError-like exception matching a ClientError."""
+    if 'Error' in e.response:
+        code = e.response['Error'].get('Code')
+        metrics.S3_ERRORS.inc(code or 'unknown')
+        return ERROR_MAP.get(code, exceptions.AssetError)()
+    metrics.S3_ERRORS.inc('unknown')
+    return exceptions.AssetError()
+
+
+def create_client(config, timeout=None):
+    """Build an S3 client with the connection settings from config.
+
+    :param timeout: the seconds the connect and read timeouts of config
+                    are capped at, if any.
+    """
+    # NOTE(armax): boto3 takes longer to import than the rest of the app,
+    # and is only needed once a client is built: short-lived processes
+    # (e.g. serverless functions) get to start serving sooner.
+    import boto3
+    from botocore import config as boto_config
+
+    # NOTE(armax): sessions are not thread-safe, clients are: build each
+    # client from a private session so that concurrent callers (or a
+    # freshly forked worker) never share a half-initialized default one.
+    session = boto3.session.Session(
+        aws_access_key_id=config.access_key_id,
+        aws_secret_access_key=config.access_key,
+        region_name=config.region)
+    return session.client(
+        's3',
+        endpoint_url=config.endpoint_url,
+        config=boto_config.Config(
+            max_pool_connections=config.max_pool_connections,
+            connect_timeout=min(config.connect_timeout,
+                                timeout or config.connect_timeout),
+            read_timeout=min(config.read_timeout,
+                             timeout or config.read_timeout),
+            # NOTE(armax): retries are up to the caller, see build_caller.
+            retries={'max_attempts': 0},
+            # NOTE(armax): the native presigner only speaks SigV4, make
+            # sure both sign alike.
+            signature_version=(
+                's3v4' if config.presigner == 'native' else None)))
+
+
+def create_read_client(config):
+    """Build the S3 client of the reads, None if they have no deadline.
+
+    Its timeouts are capped at the longest deadline of the reads: the
+    attempts that outlive their deadline are abandoned by the caller, and
+    must not hold its workers for much longer, see calls.Caller.
+    """
+    deadlines = [config.deadlines.get(operation, config.read_deadline)
+                 for operation in calls.READS]
+    if all(deadlines):
+        return create_client(config, timeout=max(deadlines))
+
+
+def build_caller(config, client, caller_class=calls.Caller,
+                 read_client=None):
+    """Return the caller of the S3 client, with the policies of config.
+
+    :param read_client: the client of the reads, see create_read_client.
+    """
+    kwargs = {}
+    if read_client is not None:
+        kwargs['read_client'] = read_client
+    return caller_class(
+        client,
+        read_policy=calls.CallPolicy(
+            config.read_deadline, config.read_retries, config.read_backoff,
+            hedge=config.hedge_percentile > 0),
+        write_policy=calls.CallPolicy(
+            config.write_deadline, config.write_retries,
+            config.write_backoff),
+        deadlines=config.deadlines,
+        tracker=calls.LatencyTracker(config.hedge_percentile or 100),
+        **kwargs)
+
+
+def build_key_layout(config):
+    """Return the key layout described by config."""
+    if config.key_layout == 'sharded':
+        return keys.ShardedLayout(config.key_prefix_length)
+    return keys.FlatLayout()
+
+
+def build_presigner(config, client):
+    """Return the native presigner if config asks for it."""
+    if config.presigner == 'native':
+        return sigv4.SigV4Presigner.from_client(
+            client, config.bucket, config.access_key_id, config.access_key)
+
+
+def build_readiness_cache(config):
+    """Return the readiness cache described by config, if enabled."""
+    if config.readiness_cache_url:
+        backend = cache.RedisBackend.from_url(config.readiness_cache_url)
+    elif config.readiness_cache_size > 0:
+        backend = cache.LRUCache(config.readiness_cache_size,
+                                 name=cache.ReadinessCache.name)
+    else:
+        return
+    return cache.ReadinessCache(
+        backend, config.readiness_ttl, config.not_ready_ttl)
+
+
+def build_url_cache(config):
+    """Return the presigned URL cache described by config, if enabled."""
+    if config.url_cache_size > 0:
+        return cache.PresignedURLCache(
+            cache.LRUCache(config.url_cache_size,
+                           name=cache.PresignedURLCache.name),
+            config.url_cache_min_validity)
+
+
+def build_write_behind(config, storage_manager):
+    """Return the started write-behind of the upload completions, if
+    config has a journal.
+    """
+    if not config.journal:
+        return
+    write_behind = journal.WriteBehind(
+        journal.Journal(config.journal),
+        storage_manager.update_upload_status,
+        workers=config.journal_workers)
+    write_behind.start()
+    return write_behind
+
+
+def build_state_store(config, storage_manager, write_behind=None):
+    """Return the asset state store described by config, if any.
+
+    Without a local database, the S3 object tags are the only record of
+    the assets' state, and the storage manager deals with them directly.
+    """
+    if not config.state_db:
+        return
+    local = state.SQLiteStateStore(config.state_db)
+    if not config.state_write_through:
+        return local
+    return state.WriteThroughStateStore(
+        local, state.TaggingStateStore(storage_manager, write_behind))
+
+
+def build_storage_manager(config, key_layout):
+    """Return the S3Manager of the bucket of config, or the manager
+    routing the assets to the locations of config if there are any.
+    """
+    # NOTE(armax): the IDs are unique across locations, the readiness
+    # cache can be shared; URLs are not, each location has its own cache.
+    readiness_cache = build_readiness_cache(config)
+
+    def _build(location_config):
+        client = create_client(location_config)
+        return S3Manager(
+            config=location_config,
+            client=client,
+            readiness_cache=readiness_cache,
+            url_cache=build_url_cache(config),
+            batch_workers=config.batch_workers,
+            presigner=build_presigner(location_config, client),
+            caller=build_caller(
+                location_config, client,
+                read_client=create_read_client(location_config)),
+            key_layout=key_layout)
+
+    if not config.locations:
+        return _build(config)
+    managers = {}
+    replicas = dict(config.replicas)
+    for location in config.locations:
+        managers[location.name] = _build(location.apply(config))
+        if (location.bucket, location.region) == (config.bucket,
+                                                  config.region):
+            managers[None] = managers[location.name]
+            replicas[None] = replicas.get(location.name, [])
+    if None not in managers:
+        managers[None] = _build(config)
+    return routing.RoutingManager(managers, replicas, config.replication_lag)
+
+
+def build_asset_manager(config):
+    """Wire up an AssetManager and its dependencies from config."""
+    metrics.configure_slow_log(config.slow_request_threshold,
+                               config.slow_request_sample_rate)
+    key_layout = build_key_layout(config)
+    storage_manager = build_storage_manager(config, key_layout)
+    write_behind = None
+    if not config.state_db or config.state_write_through:
+        write_behind = build_write_behind(config, storage_manager)
+    if config.locations:
+        key_layout = routing.RoutedLayout(key_layout, routing.Placement(
+            dict((location.name, location.weight)
+                 for location in config.locations)))
+    return AssetManager(storage_manager=storage_manager,
+                        state_store=build_state_store(config, storage_manager,
+                                                      write_behind),
+                        part_size=config.multipart_part_size,
+                        part_url_timeout=config.multipart_url_timeout,
+                        key_layout=key_layout,
+                        write_behind=write_behind,
+                        proxy=config.proxy,
+                        proxy_chunk_size=config.proxy_chunk_size)
+
+
+_config = None
+_manager_lock = threading.Lock()
+_manager = None
+_manager_pid = None
+
+
+def get_config():
+    """Return the process-wide Config, read from the environment once.
+
+    Call it at boot, so that a bad environment fails fast instead of on
+    the first request.
+
+    :raises ValueError: if a setting is missing or invalid.
+    """
+    global _config
+    if _config is None:
+        try:
+            _config = Config()
+        except KeyError as e:
+            raise ValueError('%s must be set' % e.args[0])
+    return _config
+
+
+def get_asset_manager():
+    """Return the process-wide AssetManager, building it on first use.
+
+    Building an S3 client loads the service model and opens a connection
+    pool, which is by far the most expensive part of serving a request:
+    the manager (and its client) is therefore shared by all the requests
+    served by a process, and rebuilt if the process has forked since.
+    """
+    global _manager, _manager_pid
+    pid = os.getpid()
+    if _manager is None or _manager_pid != pid:
+        with _manager_lock:
+            if _manager is None or _manager_pid != pid:
+                _manager = build_asset_manager(get_config())
+                _manager_pid = pid
+    return _manager
+
+
+def warm_up():
+    """Build the process-wide AssetManager ahead of the first request.
+
+    This imports boto3, loads the S3 service model and builds the clients,
+    which the first request would wait on otherwise. Runtimes that freeze
+    or bill the boot time apart (e.g. serverless functions) may call it
+    from their initialization hook.
+    """
+    return get_asset_manager()
+
+
+def reset_asset_manager():
+    """Drop the process-wide AssetManager, e.g. after a fork."""
+    global _manager, _manager_lock, _manager_pid
+    # NOTE(armax): the lock may have been held by another thread at fork
+    # time, in which case it would never be released in the child.
+    _manager_lock = threading.Lock()
+    _manager = None
+    _manager_pid = None
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reset_asset_manager)
 
 
 ERROR_MAP = {
     'NoSuchKey': exceptions.AssetNotFoundError,
-    'AccessDenied': exceptions.AssetAccessDeniedError
+    'NoSuchUpload': exceptions.AssetNotFoundError,
+    'AccessDenied': exceptions.AssetAccessDeniedError,
+    'InvalidPart': exceptions.AssetUploadIncompleteError,
+    'InvalidPartOrder': exceptions.AssetUploadIncompleteError,
+    'EntityTooSmall': exceptions.AssetUploadIncompleteError,
+    'InvalidRange': exceptions.AssetRangeNotSatisfiableError,
 }
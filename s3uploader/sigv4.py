@@ -0,0 +1,201 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""A dedicated S3 SigV4 presigner.
+
+botocore builds, serializes and resolves a whole request before it gets to
+sign a presigned URL or POST policy, which costs far more than the HMAC
+work itself. The only things that change from one presigned GET/POST to
+the next for a given bucket are the object key and the time, so all the
+rest is computed once, and the derived signing key is cached per day.
+
+The output is byte-identical to the one of a botocore client configured
+with signature_version='s3v4'.
+"""
+
+import base64
+import datetime
+import hashlib
+import hmac
+import json
+import threading
+from urllib import parse
+
+
+ALGORITHM = 'AWS4-HMAC-SHA256'
+ISO8601 = '%Y-%m-%dT%H:%M:%SZ'
+SIGV4_TIMESTAMP = '%Y%m%dT%H%M%SZ'
+UNSIGNED_PAYLOAD = 'UNSIGNED-PAYLOAD'
+
+
+def _utcnow():
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+
+def _quote(value, safe='-._~'):
+    return parse.quote(value.encode('utf-8'), safe=safe)
+
+
+def _hmac(key, msg):
+    return hmac.new(key, msg.encode('utf-8'), hashlib.sha256).digest()
+
+
+class SigV4Presigner(object):
+    """Presign GET URLs and POST policies for the objects of a bucket.
+
+    :param get_url: the URL of the bucket's root for presigned URLs, e.g.
+                    https://bucket.s3.amazonaws.com or, with path-style
+                    addressing, https://s3.amazonaws.com/bucket
+    :param post_url: the URL to POST objects to.
+    """
+
+    def __init__(self, bucket, region, access_key_id, secret_key,
+                 get_url, post_url, token=None, service='s3',
+                 clock=_utcnow):
+        self.bucket = bucket
+        self.region = region
+        self.service = service
+        self.access_key_id = access_key_id
+        self.token = token
+        self.post_url = post_url
+        self._secret_key = secret_key
+        self._clock = clock
+        self._signing_keys = {}
+        self._lock = threading.Lock()
+
+        url = parse.urlsplit(get_url)
+        host = url.hostname
+        if url.port is not None and url.port != {
+                'http': 80, 'https': 443}.get(url.scheme):
+            host = '%s:%d' % (host, url.port)
+        self._get_url = '%s://%s%s/' % (
+            url.scheme, url.netloc, url.path.rstrip('/'))
+        self._get_path = url.path.rstrip('/') + '/'
+        self._scope_suffix = '/%s/%s/aws4_request' % (region, service)
+        self._canonical_suffix = 'host:%s\n\nhost\n%s' % (
+            host, UNSIGNED_PAYLOAD)
+
+    @classmethod
+    def from_client(cls, client, bucket, access_key_id, secret_key,
+                    token=None, **kwargs):
+        """Build a presigner addressing bucket the way client does."""
+        # NOTE(armax): whether the bucket goes in the host name or in the
+        # path, and which host it is, depends on the endpoint resolution
+        # rules and the client configuration: let botocore work it out
+        # once and for all.
+        probe = client.generate_presigned_url(
+            ClientMethod='get_object',
+            Params={'Bucket': bucket, 'Key': 'probe'},
+            ExpiresIn=1)
+        url = parse.urlsplit(probe)
+        get_url = '%s://%s%s' % (url.scheme, url.netloc, url.path[:-6])
+        post_url = client.generate_presigned_post(
+            Bucket=bucket, Key='probe', ExpiresIn=1)['url']
+        return cls(bucket, client.meta.region_name, access_key_id,
+                   secret_key, get_url, post_url, token=token, **kwargs)
+
+    def signing_key(self, datestamp):
+        """Return the key derived for a given day, region and service."""
+        key = self._signing_keys.get(datestamp)
+        if key is None:
+            key = _hmac(('AWS4' + self._secret_key).encode('utf-8'),
+                        datestamp)
+            key = _hmac(key, self.region)
+            key = _hmac(key, self.service)
+            key = _hmac(key, 'aws4_request')
+            with self._lock:
+                # only the current day (and the previous one, around
+                # midnight) is ever needed.
+                if len(self._signing_keys) > 1:
+                    self._signing_keys.clear()
+                self._signing_keys[datestamp] = key
+        return key
+
+    def _sign(self, timestamp, string):
+        return hmac.new(self.signing_key(timestamp[:8]),
+                        string.encode('utf-8'),
+                        hashlib.sha256).hexdigest()
+
+    def presign_get(self, key, expires_in):
+        """Return a presigned URL to GET key for expires_in seconds."""
+        return self.presign_url('GET', key, expires_in)
+
+    def presign_upload_part(self, key, upload_id, part_number, expires_in):
+        """Return a presigned URL to PUT a part of a multipart upload."""
+        return self.presign_url('PUT', key, expires_in, [
+            ('uploadId', upload_id), ('partNumber', str(part_number))])
+
+    def presign_url(self, method, key, expires_in, params=()):
+        """Return a presigned URL for a request with no body to sign.
+
+        :param params: the (name, value) pairs of the operation's query
+                       string, in the order botocore serializes them.
+        """
+        timestamp = self._clock().strftime(SIGV4_TIMESTAMP)
+        scope = timestamp[:8] + self._scope_suffix
+        credential = _quote(self.access_key_id + '/' + scope)
+        query = [(_quote(name), _quote(value)) for name, value in params]
+        query.extend([
+            ('X-Amz-Algorithm', ALGORITHM),
+            ('X-Amz-Credential', credential),
+            ('X-Amz-Date', timestamp),
+            ('X-Amz-Expires', str(expires_in)),
+            ('X-Amz-SignedHeaders', 'host'),
+        ])
+        if self.token is not None:
+            query.append(('X-Amz-Security-Token', _quote(self.token)))
+        query_string = '&'.join('%s=%s' % item for item in query)
+        path = _quote(key, safe='/~')
+
+        canonical_request = '%s\n%s%s\n%s\n%s' % (
+            method, self._get_path, path,
+            '&'.join('%s=%s' % item for item in sorted(query)),
+            self._canonical_suffix)
+        string_to_sign = '%s\n%s\n%s\n%s' % (
+            ALGORITHM, timestamp, scope,
+            hashlib.sha256(canonical_request.encode('utf-8')).hexdigest())
+        return '%s%s?%s&X-Amz-Signature=%s' % (
+            self._get_url, path, query_string,
+            self._sign(timestamp, string_to_sign))
+
+    def presign_post(self, key, expires_in=3600):
+        """Return the URL and form fields to POST key.
+
+        The policy expires in expires_in seconds.
+        """
+        now = self._clock()
+        timestamp = now.strftime(SIGV4_TIMESTAMP)
+        credential = '%s/%s%s' % (
+            self.access_key_id, timestamp[:8], self._scope_suffix)
+        expiration = now + datetime.timedelta(seconds=expires_in)
+        fields = {
+            'key': key,
+            'x-amz-algorithm': ALGORITHM,
+            'x-amz-credential': credential,
+            'x-amz-date': timestamp,
+        }
+        conditions = [
+            {'bucket': self.bucket},
+            {'key': key},
+            {'x-amz-algorithm': ALGORITHM},
+            {'x-amz-credential': credential},
+            {'x-amz-date': timestamp},
+        ]
+        if self.token is not None:
+            fields['x-amz-security-token'] = self.token
+            conditions.append({'x-amz-security-token': self.token})
+        policy = {'expiration': expiration.strftime(ISO8601),
+                  'conditions': conditions}
+        fields['policy'] = base64.b64encode(
+            json.dumps(policy).encode('utf-8')).decode('utf-8')
+        fields['x-amz-signature'] = self._sign(timestamp, fields['policy'])
+        return {'url': self.post_url, 'fields': fields}
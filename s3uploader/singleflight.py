@@ -0,0 +1,114 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Coalesce concurrent identical calls into a single one.
+
+When many requests look up the same asset at once, only the first one
+calls S3: the others wait for its call to complete, and get its result
+or its exception. Nothing is remembered once the call has completed,
+caching results is left to the caches.
+"""
+
+import asyncio
+import threading
+
+from s3uploader import metrics
+
+
+class _Call(object):
+
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class Group(object):
+    """Coalesce the calls made by concurrent threads, by key."""
+
+    def __init__(self, name):
+        self.name = name
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, f, *args):
+        """Return f(*args), unless a call for key is in flight already.
+
+        In which case, wait for that call to complete and return its
+        result, or raise its exception.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            metrics.COALESCED_CALLS.inc(self.name)
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = f(*args)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            self.forget(key, call)
+            call.done.set()
+        return call.result
+
+    def forget(self, key, call=None):
+        """Have the next calls for key not join the one in flight.
+
+        E.g. because what it returns is known to be out of date.
+        """
+        with self._lock:
+            if call is None or self._calls.get(key) is call:
+                self._calls.pop(key, None)
+
+
+class AsyncGroup(object):
+    """Coalesce the calls made by concurrent coroutines, by key.
+
+    The call runs in a task of its own, so that the caller that started
+    it being cancelled does not fail the others.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._calls = {}
+
+    async def do(self, key, f, *args):
+        """Await f(*args), unless a call for key is in flight already."""
+        task = self._calls.get(key)
+        if task is None:
+            task = self._calls[key] = asyncio.ensure_future(f(*args))
+            task.add_done_callback(lambda done: self._done(key, done))
+        else:
+            metrics.COALESCED_CALLS.inc(self.name)
+        return await asyncio.shield(task)
+
+    def forget(self, key):
+        """See Group.forget."""
+        self._calls.pop(key, None)
+
+    def _done(self, key, task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        if not task.cancelled():
+            # NOTE(armax): every caller may have been cancelled, do not
+            # have asyncio complain that the exception was never retrieved.
+            task.exception()
@@ -0,0 +1,294 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Where the state of the assets (created, uploaded) is kept.
+
+By default the only record of an upload being completed is the Status
+tag of its S3 object, which costs an S3 request to write and to read. A
+local index makes telling whether an asset is ready for download a local
+lookup instead.
+"""
+
+import itertools
+import sqlite3
+import threading
+import time
+
+from s3uploader import exceptions
+
+
+CREATED = 'created'
+UPLOADED = 'uploaded'
+
+
+class AssetState(object):
+
+    def __init__(self, asset_id, status, size=None, created_at=None,
+                 uploaded_at=None):
+        self.asset_id = asset_id
+        self.status = status
+        self.size = size
+        self.created_at = created_at
+        self.uploaded_at = uploaded_at
+
+    @property
+    def uploaded(self):
+        return self.status == UPLOADED
+
+
+class AssetStateStore(object):
+    """Interface of the asset state backends."""
+
+    def create(self, asset_id):
+        """Record that an asset was created, and is waiting for upload."""
+        raise NotImplementedError()
+
+    def mark_uploaded(self, asset_id, size=None):
+        """Record that the upload of an asset was completed.
+
+        :raises AssetNotFoundError: if the asset is not known.
+        """
+        raise NotImplementedError()
+
+    def record(self, state):
+        """Record what is known of an asset, e.g. from another store."""
+        raise NotImplementedError()
+
+    def get(self, asset_id):
+        """Return the AssetState of an asset, None if it is not known."""
+        raise NotImplementedError()
+
+    def list(self, limit, after=None, status=None, created_after=None,
+             created_before=None):
+        """Return up to limit AssetStates, by creation time.
+
+        :param after: the (created_at, asset_id) of the last asset of the
+                      previous page, if any.
+        :param status: the status of the assets to list, if not all.
+        :param created_after: the creation time of the first assets to list
+                              (included), if any.
+        :param created_before: the creation time of the last assets to list
+                               (excluded), if any.
+        """
+        raise NotImplementedError()
+
+
+class TaggingStateStore(AssetStateStore):
+    """Keep the state in the Status tag of the S3 objects.
+
+    Only uploaded assets are tagged: created ones are reported as such as
+    long as their S3 object exists. Given a journal.WriteBehind, the tags
+    are written in the background.
+    """
+
+    def __init__(self, storage_manager, write_behind=None):
+        self.storage_manager = storage_manager
+        self.write_behind = write_behind
+
+    def create(self, asset_id):
+        pass
+
+    def mark_uploaded(self, asset_id, size=None):
+        if self.write_behind is None:
+            self.storage_manager.update_upload_status(asset_id)
+            return
+        self.write_behind.append(asset_id)
+        self.storage_manager.remember_uploaded(asset_id)
+
+    def record(self, state):
+        if state.uploaded:
+            self.mark_uploaded(state.asset_id, state.size)
+
+    def get(self, asset_id):
+        try:
+            uploaded = self.storage_manager.get_upload_status(asset_id)
+        except exceptions.AssetNotFoundError:
+            return
+        return AssetState(asset_id, UPLOADED if uploaded else CREATED)
+
+
+_memory_databases = itertools.count()
+
+
+class SQLiteStateStore(AssetStateStore):
+    """Keep the state in a local SQLite database, in WAL mode.
+
+    WAL lets readers proceed while a write is in progress, hence several
+    threads (and worker processes on the same host) can share the file.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS assets (
+            asset_id TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            size INTEGER,
+            created_at REAL NOT NULL,
+            uploaded_at REAL
+        );
+        CREATE INDEX IF NOT EXISTS assets_created_at ON assets (created_at);
+        CREATE INDEX IF NOT EXISTS assets_listing
+            ON assets (created_at, asset_id);
+        CREATE INDEX IF NOT EXISTS assets_status_listing
+            ON assets (status, created_at, asset_id);
+        CREATE TABLE IF NOT EXISTS metadata (
+            name TEXT PRIMARY KEY,
+            value TEXT
+        );
+    """
+
+    def __init__(self, path, clock=time.time):
+        self.path = path
+        self._uri = False
+        if path == ':memory:':
+            # NOTE(armax): make the in-memory database (for testing) the
+            # same for all threads, and only for them: the connections of
+            # other threads outlive the store.
+            self.path = 'file:s3uploader-%d?mode=memory&cache=shared' % next(
+                _memory_databases)
+            self._uri = True
+        self._clock = clock
+        self._local = threading.local()
+        self._keepalive = self._connection()
+        self._keepalive.executescript(self.SCHEMA)
+
+    def _connection(self):
+        # NOTE(armax): connections cannot be shared across threads, each
+        # thread gets its own.
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30,
+                                         isolation_level=None,
+                                         uri=self._uri)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    def create(self, asset_id):
+        self._connection().execute(
+            'INSERT OR IGNORE INTO assets (asset_id, status, created_at) '
+            'VALUES (?, ?, ?)', (asset_id, CREATED, self._clock()))
+
+    def mark_uploaded(self, asset_id, size=None):
+        cursor = self._connection().execute(
+            'UPDATE assets SET status = ?, size = COALESCE(?, size), '
+            'uploaded_at = ? WHERE asset_id = ?',
+            (UPLOADED, size, self._clock(), asset_id))
+        if not cursor.rowcount:
+            raise exceptions.AssetNotFoundError()
+
+    def record(self, state):
+        now = self._clock()
+        uploaded_at = state.uploaded_at
+        if state.uploaded and uploaded_at is None:
+            uploaded_at = now
+        self._connection().execute(
+            'INSERT INTO assets '
+            '(asset_id, status, size, created_at, uploaded_at) '
+            'VALUES (?, ?, ?, ?, ?) '
+            'ON CONFLICT (asset_id) DO UPDATE SET '
+            # once uploaded, always uploaded
+            "status = CASE status WHEN 'uploaded' THEN status "
+            'ELSE excluded.status END, '
+            'size = COALESCE(excluded.size, size), '
+            'uploaded_at = COALESCE(excluded.uploaded_at, uploaded_at)',
+            (state.asset_id, state.status, state.size,
+             state.created_at or now, uploaded_at))
+
+    def get_metadata(self, name):
+        """Return a value stored along with the assets, e.g. checkpoints."""
+        row = self._connection().execute(
+            'SELECT value FROM metadata WHERE name = ?', (name,)).fetchone()
+        if row is not None:
+            return row[0]
+
+    def set_metadata(self, name, value):
+        self._connection().execute(
+            'INSERT OR REPLACE INTO metadata (name, value) VALUES (?, ?)',
+            (name, value))
+
+    def get(self, asset_id):
+        row = self._connection().execute(
+            'SELECT asset_id, status, size, created_at, uploaded_at '
+            'FROM assets WHERE asset_id = ?', (asset_id,)).fetchone()
+        if row is not None:
+            return AssetState(*row)
+
+    def list(self, limit, after=None, status=None, created_after=None,
+             created_before=None):
+        # NOTE(armax): pages start after the last asset of the previous one
+        # rather than at an offset, so that each costs the same however
+        # deep into the listing it is.
+        clauses = []
+        params = []
+        if after is not None:
+            clauses.append('(created_at, asset_id) > (?, ?)')
+            params.extend(after)
+        if status is not None:
+            clauses.append('status = ?')
+            params.append(status)
+        if created_after is not None:
+            clauses.append('created_at >= ?')
+            params.append(created_after)
+        if created_before is not None:
+            clauses.append('created_at < ?')
+            params.append(created_before)
+        query = ('SELECT asset_id, status, size, created_at, uploaded_at '
+                 'FROM assets')
+        if clauses:
+            query += ' WHERE ' + ' AND '.join(clauses)
+        query += ' ORDER BY created_at, asset_id LIMIT ?'
+        rows = self._connection().execute(query, params + [limit]).fetchall()
+        return [AssetState(*row) for row in rows]
+
+
+class WriteThroughStateStore(AssetStateStore):
+    """Keep the state locally, and write it through to a remote store.
+
+    Reads are served locally; assets that are unknown, or not uploaded
+    according to the local store are looked up in the remote one, e.g.
+    because they were uploaded before the local store was introduced.
+    """
+
+    def __init__(self, local, remote):
+        self.local = local
+        self.remote = remote
+
+    def create(self, asset_id):
+        self.remote.create(asset_id)
+        self.local.create(asset_id)
+
+    def mark_uploaded(self, asset_id, size=None):
+        self.remote.mark_uploaded(asset_id, size)
+        self.local.record(AssetState(asset_id, UPLOADED, size=size))
+
+    def record(self, state):
+        self.remote.record(state)
+        self.local.record(state)
+
+    def get(self, asset_id):
+        state = self.local.get(asset_id)
+        if state is not None and state.uploaded:
+            return state
+        remote_state = self.remote.get(asset_id)
+        if remote_state is not None and remote_state.uploaded:
+            self.local.record(remote_state)
+            return remote_state
+        return state or remote_state
+
+    def list(self, limit, after=None, status=None, created_after=None,
+             created_before=None):
+        # NOTE(armax): the remote store cannot be listed cheaply, assets
+        # uploaded before the local store was introduced are listed once
+        # reconciled, see cmds.reconcile.
+        return self.local.list(limit, after, status, created_after,
+                               created_before)
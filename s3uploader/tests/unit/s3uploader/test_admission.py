@@ -0,0 +1,181 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import asyncio
+import threading
+
+import mock
+import testtools
+
+from s3uploader import admission
+from s3uploader import exceptions
+from s3uploader import metrics
+
+
+class TestAIMDLimit(testtools.TestCase):
+
+    def setUp(self):
+        super(TestAIMDLimit, self).setUp()
+        self.now = 0.0
+        self.limit = admission.AIMDLimit(10, latency_target=1.0,
+                                         backoff_ratio=0.5,
+                                         clock=lambda: self.now)
+
+    def test_decrease(self):
+        self.limit.update(2.0)
+        self.assertEqual(5, self.limit.current)
+        # requests in flight when S3 slowed down do not cut it further
+        self.limit.update(2.0)
+        self.assertEqual(5, self.limit.current)
+        self.now = 1.5
+        self.limit.update(0.1, timed_out=True)
+        self.assertEqual(2, self.limit.current)
+
+    def test_min_limit(self):
+        for i in range(10):
+            self.now = i * 2.0
+            self.limit.update(2.0)
+        self.assertEqual(1, self.limit.current)
+
+    def test_increase(self):
+        self.limit.update(2.0)
+        for _ in range(5):
+            self.limit.update(0.1)
+        self.assertEqual(5, self.limit.current)
+        for _ in range(100):
+            self.limit.update(0.1)
+        self.assertEqual(10, self.limit.current)
+
+
+class TestLimiter(testtools.TestCase):
+
+    def setUp(self):
+        super(TestLimiter, self).setUp()
+        metrics.ADMISSION_REJECTED.clear()
+        self.limiter = admission.Limiter('foo', admission.Limit(2),
+                                         queue_size=1, queue_timeout=5)
+
+    def test_admit(self):
+        with self.limiter.admit():
+            self.assertEqual(1, self.limiter.in_flight)
+        self.assertEqual(0, self.limiter.in_flight)
+
+    def test_queue_full(self):
+        self.limiter.queue_timeout = 0
+        self.limiter.acquire()
+        self.limiter.acquire()
+        e = self.assertRaises(exceptions.AssetOverloadedError,
+                              self.limiter.acquire)
+        self.assertEqual(503, e.code)
+        self.assertEqual(1, metrics.ADMISSION_REJECTED.value(
+            'foo', 'queue_full'))
+
+    def test_queue_timeout(self):
+        self.limiter.queue_timeout = 0.01
+        self.limiter.acquire()
+        self.limiter.acquire()
+        self.assertRaises(exceptions.AssetOverloadedError,
+                          self.limiter.acquire)
+        self.assertEqual(1, metrics.ADMISSION_REJECTED.value(
+            'foo', 'queue_timeout'))
+        self.assertEqual(0, self.limiter.queued)
+
+    def test_queued(self):
+        self.limiter.acquire()
+        self.limiter.acquire()
+        admitted = threading.Event()
+
+        def _acquire():
+            self.limiter.acquire()
+            admitted.set()
+
+        waiter = threading.Thread(target=_acquire)
+        waiter.start()
+        while not self.limiter.queued:
+            threading.Event().wait(0.001)
+        self.assertFalse(admitted.is_set())
+        self.limiter.release(0.1)
+        waiter.join(5)
+        self.assertTrue(admitted.is_set())
+        self.assertEqual(2, self.limiter.in_flight)
+
+    def test_release_updates_limit(self):
+        self.limiter.limit = mock.Mock(current=2)
+        self.limiter.acquire()
+        self.limiter.release(0.5, exceptions.AssetTimeoutError())
+        self.limiter.limit.update.assert_called_once_with(0.5, True)
+
+
+class TestAsyncLimiter(testtools.TestCase):
+
+    def setUp(self):
+        super(TestAsyncLimiter, self).setUp()
+        self.limiter = admission.AsyncLimiter('foo', admission.Limit(1),
+                                              queue_size=1, queue_timeout=5)
+        self.served = []
+
+    async def _serve(self, i, release=None):
+        try:
+            async with self.limiter.admit():
+                self.served.append(i)
+                if release is not None:
+                    await release.wait()
+        except exceptions.AssetOverloadedError:
+            self.served.append('rejected %d' % i)
+
+    def test_admit_in_turn(self):
+        async def _run():
+            release = asyncio.Event()
+            first = asyncio.ensure_future(self._serve(1, release))
+            await asyncio.sleep(0)
+            others = [asyncio.ensure_future(self._serve(i)) for i in (2, 3)]
+            await asyncio.sleep(0)
+            release.set()
+            await asyncio.gather(first, *others)
+
+        asyncio.run(_run())
+        self.assertEqual([1, 'rejected 3', 2], self.served)
+        self.assertEqual(0, self.limiter.in_flight)
+        self.assertEqual(0, self.limiter.queued)
+
+    def test_queue_timeout(self):
+        self.limiter.queue_timeout = 0.01
+
+        async def _run():
+            release = asyncio.Event()
+            first = asyncio.ensure_future(self._serve(1, release))
+            await asyncio.sleep(0)
+            await self._serve(2)
+            release.set()
+            await first
+
+        asyncio.run(_run())
+        self.assertEqual([1, 'rejected 2'], self.served)
+        self.assertEqual(0, self.limiter.in_flight)
+
+
+class TestBuildLimiters(testtools.TestCase):
+
+    def test_build_limiters(self):
+        config = mock.Mock(concurrency_limits={'get_asset': 8},
+                           adaptive_limits=True, latency_target=2.0,
+                           queue_size=4, queue_timeout=0.1, retry_after=3)
+        limiters = admission.build_limiters(config, admission.AsyncLimiter)
+        self.assertEqual(['get_asset'], list(limiters))
+        limiter = limiters['get_asset']
+        self.assertIsInstance(limiter, admission.AsyncLimiter)
+        self.assertIsInstance(limiter.limit, admission.AIMDLimit)
+        self.assertEqual(8, limiter.limit.current)
+        self.assertEqual(2.0, limiter.limit.latency_target)
+        self.assertEqual((4, 0.1, 3), (limiter.queue_size,
+                                       limiter.queue_timeout,
+                                       limiter.retry_after))
@@ -14,9 +14,13 @@ import mock
 from oslo_serialization import jsonutils
 import testtools
 
+from s3uploader import admission
+from s3uploader import api
 from s3uploader.cmds.service import app
 from s3uploader import exceptions
+from s3uploader import metrics
 from s3uploader import s3
+from s3uploader import state
 
 
 class TestS3Uploader(testtools.TestCase):
@@ -24,9 +28,11 @@ class TestS3Uploader(testtools.TestCase):
     def setUp(self):
         super(TestS3Uploader, self).setUp()
         self.app = app.test_client()
-        self.manager_patch = mock.patch(
-            's3uploader.s3.AssetManager', autospec=True).start()
-        self.manager = self.manager_patch.return_value
+        self.manager = mock.create_autospec(s3.AssetManager, instance=True)
+        mock.patch('s3uploader.s3.get_asset_manager',
+                   return_value=self.manager).start()
+        self.get_limiter = mock.patch('s3uploader.admission.get_limiter',
+                                      return_value=None).start()
         self.addCleanup(mock.patch.stopall)
 
     def test_asset_post(self):
@@ -42,6 +48,13 @@ class TestS3Uploader(testtools.TestCase):
                                 data=jsonutils.dumps(dict(Status='Uploaded')))
         self.assertEqual(response.status_code, 200)
 
+    def test_asset_put_size(self):
+        response = self.app.put(
+            '/asset/foo123',
+            data=jsonutils.dumps(dict(Status='Uploaded', Size=1024)))
+        self.assertEqual(response.status_code, 200)
+        self.manager.update_asset.assert_called_once_with('foo123', 1024)
+
     def test_asset_get(self):
         self.manager.get_asset.return_value = s3.Asset('foo_url')
         response = self.app.get('/asset/foo123')
@@ -49,6 +62,93 @@ class TestS3Uploader(testtools.TestCase):
         response_body = jsonutils.loads(response.get_data())
         self.assertIn('download_url', response_body)
 
+    def test_asset_get_redirect(self):
+        url = 'https://foo/bar?Expires=1509498000'
+        self.manager.get_asset.return_value = s3.Asset(url)
+        response = self.app.get('/asset/foo123?redirect=true')
+        self.assertEqual(307, response.status_code)
+        self.assertEqual(url, response.headers['Location'])
+        self.assertEqual('public, max-age=0',
+                         response.headers['Cache-Control'])
+        self.assertEqual('X-Client-Region', response.headers['Vary'])
+        self.assertEqual(url, jsonutils.loads(
+            response.get_data())['download_url'])
+
+    def test_asset_get_redirect_not_ready(self):
+        self.manager.get_asset.return_value = s3.Asset(None)
+        response = self.app.get('/asset/foo123?redirect=1')
+        self.assertEqual(409, response.status_code)
+
+    def test_asset_content(self):
+        body = mock.Mock()
+        body.read.side_effect = [b'foo', b'bar', b'']
+        self.manager.open_download.return_value = s3.Download(
+            'foo123', 206, [('Content-Range', 'bytes 0-5/10'),
+                            ('Content-Length', '6')], body)
+        response = self.app.get('/asset/foo123/content',
+                                headers={'Range': 'bytes=0-5',
+                                         'If-None-Match': '"etag"'})
+        self.assertEqual(206, response.status_code)
+        self.assertEqual(b'foobar', response.get_data())
+        self.assertEqual('bytes 0-5/10', response.headers['Content-Range'])
+        self.manager.open_download.assert_called_once_with(
+            'foo123', 'bytes=0-5', '"etag"')
+        body.close.assert_called_once_with()
+
+    def test_asset_content_not_modified(self):
+        self.manager.open_download.return_value = s3.Download(
+            'foo123', 304, [('ETag', '"etag"')])
+        response = self.app.get('/asset/foo123/content')
+        self.assertEqual(304, response.status_code)
+        self.assertEqual('"etag"', response.headers['ETag'])
+
+    def test_asset_content_not_ready(self):
+        self.manager.open_download.return_value = None
+        response = self.app.get('/asset/foo123/content')
+        self.assertEqual(409, response.status_code)
+
+    def test_asset_content_invalid_range(self):
+        self.manager.open_download.side_effect = (
+            exceptions.AssetRangeNotSatisfiableError())
+        response = self.app.get('/asset/foo123/content',
+                                headers={'Range': 'bytes=100-'})
+        self.assertEqual(416, response.status_code)
+
+    def test_asset_get_overloaded(self):
+        limiter = admission.Limiter('get_asset', admission.Limit(1),
+                                    queue_timeout=0, retry_after=2)
+        self.get_limiter.return_value = limiter
+        self.manager.get_asset.return_value = s3.Asset('foo_url')
+        self.assertEqual(200, self.app.get('/asset/foo123').status_code)
+        limiter.acquire()
+        response = self.app.get('/asset/foo123')
+        self.assertEqual(503, response.status_code)
+        self.assertEqual('2', response.headers['Retry-After'])
+        self.get_limiter.assert_called_with('get_asset')
+        self.assertEqual(1, self.manager.get_asset.call_count)
+
+    def test_asset_put_overloaded(self):
+        limiter = admission.Limiter('put_asset', admission.Limit(1),
+                                    queue_timeout=0)
+        self.get_limiter.return_value = limiter
+        limiter.acquire()
+        response = self.app.put('/asset/foo123',
+                                data=jsonutils.dumps(dict(Status='Uploaded')))
+        self.assertEqual(503, response.status_code)
+        self.assertFalse(self.manager.update_asset.called)
+
+    def test_asset_get_invalid_redirect(self):
+        response = self.app.get('/asset/foo123?redirect=maybe')
+        self.assertEqual(400, response.status_code)
+        self.assertFalse(self.manager.get_asset.called)
+
+    def test_asset_get_region(self):
+        self.manager.get_asset.return_value = s3.Asset('foo_url')
+        self.app.get('/asset/foo123',
+                     headers={'X-Client-Region': 'eu-west-1'})
+        self.manager.get_asset.assert_called_once_with(
+            'foo123', 60, region='eu-west-1')
+
     def test_asset_get_not_ready(self):
         self.manager.get_asset.return_value = s3.Asset(None)
         response = self.app.get('/asset/foo123')
@@ -70,6 +170,11 @@ class TestS3Uploader(testtools.TestCase):
         response = self.app.get('/asset/foo123')
         self.assertEqual(response.status_code, 500)
 
+    def test_asset_get_timeout(self):
+        self.manager.get_asset.side_effect = exceptions.AssetTimeoutError()
+        response = self.app.get('/asset/foo123')
+        self.assertEqual(response.status_code, 504)
+
     def test_asset_put_backend_failure(self):
         self.manager.update_asset.side_effect = exceptions.AssetError()
         response = self.app.put('/asset/foo123',
@@ -86,12 +191,145 @@ class TestS3Uploader(testtools.TestCase):
         response = self.app.post('/asset')
         self.assertEqual(response.status_code, 500)
 
+    def test_assets_batch_post(self):
+        self.manager.create_assets.return_value = [
+            s3.Asset('foo_url', 'foo'), s3.Asset('bar_url', 'bar')]
+        response = self.app.post('/assets:batch',
+                                 data=jsonutils.dumps(dict(count=2)))
+        self.assertEqual(response.status_code, 200)
+        response_body = jsonutils.loads(response.get_data())
+        self.assertEqual(
+            [{'id': 'foo', 'upload_url': 'foo_url'},
+             {'id': 'bar', 'upload_url': 'bar_url'}],
+            response_body['assets'])
+        self.manager.create_assets.assert_called_once_with(2)
+
+    def test_assets_batch_post_backend_failure(self):
+        self.manager.create_assets.return_value = [s3.Asset(None, 'foo')]
+        response = self.app.post('/assets:batch',
+                                 data=jsonutils.dumps(dict(count=1)))
+        self.assertEqual(response.status_code, 500)
+
+    def test_assets_list(self):
+        self.manager.list_assets.return_value = (
+            [state.AssetState('foo', state.UPLOADED, 10, 100, 110),
+             state.AssetState('bar', None, created_at=120)],
+            {'token': 'next'})
+        response = self.app.get(
+            '/asset?limit=2&status=uploaded&created_after=100')
+        self.assertEqual(200, response.status_code)
+        body = jsonutils.loads(response.get_data())
+        self.assertEqual(
+            [{'id': 'foo', 'status': 'uploaded', 'size': 10,
+              'created_at': 100, 'uploaded_at': 110},
+             {'id': 'bar', 'status': 'unknown', 'created_at': 120}],
+            body['assets'])
+        self.manager.list_assets.assert_called_once_with(
+            limit=2, status='uploaded', created_after=100.0,
+            created_before=None)
+        self.manager.list_assets.reset_mock()
+        self.manager.list_assets.return_value = ([], None)
+        response = self.app.get('/asset?cursor=%s' % body['next_cursor'])
+        self.assertEqual(
+            {'assets': [], 'next_cursor': None},
+            jsonutils.loads(response.get_data()))
+        self.manager.list_assets.assert_called_once_with(
+            limit=100, status=None, created_after=None, created_before=None,
+            cursor={'token': 'next'})
+
+    def test_assets_batch_get(self):
+        self.manager.get_assets.return_value = [
+            s3.Asset('foo_url', 'foo'),
+            s3.Asset(None, 'bar'),
+            s3.Asset(None, 'baz', exceptions.AssetNotFoundError()),
+            s3.Asset(None, 'qux', exceptions.AssetError()),
+            s3.Asset(None, 'quux', exceptions.AssetTimeoutError())]
+        response = self.app.post(
+            '/assets:batchGet',
+            data=jsonutils.dumps(dict(ids=['foo', 'bar', 'baz', 'qux'],
+                                      timeout=30)))
+        self.assertEqual(response.status_code, 200)
+        response_body = jsonutils.loads(response.get_data())
+        self.assertEqual(
+            [{'id': 'foo', 'status': 'ready', 'download_url': 'foo_url'},
+             {'id': 'bar', 'status': 'not_ready'},
+             {'id': 'baz', 'status': 'not_found'},
+             {'id': 'qux', 'status': 'error'},
+             {'id': 'quux', 'status': 'timeout'}],
+            response_body['assets'])
+        self.manager.get_assets.assert_called_once_with(
+            ['foo', 'bar', 'baz', 'qux'], 30, region=None)
+
+    def test_multipart_post(self):
+        self.manager.create_multipart_asset.return_value = (
+            s3.MultipartUpload('foo', 'upload', 5242880, [(1, 'url1')]))
+        response = self.app.post('/asset:multipart',
+                                 data=jsonutils.dumps(dict(size=10)))
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(
+            {'id': 'foo', 'upload_id': 'upload', 'part_size': 5242880,
+             'parts': [{'part_number': 1, 'upload_url': 'url1'}]},
+            jsonutils.loads(response.get_data()))
+        self.manager.create_multipart_asset.assert_called_once_with(10, None)
+
+    def test_multipart_get(self):
+        self.manager.get_multipart_upload.return_value = s3.MultipartUpload(
+            'foo', 'upload', part_urls=[(2, 'url2')],
+            parts=[{'PartNumber': 1, 'Size': 10, 'ETag': '"etag"'}])
+        response = self.app.get(
+            '/asset/foo/multipart/upload?part_numbers=2')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(
+            {'id': 'foo', 'upload_id': 'upload',
+             'parts': [{'part_number': 2, 'upload_url': 'url2'}],
+             'uploaded_parts': [
+                 {'part_number': 1, 'size': 10, 'etag': '"etag"'}]},
+            jsonutils.loads(response.get_data()))
+        self.manager.get_multipart_upload.assert_called_once_with(
+            'foo', 'upload', [2])
+
+    def test_multipart_put(self):
+        response = self.app.put(
+            '/asset/foo/multipart/upload',
+            data=jsonutils.dumps(dict(Status='Uploaded', Size=10)))
+        self.assertEqual(200, response.status_code)
+        self.manager.complete_multipart_asset.assert_called_once_with(
+            'foo', 'upload', 10)
+
+    def test_multipart_put_incomplete(self):
+        self.manager.complete_multipart_asset.side_effect = (
+            exceptions.AssetUploadIncompleteError())
+        response = self.app.put(
+            '/asset/foo/multipart/upload',
+            data=jsonutils.dumps(dict(Status='Uploaded', Size=10)))
+        self.assertEqual(409, response.status_code)
+
+    def test_multipart_delete(self):
+        response = self.app.delete('/asset/foo/multipart/upload')
+        self.assertEqual(200, response.status_code)
+        self.manager.abort_multipart_asset.assert_called_once_with(
+            'foo', 'upload')
+
+    def test_metrics(self):
+        self.manager.get_asset.return_value = s3.Asset(None)
+        self.app.get('/asset/foo123')
+        response = self.app.get('/metrics')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(metrics.CONTENT_TYPE, response.content_type)
+        self.assertIn(
+            's3uploader_request_duration_seconds_count{'
+            'endpoint="/asset/<string:asset_id>",method="GET",'
+            'status="409"}', response.get_data(as_text=True))
+
 
 class TestS3UploaderNegativeInputs(testtools.TestCase):
 
     def setUp(self):
         super(TestS3UploaderNegativeInputs, self).setUp()
         self.app = app.test_client()
+        mock.patch('s3uploader.admission.get_limiter',
+                   return_value=None).start()
+        self.addCleanup(mock.patch.stopall)
 
     def test_asset_post_wrong_prefix(self):
         response = self.app.post('/asset1')
@@ -107,6 +345,79 @@ class TestS3UploaderNegativeInputs(testtools.TestCase):
                                 data=jsonutils.dumps(dict(Status='Aploaded')))
         self.assertEqual(response.status_code, 400)
 
+    def test_asset_put_bad_input_size(self):
+        response = self.app.put(
+            '/asset/foo123',
+            data=jsonutils.dumps(dict(Status='Uploaded', Size=-1)))
+        self.assertEqual(response.status_code, 400)
+
     def test_asset_get_invalid_timeout(self):
         response = self.app.get('/asset/foo123?timeout=0')
         self.assertEqual(response.status_code, 400)
+
+    def test_assets_list_bad_input(self):
+        for query in ('limit=0', 'limit=1001', 'limit=ten',
+                      'status=ready', 'created_after=yesterday',
+                      'cursor=foo', 'cursor=e30'):
+            response = self.app.get('/asset?%s' % query)
+            self.assertEqual(400, response.status_code)
+
+    def test_assets_batch_post_invalid_count(self):
+        for count in (0, -1, 'two', True, 1000):
+            response = self.app.post('/assets:batch',
+                                     data=jsonutils.dumps(dict(count=count)))
+            self.assertEqual(response.status_code, 400)
+
+    def test_assets_batch_get_invalid_ids(self):
+        for ids in ([], 'foo', [1], ['foo'] * 1000):
+            response = self.app.post('/assets:batchGet',
+                                     data=jsonutils.dumps(dict(ids=ids)))
+            self.assertEqual(response.status_code, 400)
+
+    def test_assets_batch_get_invalid_timeout(self):
+        response = self.app.post(
+            '/assets:batchGet',
+            data=jsonutils.dumps(dict(ids=['foo'], timeout=-1)))
+        self.assertEqual(response.status_code, 400)
+
+    def test_multipart_post_bad_input(self):
+        for body in ({}, {'size': -1}, {'size': 'big'},
+                     {'size': 10, 'part_size': 1024}):
+            response = self.app.post('/asset:multipart',
+                                     data=jsonutils.dumps(body))
+            self.assertEqual(400, response.status_code)
+
+    def test_multipart_get_bad_part_numbers(self):
+        for part_numbers in ('x', '0', '1,10001'):
+            response = self.app.get(
+                '/asset/foo/multipart/upload?part_numbers=%s' % part_numbers)
+            self.assertEqual(400, response.status_code)
+
+    def test_multipart_put_size_required(self):
+        response = self.app.put('/asset/foo/multipart/upload',
+                                data=jsonutils.dumps(dict(Status='Uploaded')))
+        self.assertEqual(400, response.status_code)
+
+
+class TestRedirectHeaders(testtools.TestCase):
+
+    def test_url_expires_at(self):
+        self.assertEqual(1509498000, api.url_expires_at(
+            'https://foo/bar?X-Amz-Date=20171101T000000Z&X-Amz-Expires=3600'))
+        self.assertEqual(1509498000, api.url_expires_at(
+            'https://foo/bar?AWSAccessKeyId=baz&Expires=1509498000'))
+        self.assertIsNone(api.url_expires_at('https://foo/bar'))
+        self.assertIsNone(api.url_expires_at(
+            'https://foo/bar?X-Amz-Date=yesterday&X-Amz-Expires=3600'))
+
+    def test_redirect_headers(self):
+        url = 'https://foo/bar?Expires=1509498000'
+        self.assertEqual(
+            [('Location', url), ('Cache-Control', 'public, max-age=59'),
+             ('Vary', 'X-Client-Region')],
+            api.redirect_headers(url, clock=lambda: 1509497940.5))
+        self.assertEqual(
+            ('Cache-Control', 'public, max-age=0'),
+            api.redirect_headers(url, clock=lambda: 1509500000)[1])
+        self.assertEqual(('Cache-Control', 'no-cache'),
+                         api.redirect_headers('https://foo/bar')[1])
@@ -0,0 +1,471 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import asyncio
+
+from botocore import exceptions as boto_exc
+import mock
+from oslo_serialization import jsonutils
+import testtools
+
+from s3uploader import admission
+from s3uploader import aio
+from s3uploader import asgi
+from s3uploader import cache
+from s3uploader import exceptions
+from s3uploader import metrics
+from s3uploader import s3
+from s3uploader import state
+
+
+def _request(app, method, path, body=b'', query_string=b'', raw=False,
+             headers=()):
+    scope = {'type': 'http', 'method': method, 'path': path,
+             'query_string': query_string, 'headers': list(headers)}
+    messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(app(scope, receive, send))
+    if raw:
+        return sent[0], sent[1]['body']
+    return sent[0]['status'], jsonutils.loads(sent[1]['body'])
+
+
+class TestASGIApplication(testtools.TestCase):
+
+    def setUp(self):
+        super(TestASGIApplication, self).setUp()
+        self.manager = mock.Mock()
+        self.app = asgi.Application(asset_manager=self.manager)
+
+    def test_asset_post(self):
+        self.manager.create_asset = mock.AsyncMock(
+            return_value=s3.Asset('foo_url', 'foo'))
+        status, body = _request(self.app, 'POST', '/asset')
+        self.assertEqual(200, status)
+        self.assertEqual({'upload_url': 'foo_url', 'id': 'foo'}, body)
+
+    def test_asset_put(self):
+        self.manager.update_asset = mock.AsyncMock()
+        status, body = _request(self.app, 'PUT', '/asset/foo123',
+                                body=b'{"Status": "Uploaded"}')
+        self.assertEqual(200, status)
+        self.manager.update_asset.assert_awaited_once_with('foo123', None)
+
+    def test_asset_put_bad_input(self):
+        status, body = _request(self.app, 'PUT', '/asset/foo123',
+                                body=b'{"Stotus": "Uploaded"}')
+        self.assertEqual(400, status)
+        status, body = _request(self.app, 'PUT', '/asset/foo123',
+                                body=b'garbage')
+        self.assertEqual(400, status)
+
+    def test_asset_get(self):
+        self.manager.get_asset = mock.AsyncMock(
+            return_value=s3.Asset('foo_url', 'foo'))
+        status, body = _request(self.app, 'GET', '/asset/foo123',
+                                query_string=b'timeout=10')
+        self.assertEqual(200, status)
+        self.assertEqual({'download_url': 'foo_url'}, body)
+        self.manager.get_asset.assert_awaited_once_with(
+            'foo123', 10, region=None)
+
+    def test_asset_get_redirect(self):
+        url = 'https://foo/bar?Expires=1509498000'
+        self.manager.get_asset = mock.AsyncMock(
+            return_value=s3.Asset(url, 'foo'))
+        start, body = _request(self.app, 'GET', '/asset/foo123',
+                               query_string=b'redirect=true', raw=True)
+        self.assertEqual(307, start['status'])
+        headers = dict(start['headers'])
+        self.assertEqual(url.encode(), headers[b'location'])
+        # the URL has long expired
+        self.assertEqual(b'public, max-age=0', headers[b'cache-control'])
+        self.assertEqual(b'X-Client-Region', headers[b'vary'])
+
+    def test_asset_get_overloaded(self):
+        limiter = admission.AsyncLimiter('get_asset', admission.Limit(1),
+                                         queue_timeout=0, retry_after=2)
+        self.app.limiters = {'get_asset': limiter}
+        self.manager.get_asset = mock.AsyncMock(
+            return_value=s3.Asset('foo_url', 'foo'))
+        status, body = _request(self.app, 'GET', '/asset/foo123')
+        self.assertEqual(200, status)
+        self.assertEqual(0, limiter.in_flight)
+        limiter.in_flight = 1
+        start, body = _request(self.app, 'GET', '/asset/foo123', raw=True)
+        self.assertEqual(503, start['status'])
+        self.assertIn((b'retry-after', b'2'), start['headers'])
+        self.manager.get_asset.assert_awaited_once_with(
+            'foo123', 60, region=None)
+
+    def test_asset_get_region(self):
+        self.manager.get_asset = mock.AsyncMock(
+            return_value=s3.Asset('foo_url', 'foo'))
+        _request(self.app, 'GET', '/asset/foo123',
+                 headers=[(b'X-Client-Region', b'eu-west-1')])
+        self.manager.get_asset.assert_awaited_once_with(
+            'foo123', 60, region='eu-west-1')
+
+    def test_asset_content(self):
+        body = mock.Mock()
+        body.read = mock.AsyncMock(side_effect=[b'foo', b'bar', b''])
+        self.manager.open_download = mock.AsyncMock(
+            return_value=aio.AsyncDownload(
+                'foo123', 200, [('Content-Length', '6')], body))
+        scope = {'type': 'http', 'method': 'GET',
+                 'path': '/asset/foo123/content', 'query_string': b'',
+                 'headers': [(b'range', b'bytes=0-')]}
+        sent = []
+
+        async def send(message):
+            sent.append(message)
+
+        asyncio.run(self.app(scope, None, send))
+        self.assertEqual(200, sent[0]['status'])
+        self.assertEqual([(b'content-length', b'6')], sent[0]['headers'])
+        self.assertEqual(b'foobar',
+                         b''.join(message['body'] for message in sent[1:]))
+        self.assertFalse(sent[-1].get('more_body'))
+        self.manager.open_download.assert_awaited_once_with(
+            'foo123', 'bytes=0-', None)
+        body.close.assert_called_once_with()
+
+    def test_asset_content_not_ready(self):
+        self.manager.open_download = mock.AsyncMock(return_value=None)
+        status, body = _request(self.app, 'GET', '/asset/foo123/content')
+        self.assertEqual(409, status)
+
+    def test_asset_get_not_ready(self):
+        self.manager.get_asset = mock.AsyncMock(return_value=s3.Asset(None))
+        status, body = _request(self.app, 'GET', '/asset/foo123')
+        self.assertEqual(409, status)
+
+    def test_asset_get_not_found(self):
+        self.manager.get_asset = mock.AsyncMock(
+            side_effect=exceptions.AssetNotFoundError())
+        status, body = _request(self.app, 'GET', '/asset/foo123')
+        self.assertEqual(404, status)
+        self.assertEqual(
+            {'message': exceptions.AssetNotFoundError.description}, body)
+
+    def test_asset_get_invalid_timeout(self):
+        status, body = _request(self.app, 'GET', '/asset/foo123',
+                                query_string=b'timeout=0')
+        self.assertEqual(400, status)
+
+    def test_assets_list(self):
+        self.manager.list_assets = mock.AsyncMock(return_value=(
+            [state.AssetState('foo', state.CREATED, created_at=100)], None))
+        status, body = _request(self.app, 'GET', '/asset',
+                                query_string=b'status=created&limit=10')
+        self.assertEqual(200, status)
+        self.assertEqual(
+            {'assets': [{'id': 'foo', 'status': 'created',
+                         'created_at': 100}],
+             'next_cursor': None}, body)
+        self.manager.list_assets.assert_awaited_once_with(
+            limit=10, status='created', created_after=None,
+            created_before=None)
+        status, body = _request(self.app, 'GET', '/asset',
+                                query_string=b'limit=0')
+        self.assertEqual(400, status)
+
+    def test_assets_batch_get(self):
+        self.manager.get_assets = mock.AsyncMock(return_value=[
+            s3.Asset('foo_url', 'foo'), s3.Asset(None, 'bar')])
+        status, body = _request(self.app, 'POST', '/assets:batchGet',
+                                body=b'{"ids": ["foo", "bar"]}')
+        self.assertEqual(200, status)
+        self.assertEqual(
+            [{'id': 'foo', 'status': 'ready', 'download_url': 'foo_url'},
+             {'id': 'bar', 'status': 'not_ready'}], body['assets'])
+
+    def test_multipart_post(self):
+        self.manager.create_multipart_asset = mock.AsyncMock(
+            return_value=s3.MultipartUpload('foo', 'upload', 5242880,
+                                            [(1, 'url1')]))
+        status, body = _request(self.app, 'POST', '/asset:multipart',
+                                body=b'{"size": 10}')
+        self.assertEqual(200, status)
+        self.assertEqual('upload', body['upload_id'])
+        self.assertEqual([{'part_number': 1, 'upload_url': 'url1'}],
+                         body['parts'])
+
+    def test_multipart_put(self):
+        self.manager.complete_multipart_asset = mock.AsyncMock()
+        status, body = _request(
+            self.app, 'PUT', '/asset/foo/multipart/upload',
+            body=b'{"Status": "Uploaded", "Size": 10}')
+        self.assertEqual(200, status)
+        self.manager.complete_multipart_asset.assert_awaited_once_with(
+            'foo', 'upload', 10)
+        status, body = _request(
+            self.app, 'PUT', '/asset/foo/multipart/upload',
+            body=b'{"Status": "Uploaded"}')
+        self.assertEqual(400, status)
+
+    def test_not_found(self):
+        status, body = _request(self.app, 'POST', '/asset1')
+        self.assertEqual(404, status)
+
+    def test_method_not_allowed(self):
+        status, body = _request(self.app, 'DELETE', '/asset/foo123')
+        self.assertEqual(405, status)
+
+    def test_metrics(self):
+        self.manager.get_asset = mock.AsyncMock(
+            side_effect=exceptions.AssetNotFoundError())
+        _request(self.app, 'GET', '/asset/foo123')
+        start, body = _request(self.app, 'GET', '/metrics', raw=True)
+        self.assertEqual(200, start['status'])
+        self.assertIn((b'content-type', metrics.CONTENT_TYPE.encode()),
+                      start['headers'])
+        self.assertIn(
+            b's3uploader_request_duration_seconds_count{'
+            b'endpoint="/asset/<string:asset_id>",method="GET",'
+            b'status="404"}', body)
+
+
+class TestASGIStartup(testtools.TestCase):
+
+    def setUp(self):
+        super(TestASGIStartup, self).setUp()
+        self.config = mock.Mock(warm_up=True, concurrency_limits={})
+        mock.patch('s3uploader.s3.get_config',
+                   return_value=self.config).start()
+        self.build = mock.patch('s3uploader.aio.build_asset_manager',
+                                new_callable=mock.AsyncMock).start()
+        self.addCleanup(mock.patch.stopall)
+        self.app = asgi.Application()
+
+    def test_startup(self):
+        asyncio.run(self.app.startup())
+        self.assertIs(self.build.return_value, self.app.asset_manager)
+
+    def test_startup_no_warm_up(self):
+        self.config.warm_up = False
+        asyncio.run(self.app.startup())
+        self.assertFalse(self.build.called)
+        # built on first use instead
+        self.build.return_value.create_asset = mock.AsyncMock(
+            return_value=s3.Asset('foo_url', 'foo'))
+        status, body = _request(self.app, 'POST', '/asset')
+        self.assertEqual(200, status)
+        self.build.assert_awaited_once()
+
+
+class TestAsyncAssetManagerStateStore(testtools.TestCase):
+
+    def setUp(self):
+        super(TestAsyncAssetManagerStateStore, self).setUp()
+        self.storage_mock = mock.Mock()
+        self.storage_mock.get_url_for_upload = mock.AsyncMock(
+            return_value='upload_url')
+        self.storage_mock.presign_download.return_value = 'foo_url'
+        self.store = state.SQLiteStateStore(':memory:')
+        self.manager = aio.AsyncAssetManager(
+            storage_manager=self.storage_mock, state_store=self.store)
+
+    def test_create_asset(self):
+        asset = asyncio.run(self.manager.create_asset())
+        self.assertEqual(state.CREATED, self.store.get(asset.asset_id).status)
+
+    def test_get_asset(self):
+        asset = asyncio.run(self.manager.create_asset())
+        self.assertIsNone(
+            asyncio.run(self.manager.get_asset(asset.asset_id, 50)).url)
+        asyncio.run(self.manager.update_asset(asset.asset_id, 10))
+        self.assertEqual(10, self.store.get(asset.asset_id).size)
+        self.assertEqual('foo_url', asyncio.run(
+            self.manager.get_asset(asset.asset_id, 50)).url)
+        self.assertFalse(self.storage_mock.get_url_for_download.called)
+        self.assertFalse(self.storage_mock.update_upload_status.called)
+
+    def test_get_asset_presign_error(self):
+        self.storage_mock.presign_download.side_effect = (
+            boto_exc.NoCredentialsError())
+        self.store.record(state.AssetState('foo', state.UPLOADED))
+        self.assertRaises(exceptions.AssetError, asyncio.run,
+                          self.manager.get_asset('foo', 50))
+
+    def test_get_assets(self):
+        self.store.record(state.AssetState('foo', state.UPLOADED))
+        assets = asyncio.run(self.manager.get_assets(['foo', 'bar'], 50))
+        self.assertEqual('foo_url', assets[0].url)
+        self.assertIsInstance(assets[1].error, exceptions.AssetNotFoundError)
+
+    def test_open_download(self):
+        self.manager.proxy = True
+        self.storage_mock.open_download = mock.AsyncMock()
+        self.store.create('foo')
+        self.assertIsNone(asyncio.run(self.manager.open_download('foo')))
+        self.store.record(state.AssetState('foo', state.UPLOADED))
+        download = asyncio.run(self.manager.open_download('foo'))
+        self.assertIs(self.storage_mock.open_download.return_value, download)
+        self.assertFalse(self.storage_mock.get_upload_status.called)
+        self.assertRaises(exceptions.AssetNotFoundError, asyncio.run,
+                          self.manager.open_download('bar'))
+
+    def test_list_assets(self):
+        for i, asset_id in enumerate(['foo', 'bar', 'baz']):
+            self.store.record(state.AssetState(
+                asset_id, state.UPLOADED, created_at=100.0 + i))
+        states, cursor = asyncio.run(self.manager.list_assets(2))
+        self.assertEqual(['foo', 'bar'], [s.asset_id for s in states])
+        self.assertEqual({'after': [101.0, 'bar']}, cursor)
+        states, cursor = asyncio.run(self.manager.list_assets(2, cursor))
+        self.assertEqual(['baz'], [s.asset_id for s in states])
+        self.assertIsNone(cursor)
+        self.assertFalse(self.storage_mock.list_assets.called)
+
+
+class TestAsyncBuildAssetManager(testtools.TestCase):
+
+    def test_state_store(self):
+        asset_manager = mock.Mock(storage_manager=mock.Mock())
+        with mock.patch('s3uploader.s3.build_asset_manager',
+                        return_value=asset_manager), \
+                mock.patch('s3uploader.aio.build_s3_manager',
+                           new=mock.AsyncMock()):
+            manager = asyncio.run(aio.build_asset_manager(
+                mock.Mock(), mock.Mock()))
+        self.assertIs(asset_manager.state_store, manager.state_store)
+
+
+class TestAsyncS3Manager(testtools.TestCase):
+
+    def setUp(self):
+        super(TestAsyncS3Manager, self).setUp()
+        self.s3_manager = s3.S3Manager(
+            config=mock.Mock(), client=mock.Mock(),
+            readiness_cache=cache.ReadinessCache(cache.LRUCache(10), 60, 5))
+        self.client = mock.Mock()
+        self.client.get_object_tagging = mock.AsyncMock(
+            return_value={'TagSet': [{'Key': 'Status', 'Value': 'Uploaded'}]})
+        self.client.put_object_tagging = mock.AsyncMock()
+        self.manager = aio.AsyncS3Manager(self.s3_manager, self.client)
+        self.s3_manager.client.generate_presigned_url.return_value = 'url'
+
+    def test_get_url_for_download(self):
+        url = asyncio.run(
+            self.manager.get_url_for_download('foo_asset_id', 50))
+        self.assertEqual('url', url)
+        asyncio.run(self.manager.get_url_for_download('foo_asset_id', 50))
+        self.client.get_object_tagging.assert_awaited_once()
+
+    def test_get_url_for_download_not_found(self):
+        self.client.get_object_tagging.side_effect = boto_exc.ClientError(
+            error_response={'Error': {'Code': 'NoSuchKey'}},
+            operation_name='foo')
+        self.assertRaises(
+            exceptions.AssetNotFoundError, asyncio.run,
+            self.manager.get_url_for_download('foo_asset_id', 50))
+
+    def test_update_upload_status(self):
+        asyncio.run(self.manager.update_upload_status('foo_asset_id'))
+        self.client.put_object_tagging.assert_awaited_once()
+        self.assertTrue(self.s3_manager.readiness_cache.get('foo_asset_id'))
+
+    def test_update_upload_status_transient_failure(self):
+        self.manager.remember_uploaded('foo_asset_id')
+        self.manager.caller = mock.AsyncMock(side_effect=boto_exc.ClientError(
+            error_response={'Error': {'Code': 'SlowDown'}},
+            operation_name='foo'))
+        self.assertRaises(
+            exceptions.AssetError, asyncio.run,
+            self.manager.update_upload_status('foo_asset_id'))
+        self.assertTrue(self.s3_manager.readiness_cache.get('foo_asset_id'))
+
+    def test_remember_uploaded_during_lookup(self):
+        async def get_object_tagging(**kwargs):
+            self.manager.remember_uploaded('foo_asset_id')
+            return {'TagSet': []}
+
+        self.client.get_object_tagging.side_effect = get_object_tagging
+        self.assertIsNone(asyncio.run(
+            self.manager.get_url_for_download('foo_asset_id', 50)))
+        self.assertTrue(self.s3_manager.readiness_cache.get('foo_asset_id'))
+
+    def test_get_urls_for_download(self):
+        self.client.get_object_tagging.side_effect = [
+            {'TagSet': []},
+            boto_exc.ClientError(
+                error_response={'Error': {'Code': 'AccessDenied'}},
+                operation_name='foo')]
+        results = asyncio.run(
+            self.manager.get_urls_for_download(['foo', 'bar'], 50))
+        self.assertEqual((None, None), results[0])
+        self.assertIsInstance(
+            results[1][1], exceptions.AssetAccessDeniedError)
+
+    def test_open_download(self):
+        self.client.get_object = mock.AsyncMock(return_value={
+            'Body': mock.Mock(), 'ContentRange': 'bytes 0-9/100'})
+        download = asyncio.run(self.manager.open_download('foo', 'bytes=0-9'))
+        self.assertIsInstance(download, aio.AsyncDownload)
+        self.assertEqual(206, download.status)
+        self.client.get_object.side_effect = boto_exc.ClientError(
+            error_response={'Error': {'Code': '304'}},
+            operation_name='GetObject')
+        download = asyncio.run(self.manager.open_download(
+            'foo', if_none_match='"etag"'))
+        self.assertEqual(304, download.status)
+
+    def test_timed(self):
+        self.client.get_object = mock.AsyncMock(
+            return_value={'Body': mock.Mock()})
+        self.client.list_objects_v2 = mock.AsyncMock(return_value={})
+        self.client.create_multipart_upload = mock.AsyncMock(
+            return_value={'UploadId': 'upload'})
+        self.client.list_parts = mock.AsyncMock(return_value={'Parts': [
+            {'PartNumber': 1, 'ETag': '"etag"', 'Size': 10}]})
+        self.client.complete_multipart_upload = mock.AsyncMock()
+        self.client.abort_multipart_upload = mock.AsyncMock()
+        for name, args in [('get_url_for_upload', ('foo',)),
+                           ('get_urls_for_upload', (['foo'],)),
+                           ('update_upload_status', ('foo',)),
+                           ('get_url_for_download', ('foo', 50)),
+                           ('get_urls_for_download', (['foo'], 50)),
+                           ('get_upload_status', ('foo',)),
+                           ('open_download', ('foo',)),
+                           ('list_assets', (10,)),
+                           ('create_multipart_upload', ('foo',)),
+                           ('list_parts', ('foo', 'upload')),
+                           ('complete_multipart_upload', ('foo', 'upload')),
+                           ('abort_multipart_upload', ('foo', 'upload'))]:
+            with mock.patch('s3uploader.metrics._Timing') as timing:
+                asyncio.run(getattr(self.manager, name)(*args))
+            operations = [c[0][0] for c in timing.call_args_list]
+            # timed once, under its own name, before what it calls
+            self.assertEqual(name, operations[0])
+            self.assertEqual(1, operations.count(name))
+
+    def test_complete_multipart_upload(self):
+        self.client.list_parts = mock.AsyncMock(return_value={'Parts': [
+            {'PartNumber': 1, 'ETag': '"etag"', 'Size': 10}]})
+        self.client.complete_multipart_upload = mock.AsyncMock()
+        self.assertEqual(10, asyncio.run(
+            self.manager.complete_multipart_upload('foo', 'upload', 10)))
+        self.client.complete_multipart_upload.assert_awaited_once_with(
+            Bucket=self.s3_manager.config.bucket, Key='foo',
+            UploadId='upload', MultipartUpload={'Parts': [
+                {'PartNumber': 1, 'ETag': '"etag"'}]})
+        self.assertRaises(
+            exceptions.AssetUploadIncompleteError, asyncio.run,
+            self.manager.complete_multipart_upload('foo', 'upload', 20))
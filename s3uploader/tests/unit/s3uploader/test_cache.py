@@ -0,0 +1,157 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import mock
+import testtools
+
+from s3uploader import cache
+from s3uploader import metrics
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestLRUCache(testtools.TestCase):
+
+    def setUp(self):
+        super(TestLRUCache, self).setUp()
+        self.clock = FakeClock()
+        self.cache = cache.LRUCache(2, clock=self.clock, name='foo')
+        metrics.CACHE_EVENTS.clear()
+        metrics.CACHE_SIZE.clear()
+
+    def test_get_missing(self):
+        self.assertIsNone(self.cache.get('foo'))
+
+    def test_get_expired(self):
+        self.cache.set('foo', 'bar', 10)
+        self.assertEqual('bar', self.cache.get('foo'))
+        self.clock.now += 10
+        self.assertIsNone(self.cache.get('foo'))
+        self.assertEqual(0, len(self.cache))
+
+    def test_evicts_least_recently_used(self):
+        self.cache.set('foo', 1, 10)
+        self.cache.set('bar', 2, 10)
+        self.cache.get('foo')
+        self.cache.set('baz', 3, 10)
+        self.assertIsNone(self.cache.get('bar'))
+        self.assertEqual(1, self.cache.get('foo'))
+        self.assertEqual(1, metrics.CACHE_EVENTS.value('foo', 'eviction'))
+        self.assertEqual(2, metrics.CACHE_SIZE.value('foo'))
+
+    def test_delete(self):
+        self.cache.set('foo', 1, 10)
+        self.assertEqual(1, metrics.CACHE_SIZE.value('foo'))
+        self.cache.delete('foo')
+        self.cache.delete('foo')
+        self.assertIsNone(self.cache.get('foo'))
+        self.assertEqual(0, metrics.CACHE_SIZE.value('foo'))
+
+    def test_add(self):
+        self.assertTrue(self.cache.add('foo', 1, 10))
+        self.assertFalse(self.cache.add('foo', 2, 10))
+        self.assertEqual(1, self.cache.get('foo'))
+        self.clock.now += 10
+        self.assertTrue(self.cache.add('foo', 2, 10))
+        self.assertEqual(2, self.cache.get('foo'))
+
+    def test_invalid_size(self):
+        self.assertRaises(ValueError, cache.LRUCache, 0)
+
+
+class TestReadinessCache(testtools.TestCase):
+
+    def setUp(self):
+        super(TestReadinessCache, self).setUp()
+        self.clock = FakeClock()
+        self.cache = cache.ReadinessCache(
+            cache.LRUCache(10, clock=self.clock), 100, 5)
+        metrics.CACHE_EVENTS.clear()
+
+    def test_ttls(self):
+        self.cache.set('ready', True)
+        self.cache.set('not_ready', False)
+        self.assertTrue(self.cache.get('ready'))
+        self.assertFalse(self.cache.get('not_ready'))
+        self.clock.now += 5
+        self.assertTrue(self.cache.get('ready'))
+        self.assertIsNone(self.cache.get('not_ready'))
+
+    def test_observe(self):
+        self.cache.observe('foo', False)
+        self.assertFalse(self.cache.get('foo'))
+        self.cache.observe('foo', True)
+        self.assertTrue(self.cache.get('foo'))
+        # a lookup started before the upload was completed
+        self.cache.observe('foo', False)
+        self.assertTrue(self.cache.get('foo'))
+
+    def test_metrics(self):
+        self.cache.get('foo')
+        self.cache.set('foo', True)
+        self.cache.get('foo')
+        self.assertEqual(1, metrics.CACHE_EVENTS.value('readiness', 'hit'))
+        self.assertEqual(1, metrics.CACHE_EVENTS.value('readiness', 'miss'))
+
+    def test_redis_backend(self):
+        client = mock.Mock()
+        client.get.return_value = b'1'
+        readiness_cache = cache.ReadinessCache(
+            cache.RedisBackend(client), 100, 5)
+        readiness_cache.set('foo', False)
+        client.setex.assert_called_once_with('s3uploader:foo', 5, '0')
+        self.assertTrue(readiness_cache.get('foo'))
+        readiness_cache.invalidate('foo')
+        client.delete.assert_called_once_with('s3uploader:foo')
+        readiness_cache.observe('foo', False)
+        client.set.assert_called_once_with('s3uploader:foo', '0', ex=5,
+                                           nx=True)
+
+
+class TestPresignedURLCache(testtools.TestCase):
+
+    def setUp(self):
+        super(TestPresignedURLCache, self).setUp()
+        self.clock = FakeClock()
+        self.cache = cache.PresignedURLCache(
+            cache.LRUCache(10, clock=self.clock), 0.8, clock=self.clock)
+
+    def test_reused_while_valid_enough(self):
+        self.assertIsNone(self.cache.get('foo', 100))
+        self.cache.set('foo', 100, 'foo_url')
+        self.clock.now += 19
+        self.assertEqual(('foo_url', 1100.0), self.cache.get('foo', 100))
+        self.clock.now += 1
+        self.assertIsNone(self.cache.get('foo', 100))
+
+    def test_metrics(self):
+        metrics.CACHE_EVENTS.clear()
+        self.cache.get('foo', 100)
+        self.cache.set('foo', 100, 'foo_url')
+        self.cache.get('foo', 100)
+        self.assertEqual(1, metrics.CACHE_EVENTS.value('url', 'hit'))
+        self.assertEqual(1, metrics.CACHE_EVENTS.value('url', 'miss'))
+
+    def test_keyed_by_timeout(self):
+        self.cache.set('foo', 100, 'foo_url')
+        self.assertIsNone(self.cache.get('foo', 50))
+
+    def test_invalid_min_validity(self):
+        self.assertRaises(ValueError, cache.PresignedURLCache,
+                          cache.LRUCache(10), 1)
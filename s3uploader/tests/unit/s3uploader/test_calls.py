@@ -0,0 +1,274 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import asyncio
+import threading
+
+from botocore import exceptions as boto_exc
+import mock
+import testtools
+
+from s3uploader import calls
+from s3uploader import exceptions
+from s3uploader import metrics
+
+
+def _client_error(code, status=400):
+    return boto_exc.ClientError(
+        error_response={'Error': {'Code': code},
+                        'ResponseMetadata': {'HTTPStatusCode': status}},
+        operation_name='foo')
+
+
+class TestIsRetryable(testtools.TestCase):
+
+    def test_is_retryable(self):
+        self.assertTrue(calls.is_retryable(_client_error('SlowDown', 503)))
+        self.assertTrue(calls.is_retryable(_client_error('Foo', 500)))
+        self.assertTrue(calls.is_retryable(
+            boto_exc.EndpointConnectionError(endpoint_url='foo')))
+        self.assertTrue(calls.is_retryable(
+            boto_exc.ReadTimeoutError(endpoint_url='foo')))
+        self.assertFalse(calls.is_retryable(_client_error('NoSuchKey', 404)))
+        self.assertFalse(calls.is_retryable(ValueError()))
+
+
+class TestLatencyTracker(testtools.TestCase):
+
+    def test_threshold(self):
+        tracker = calls.LatencyTracker(percentile=90, window=100,
+                                       min_samples=64, initial_delay=0.5,
+                                       min_delay=0.001)
+        for i in range(63):
+            tracker.observe('foo', i / 1000.0)
+        self.assertEqual(0.5, tracker.threshold('foo'))
+        for i in range(63, 128):
+            tracker.observe('foo', i / 1000.0)
+        # the last 100 samples, 28 to 127ms
+        self.assertEqual(0.118, tracker.threshold('foo'))
+        self.assertEqual(0.5, tracker.threshold('bar'))
+
+    def test_threshold_min_delay(self):
+        tracker = calls.LatencyTracker(min_samples=1, min_delay=0.01)
+        for _ in range(tracker.REFRESH_EVERY):
+            tracker.observe('foo', 0.0001)
+        self.assertEqual(0.01, tracker.threshold('foo'))
+
+
+class TestCaller(testtools.TestCase):
+
+    def setUp(self):
+        super(TestCaller, self).setUp()
+        self.client = mock.Mock()
+        self.sleep = mock.Mock()
+        self.caller = calls.Caller(
+            self.client,
+            read_policy=calls.CallPolicy(1, 2, 0.01, hedge=True),
+            write_policy=calls.CallPolicy(1, 2, 0.01),
+            tracker=calls.LatencyTracker(initial_delay=0.01),
+            sleep=self.sleep)
+        metrics.S3_CALL_EVENTS.clear()
+
+    def test_read(self):
+        self.client.get_object_tagging.return_value = 'tags'
+        self.assertEqual('tags', self.caller('get_object_tagging',
+                                             Bucket='foo', Key='bar'))
+        self.client.get_object_tagging.assert_called_once_with(
+            Bucket='foo', Key='bar')
+
+    def test_read_hedged(self):
+        release = threading.Event()
+        answers = iter(['slow', 'fast'])
+
+        def get_object_tagging(**kwargs):
+            answer = next(answers)
+            if answer == 'slow':
+                release.wait(5)
+            return answer
+
+        self.client.get_object_tagging.side_effect = get_object_tagging
+        self.assertEqual('fast', self.caller('get_object_tagging'))
+        release.set()
+        self.assertEqual(
+            1, metrics.S3_CALL_EVENTS.value('get_object_tagging', 'hedged'))
+
+    def test_read_hedged_closes_loser(self):
+        release = threading.Event()
+        closed = threading.Event()
+        slow, fast = mock.Mock(), mock.Mock()
+        slow.close.side_effect = closed.set
+        answers = iter([slow, fast])
+
+        def get_object(**kwargs):
+            body = next(answers)
+            if body is slow:
+                release.wait(5)
+            return {'Body': body}
+
+        self.client.get_object.side_effect = get_object
+        self.assertIs(fast, self.caller('get_object')['Body'])
+        release.set()
+        self.assertTrue(closed.wait(5))
+        self.assertFalse(fast.close.called)
+
+    def test_read_hedged_first_error(self):
+        release = threading.Event()
+        answers = iter(['slow', 'error'])
+
+        def get_object_tagging(**kwargs):
+            answer = next(answers)
+            if answer == 'error':
+                release.set()
+                raise _client_error('NoSuchKey', 404)
+            release.wait(5)
+            return answer
+
+        self.client.get_object_tagging.side_effect = get_object_tagging
+        # the error of the hedged attempt does not fail the slow one
+        self.assertEqual('slow', self.caller('get_object_tagging'))
+
+    def test_read_deadline(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+        self.client.list_parts.side_effect = lambda **kwargs: release.wait(5)
+        self.caller.deadlines['list_parts'] = 0.05
+        self.assertRaises(exceptions.AssetTimeoutError,
+                          self.caller, 'list_parts')
+        self.assertEqual(
+            1, metrics.S3_CALL_EVENTS.value('list_parts',
+                                            'deadline_exceeded'))
+
+    def test_read_saturated(self):
+        self.caller.workers = 1
+        started = threading.Event()
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def get_object_tagging(**kwargs):
+            if threading.current_thread() is threading.main_thread():
+                return 'tags'
+            started.set()
+            release.wait(5)
+            return 'slow'
+
+        self.client.get_object_tagging.side_effect = get_object_tagging
+        results = []
+        slow = threading.Thread(target=lambda: results.append(
+            self.caller('get_object_tagging')))
+        slow.start()
+        started.wait(5)
+        # past the hedging delay: there is no worker left to hedge with
+        threading.Event().wait(0.05)
+        # nor to queue on, the call is attempted in the calling thread
+        self.assertEqual('tags', self.caller('get_object_tagging'))
+        release.set()
+        slow.join(5)
+        self.assertEqual(['slow'], results)
+        self.assertEqual(
+            0, metrics.S3_CALL_EVENTS.value('get_object_tagging', 'hedged'))
+        self.assertEqual(
+            1, metrics.S3_CALL_EVENTS.value('get_object_tagging',
+                                            'saturated'))
+
+    def test_read_client(self):
+        self.caller.read_client = mock.Mock()
+        self.caller.read_client.get_object_tagging.return_value = 'tags'
+        self.assertEqual('tags', self.caller('get_object_tagging'))
+        self.caller('put_object_tagging')
+        self.assertFalse(self.client.get_object_tagging.called)
+        self.client.put_object_tagging.assert_called_once_with()
+
+    def test_read_retried(self):
+        self.client.get_object_tagging.side_effect = [
+            _client_error('SlowDown', 503), 'tags']
+        self.assertEqual('tags', self.caller('get_object_tagging'))
+        self.assertEqual(1, self.sleep.call_count)
+        self.assertEqual(
+            1, metrics.S3_CALL_EVENTS.value('get_object_tagging', 'retried'))
+
+    def test_read_not_retried(self):
+        error = _client_error('NoSuchKey', 404)
+        self.client.get_object_tagging.side_effect = error
+        e = self.assertRaises(boto_exc.ClientError,
+                              self.caller, 'get_object_tagging')
+        self.assertIs(error, e)
+        self.client.get_object_tagging.assert_called_once_with()
+
+    def test_write_retries_exhausted(self):
+        self.client.put_object_tagging.side_effect = (
+            boto_exc.EndpointConnectionError(endpoint_url='foo'))
+        self.assertRaises(boto_exc.EndpointConnectionError,
+                          self.caller, 'put_object_tagging', Key='foo')
+        self.assertEqual(3, self.client.put_object_tagging.call_count)
+
+    def test_write_retries_past_deadline(self):
+        self.caller._clock = mock.Mock(side_effect=[0, 2])
+        self.client.put_object_tagging.side_effect = (
+            _client_error('SlowDown', 503))
+        self.assertRaises(exceptions.AssetTimeoutError,
+                          self.caller, 'put_object_tagging')
+        self.client.put_object_tagging.assert_called_once_with()
+        self.assertFalse(self.sleep.called)
+
+
+class TestAsyncCaller(testtools.TestCase):
+
+    def setUp(self):
+        super(TestAsyncCaller, self).setUp()
+        self.client = mock.Mock()
+        self.caller = calls.AsyncCaller(
+            self.client,
+            read_policy=calls.CallPolicy(1, 2, 0.001, hedge=True),
+            tracker=calls.LatencyTracker(initial_delay=0.01))
+        metrics.S3_CALL_EVENTS.clear()
+
+    def test_read_hedged(self):
+        delays = iter([5, 0])
+        cancelled = []
+
+        async def get_object_tagging(**kwargs):
+            delay = next(delays)
+            try:
+                await asyncio.sleep(delay)
+            except asyncio.CancelledError:
+                cancelled.append(delay)
+                raise
+            return delay
+
+        self.client.get_object_tagging = get_object_tagging
+        self.assertEqual(
+            0, asyncio.run(self.caller('get_object_tagging', Key='foo')))
+        self.assertEqual([5], cancelled)
+
+    def test_read_deadline(self):
+        async def list_parts(**kwargs):
+            await asyncio.sleep(5)
+
+        self.client.list_parts = list_parts
+        self.caller.deadlines['list_parts'] = 0.05
+        self.assertRaises(exceptions.AssetTimeoutError, asyncio.run,
+                          self.caller('list_parts'))
+
+    def test_write_retried(self):
+        answers = [_client_error('InternalError', 500), 'done']
+
+        async def put_object_tagging(**kwargs):
+            answer = answers.pop(0)
+            if isinstance(answer, Exception):
+                raise answer
+            return answer
+
+        self.client.put_object_tagging = put_object_tagging
+        self.assertEqual(
+            'done', asyncio.run(self.caller('put_object_tagging')))
+        self.assertEqual(
+            1, metrics.S3_CALL_EVENTS.value('put_object_tagging', 'retried'))
@@ -0,0 +1,219 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+import mock
+import testtools
+import urllib3
+
+from s3uploader import client
+
+
+class Response(object):
+
+    def __init__(self, status, data=b'', headers=None):
+        self.status = status
+        self.data = data
+        self.headers = headers or {}
+
+
+class FakeHTTP(object):
+    """The API and S3, as seen by the client."""
+
+    def __init__(self):
+        self.objects = {}
+        self.parts = {}
+        self.requests = []
+        self.failures = []
+        self._lock = threading.Lock()
+
+    def request(self, method, url, body=None, headers=None, **kwargs):
+        if hasattr(body, 'read'):
+            body = b''.join(iter(lambda: body.read(1000), b''))
+        with self._lock:
+            self.requests.append((method, url))
+            if self.failures:
+                failure = self.failures.pop(0)
+                if isinstance(failure, Exception):
+                    raise failure
+                return Response(failure, b'{"message": "nope"}')
+        if url.startswith('http://api'):
+            return self._api(method, url[len('http://api'):],
+                             json.loads(body.decode('utf-8')) if body else {})
+        return self._s3(method, url[len('http://s3/'):], body, headers)
+
+    def _json(self, data):
+        return Response(200, json.dumps(data).encode('utf-8'))
+
+    def _api(self, method, path, content):
+        if method == 'POST' and path == '/asset':
+            asset_id = 'asset%d' % len(self.requests)
+            return self._json({'id': asset_id, 'upload_url': {
+                'url': 'http://s3/', 'fields': {'key': asset_id}}})
+        if method == 'POST' and path == '/asset:multipart':
+            part_size = content['part_size']
+            count = max(-(-content['size'] // part_size), 1)
+            return self._json({
+                'id': 'big', 'upload_id': 'upload', 'part_size': part_size,
+                'parts': [{'part_number': n,
+                           'upload_url': 'http://s3/big?partNumber=%d' % n}
+                          for n in range(1, count + 1)]})
+        if method == 'PUT' and path == '/asset/big/multipart/upload':
+            self.objects['big'] = b''.join(
+                self.parts[n] for n in sorted(self.parts))
+            return self._json('done')
+        if method == 'GET':
+            asset_id = path.split('/')[2].split('?')[0]
+            return self._json({'download_url': 'http://s3/' + asset_id})
+        return self._json('done')
+
+    def _s3(self, method, path, body, headers):
+        if method == 'POST':
+            # a form: pick the key and the file out of it
+            boundary = headers['Content-Type'].split('boundary=')[1]
+            parts = body.split(b'--' + boundary.encode())
+            key = parts[1].split(b'\r\n\r\n')[1][:-2].decode()
+            self.objects[key] = parts[2].split(b'\r\n\r\n', 1)[1][:-2]
+            return Response(204)
+        if method == 'PUT':
+            self.parts[int(path.split('partNumber=')[1])] = body
+            return Response(200)
+        data = self.objects.get(path)
+        if data is None:
+            return Response(404, b'NoSuchKey')
+        start, end = headers['Range'][6:].split('-')
+        start, end = int(start), min(int(end), len(data) - 1)
+        if start >= len(data):
+            return Response(416)
+        return Response(206, data[start:end + 1], {
+            'Content-Range': 'bytes %d-%d/%d' % (start, end, len(data))})
+
+
+class TestReader(testtools.TestCase):
+
+    def test_read(self):
+        reader = client._Reader(b'ab', (b'xcdefx', 1, 5), b'', b'g')
+        self.assertEqual(7, len(reader))
+        self.assertEqual([b'ab', b'cde', b'f', b'g', b''],
+                         [reader.read(3) for _ in range(5)])
+
+
+class TestClient(testtools.TestCase):
+
+    def setUp(self):
+        super(TestClient, self).setUp()
+        self.http = FakeHTTP()
+        self.client = client.Client(
+            'http://api', concurrency=4, retries=2, part_size=10,
+            multipart_threshold=25, chunk_size=7, http=self.http)
+        self.addCleanup(self.client.close)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        mock.patch('time.sleep').start()
+        self.addCleanup(mock.patch.stopall)
+
+    def _file(self, name, data):
+        path = os.path.join(self.directory, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_upload_file(self):
+        asset_id = self.client.upload_file(self._file('foo', b'x' * 20))
+        self.assertEqual(b'x' * 20, self.http.objects[asset_id])
+        self.assertEqual(('PUT', 'http://api/asset/%s' % asset_id),
+                         self.http.requests[-1])
+
+    def test_upload_empty_file(self):
+        asset_id = self.client.upload_file(self._file('foo', b''))
+        self.assertEqual(b'', self.http.objects[asset_id])
+
+    def test_upload_file_in_parts(self):
+        data = os.urandom(95)
+        self.assertEqual('big', self.client.upload_file(
+            self._file('foo', data)))
+        self.assertEqual(10, len(self.http.parts))
+        self.assertEqual(data, self.http.objects['big'])
+        self.assertEqual(95, self.client.progress.done_bytes)
+
+    def test_upload_file_in_parts_failure_aborts(self):
+        original = self.http._s3
+
+        def _s3(method, path, body, headers):
+            if 'partNumber=3' in path:
+                return Response(403, b'denied')
+            return original(method, path, body, headers)
+
+        self.http._s3 = _s3
+        self.assertRaises(client.TransferError, self.client.upload_file,
+                          self._file('foo', b'x' * 95))
+        self.assertIn(('DELETE', 'http://api/asset/big/multipart/upload'),
+                      self.http.requests)
+
+    def test_upload_files(self):
+        paths = [self._file('foo%d' % i, b'x' * i) for i in range(5)]
+        results = list(self.client.upload_files(paths))
+        self.assertEqual(sorted(paths), sorted(r[0] for r in results))
+        self.assertTrue(all(r[1] and r[2] is None for r in results))
+        self.assertEqual(5, self.client.progress.done_files)
+
+    def test_retries(self):
+        self.http.failures = [503, urllib3.exceptions.ProtocolError()]
+        asset_id = self.client.upload_file(self._file('foo', b'x'))
+        self.assertEqual(b'x', self.http.objects[asset_id])
+        self.assertEqual([('POST', 'http://api/asset')] * 3,
+                         self.http.requests[:3])
+
+    def test_retries_exhausted(self):
+        self.http.failures = [503] * 3
+        e = self.assertRaises(client.TransferError, self.client.upload_file,
+                              self._file('foo', b'x'))
+        self.assertEqual(503, e.status)
+
+    def test_no_retry_on_client_error(self):
+        self.http.failures = [409]
+        self.assertRaises(client.TransferError, self.client.upload_file,
+                          self._file('foo', b'x'))
+        self.assertEqual(1, len(self.http.requests))
+
+    def test_download(self):
+        data = os.urandom(30)
+        self.http.objects['foo'] = data
+        path = os.path.join(self.directory, 'foo')
+        self.client.download('foo', path)
+        with open(path, 'rb') as f:
+            self.assertEqual(data, f.read())
+        # one request for the URL, and one per 7 bytes chunk
+        self.assertEqual(6, len(self.http.requests))
+
+    def test_download_empty(self):
+        self.http.objects['foo'] = b''
+        path = os.path.join(self.directory, 'foo')
+        self.client.download('foo', path)
+        self.assertEqual(0, os.path.getsize(path))
+
+    def test_download_assets(self):
+        self.http.objects.update(foo=b'foo' * 10, bar=b'bar')
+        results = sorted(self.client.download_assets(['foo', 'bar', 'baz'],
+                                                     self.directory))
+        self.assertEqual('bar', results[0][0])
+        self.assertIsNone(results[0][2])
+        self.assertEqual('baz', results[1][0])
+        self.assertIsNotNone(results[1][2])
+        self.assertEqual(1, self.client.progress.failed_files)
+        with open(os.path.join(self.directory, 'foo'), 'rb') as f:
+            self.assertEqual(b'foo' * 10, f.read())
@@ -0,0 +1,140 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import tempfile
+import threading
+
+import mock
+import testtools
+
+from s3uploader import exceptions
+from s3uploader import journal
+from s3uploader import metrics
+
+
+class TestJournal(testtools.TestCase):
+
+    def setUp(self):
+        super(TestJournal, self).setUp()
+        self.clock = mock.Mock(return_value=1000.0)
+        self.journal = journal.Journal(':memory:', clock=self.clock)
+
+    def test_claim(self):
+        self.journal.append('foo')
+        self.journal.append('bar')
+        entries = self.journal.claim(10, lease=60)
+        self.assertEqual(['foo', 'bar'], [entry[1] for entry in entries])
+        self.assertEqual([0, 0], [entry[2] for entry in entries])
+        # leased entries are not claimed twice
+        self.assertEqual([], self.journal.claim(10, lease=60))
+
+    def test_claim_limit(self):
+        for asset_id in ('foo', 'bar', 'baz'):
+            self.journal.append(asset_id)
+        self.assertEqual(2, len(self.journal.claim(2, lease=60)))
+        self.assertEqual(1, len(self.journal.claim(2, lease=60)))
+
+    def test_lease_expires(self):
+        self.journal.append('foo')
+        self.journal.claim(10, lease=60)
+        self.clock.return_value = 1060.0
+        self.assertEqual('foo', self.journal.claim(10, lease=60)[0][1])
+
+    def test_done(self):
+        self.journal.append('foo')
+        seq, _, _ = self.journal.claim(10, lease=60)[0]
+        self.journal.done(seq)
+        self.clock.return_value = 2000.0
+        self.assertEqual([], self.journal.claim(10, lease=60))
+        self.assertEqual((0, 0.0), self.journal.stats())
+
+    def test_retry(self):
+        self.journal.append('foo')
+        seq, _, _ = self.journal.claim(10, lease=60)[0]
+        self.journal.retry(seq, 5)
+        self.assertEqual([], self.journal.claim(10, lease=60))
+        self.clock.return_value = 1005.0
+        self.assertEqual([(seq, 'foo', 1)], self.journal.claim(10, lease=60))
+
+    def test_stats(self):
+        self.journal.append('foo')
+        self.clock.return_value = 1030.0
+        self.journal.append('bar')
+        self.assertEqual((2, 30.0), self.journal.stats())
+
+    def test_replay(self):
+        path = os.path.join(tempfile.mkdtemp(), 'journal.db')
+        journal.Journal(path, clock=self.clock).append('foo')
+        # e.g. after a crash
+        self.assertEqual('foo', journal.Journal(path).claim(10, 60)[0][1])
+
+
+class TestWriteBehind(testtools.TestCase):
+
+    def setUp(self):
+        super(TestWriteBehind, self).setUp()
+        self.journal = journal.Journal(':memory:')
+        self.apply = mock.Mock()
+        self.write_behind = journal.WriteBehind(
+            self.journal, self.apply, workers=2, poll_interval=0.01,
+            backoff=0)
+
+    def test_apply(self):
+        self.write_behind.append('foo')
+        self.write_behind.append('bar')
+        applied = threading.Event()
+        self.apply.side_effect = lambda asset_id: applied.set()
+        self.write_behind.start()
+        self.addCleanup(self.write_behind.stop)
+        self.assertTrue(applied.wait(5))
+        self.write_behind.stop()
+        self.assertEqual(set(['foo', 'bar']),
+                         set(c[0][0] for c in self.apply.call_args_list))
+        self.assertEqual(0, self.journal.stats()[0])
+
+    def test_run_once_bounded(self):
+        self.write_behind._executor = mock.Mock()
+        for asset_id in ('foo', 'bar', 'baz'):
+            self.write_behind.append(asset_id)
+        self.assertEqual(2, self.write_behind.run_once())
+        self.assertEqual(0, self.write_behind.run_once())
+
+    def test_retry(self):
+        self.apply.side_effect = [exceptions.AssetError(), None]
+        self.write_behind.append('foo')
+        entry = self.journal.claim(1, lease=60)[0]
+        self.write_behind._apply(*entry)
+        self.assertEqual(1, self.journal.stats()[0])
+        entry = self.journal.claim(1, lease=60)[0]
+        self.assertEqual(1, entry[2])
+        self.write_behind._apply(*entry)
+        self.assertEqual(0, self.journal.stats()[0])
+
+    def test_backoff_capped(self):
+        self.write_behind.backoff = 1
+        self.write_behind.max_backoff = 10
+        self.journal.retry = mock.Mock()
+        with mock.patch('random.uniform', side_effect=lambda a, b: b):
+            self.write_behind._retry(1, 'foo', 20, None)
+        self.journal.retry.assert_called_once_with(1, 10)
+
+    def test_drop_client_errors(self):
+        self.apply.side_effect = exceptions.AssetNotFoundError()
+        self.write_behind.append('foo')
+        self.write_behind._apply(*self.journal.claim(1, lease=60)[0])
+        self.assertEqual(0, self.journal.stats()[0])
+
+    def test_report(self):
+        self.write_behind.append('foo')
+        self.write_behind._report()
+        self.assertEqual(1, metrics.JOURNAL_DEPTH.value())
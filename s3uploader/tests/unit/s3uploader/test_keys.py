@@ -0,0 +1,108 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import uuid
+
+import mock
+import testtools
+
+from s3uploader import keys
+
+
+LEGACY_ID = 'b5f4a3c2-1e0d-4c9b-8a7f-6e5d4c3b2a19'
+
+
+class TestUUID7(testtools.TestCase):
+
+    def test_uuid7(self):
+        value = keys.uuid7(clock=lambda: 1500000000.123)
+        self.assertEqual(7, value.version)
+        self.assertEqual(uuid.RFC_4122, value.variant)
+        self.assertEqual(1500000000123, value.int >> 80)
+
+    def test_uuid7_ordered(self):
+        clock = mock.Mock(side_effect=[1.0, 1.5, 2.0])
+        values = [str(keys.uuid7(clock)) for _ in range(3)]
+        self.assertEqual(sorted(values), values)
+
+    def test_uuid7_floor(self):
+        value = keys.uuid7(clock=lambda: 1500000000.123)
+        self.assertLess(keys.uuid7_floor(1500000000.123), value)
+        self.assertGreater(keys.uuid7_floor(1500000000.124), value)
+
+    def test_is_uuid7(self):
+        value = str(keys.uuid7())
+        self.assertTrue(keys.is_uuid7(value))
+        self.assertFalse(keys.is_uuid7(value.upper()))
+        self.assertFalse(keys.is_uuid7(value.replace('-', '')))
+        self.assertFalse(keys.is_uuid7(LEGACY_ID))
+        self.assertFalse(keys.is_uuid7('foo'))
+
+    def test_uuid7_timestamp(self):
+        value = str(keys.uuid7(clock=lambda: 1500000000.123))
+        self.assertEqual(1500000000.123, keys.uuid7_timestamp(value))
+        self.assertIsNone(keys.uuid7_timestamp(LEGACY_ID))
+
+
+class TestFlatLayout(testtools.TestCase):
+
+    def test_layout(self):
+        layout = keys.FlatLayout()
+        asset_id = layout.new_id()
+        self.assertEqual(4, uuid.UUID(asset_id).version)
+        self.assertEqual(asset_id, layout.key(asset_id))
+        self.assertEqual(asset_id, layout.asset_id(asset_id))
+        self.assertEqual([{}], list(layout.ranges(since=1000.0)))
+
+
+class TestShardedLayout(testtools.TestCase):
+
+    def setUp(self):
+        super(TestShardedLayout, self).setUp()
+        self.layout = keys.ShardedLayout(2)
+
+    def test_key(self):
+        asset_id = self.layout.new_id()
+        key = self.layout.key(asset_id)
+        prefix, _, tail = key.partition('/')
+        self.assertEqual(asset_id, tail)
+        self.assertEqual(2, len(prefix))
+        self.assertIn(prefix, self.layout.prefixes())
+        self.assertEqual(asset_id, self.layout.asset_id(key))
+
+    def test_key_spread(self):
+        prefixes = set(self.layout.key(self.layout.new_id()).split('/')[0]
+                       for _ in range(2000))
+        self.assertGreater(len(prefixes), 200)
+
+    def test_legacy_key(self):
+        self.assertEqual(LEGACY_ID, self.layout.key(LEGACY_ID))
+        self.assertEqual(LEGACY_ID, self.layout.asset_id(LEGACY_ID))
+
+    def test_asset_id_foreign_key(self):
+        asset_id = self.layout.new_id()
+        self.assertIsNone(self.layout.asset_id('zz/' + asset_id))
+        self.assertIsNone(self.layout.asset_id('logs/' + LEGACY_ID))
+
+    def test_invalid_prefix_length(self):
+        self.assertRaises(ValueError, keys.ShardedLayout, 0)
+        self.assertRaises(ValueError, keys.ShardedLayout, 5)
+
+    def test_ranges(self):
+        self.assertEqual([{}], list(self.layout.ranges()))
+        ranges = list(self.layout.ranges(since=1500000000.123))
+        self.assertEqual(257, len(ranges))
+        self.assertEqual({'delimiter': '/'}, ranges[0])
+        floor = str(keys.uuid7_floor(1500000000.123))
+        self.assertEqual({'prefix': '00/', 'start_after': '00/' + floor},
+                         ranges[1])
+        self.assertEqual('ff/', ranges[-1]['prefix'])
@@ -0,0 +1,147 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import asyncio
+
+import mock
+import testtools
+
+from s3uploader import exceptions
+from s3uploader import metrics
+
+
+class TestMetrics(testtools.TestCase):
+
+    def test_counter(self):
+        counter = metrics.Counter('foo_total', 'Foos.', ('code',))
+        counter.inc('NoSuchKey')
+        counter.inc('NoSuchKey')
+        self.assertEqual(2, counter.value('NoSuchKey'))
+        self.assertEqual(
+            '# HELP foo_total Foos.\n'
+            '# TYPE foo_total counter\n'
+            'foo_total{code="NoSuchKey"} 2.0', counter.render())
+
+    def test_gauge(self):
+        gauge = metrics.Gauge('foo', 'Foo.')
+        gauge.inc()
+        gauge.inc()
+        gauge.dec()
+        self.assertEqual(1, gauge.value())
+
+    def test_histogram(self):
+        histogram = metrics.Histogram('foo_seconds', 'Foo.', ('op',),
+                                      buckets=(0.1, 1))
+        histogram.observe(0.05, 'get')
+        histogram.observe(0.5, 'get')
+        histogram.observe(5, 'get')
+        self.assertEqual(3, histogram.count('get'))
+        self.assertEqual(
+            '# HELP foo_seconds Foo.\n'
+            '# TYPE foo_seconds histogram\n'
+            'foo_seconds_bucket{op="get",le="0.1"} 1\n'
+            'foo_seconds_bucket{op="get",le="1.0"} 2\n'
+            'foo_seconds_bucket{op="get",le="+Inf"} 3\n'
+            'foo_seconds_sum{op="get"} 5.55\n'
+            'foo_seconds_count{op="get"} 3', histogram.render())
+
+    def test_label_escaping(self):
+        counter = metrics.Counter('foo_total', 'Foos.', ('code',))
+        counter.inc('a"b\\c\n')
+        self.assertIn(r'{code="a\"b\\c\n"}', counter.render())
+
+
+class TestInstrumentation(testtools.TestCase):
+
+    def setUp(self):
+        super(TestInstrumentation, self).setUp()
+        metrics.REGISTRY.clear()
+        self.addCleanup(metrics.REGISTRY.clear)
+        self.addCleanup(metrics.configure_slow_log, 0)
+
+    def test_timed(self):
+        @metrics.timed('foo')
+        def foo(fail=False):
+            if fail:
+                raise exceptions.AssetNotFoundError()
+            return 'bar'
+
+        self.assertEqual('bar', foo())
+        self.assertRaises(exceptions.AssetNotFoundError, foo, fail=True)
+        self.assertEqual(
+            1, metrics.S3_OPERATION_SECONDS.count('foo', 'ok'))
+        self.assertEqual(1, metrics.S3_OPERATION_SECONDS.count(
+            'foo', 'AssetNotFoundError'))
+
+    def test_timed_coroutine(self):
+        @metrics.timed('foo')
+        async def foo():
+            return 'bar'
+
+        self.assertEqual('bar', asyncio.run(foo()))
+        self.assertEqual(
+            1, metrics.S3_OPERATION_SECONDS.count('foo', 'ok'))
+
+    def test_request_timer(self):
+        with metrics.RequestTimer('/asset', 'POST') as timer:
+            self.assertEqual(
+                1, metrics.REQUESTS_IN_FLIGHT.value('/asset', 'POST'))
+            timer.status = 409
+        self.assertEqual(
+            0, metrics.REQUESTS_IN_FLIGHT.value('/asset', 'POST'))
+        self.assertEqual(
+            1, metrics.REQUEST_SECONDS.count('/asset', 'POST', '409'))
+
+    def test_request_timer_error(self):
+        def serve(e):
+            with metrics.RequestTimer('/asset', 'POST'):
+                raise e
+
+        self.assertRaises(exceptions.AssetAccessDeniedError, serve,
+                          exceptions.AssetAccessDeniedError())
+        self.assertRaises(ValueError, serve, ValueError())
+        self.assertEqual(
+            1, metrics.REQUEST_SECONDS.count('/asset', 'POST', '401'))
+        self.assertEqual(
+            1, metrics.REQUEST_SECONDS.count('/asset', 'POST', '500'))
+
+    @mock.patch.object(metrics.LOG, 'warning')
+    def test_slow_log(self, warning):
+        metrics.configure_slow_log(1e-9, sample_rate=1)
+
+        @metrics.timed('inner')
+        def inner():
+            pass
+
+        @metrics.timed('outer')
+        def outer():
+            inner()
+
+        with metrics.RequestTimer('/asset', 'POST'):
+            outer()
+        warning.assert_called_once()
+        breakdown = warning.call_args[0][-1]
+        self.assertRegex(breakdown, r'^outer [\d.]+ms \(inner [\d.]+ms\)$')
+
+    @mock.patch.object(metrics.LOG, 'warning')
+    def test_slow_log_not_sampled(self, warning):
+        metrics.configure_slow_log(1e-9, sample_rate=0)
+        with metrics.RequestTimer('/asset', 'POST'):
+            pass
+        warning.assert_not_called()
+
+    @mock.patch.object(metrics.LOG, 'warning')
+    def test_slow_log_fast_request(self, warning):
+        metrics.configure_slow_log(60, sample_rate=1)
+        with metrics.RequestTimer('/asset', 'POST'):
+            pass
+        warning.assert_not_called()
@@ -0,0 +1,180 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import datetime
+
+import mock
+import testtools
+
+from s3uploader.cmds import reconcile
+from s3uploader import exceptions
+from s3uploader import keys
+from s3uploader import state
+
+
+def _object(key, day=1, size=10):
+    return {'Key': key, 'Size': size,
+            'LastModified': datetime.datetime(
+                2017, 11, day, tzinfo=datetime.timezone.utc)}
+
+
+class TestReconciler(testtools.TestCase):
+
+    def setUp(self):
+        super(TestReconciler, self).setUp()
+        self.storage = mock.Mock()
+        self.pages = {
+            None: ([_object('foo'), _object('bar', day=3)], 'token1'),
+            'token1': ([_object('baz', day=5)], None),
+        }
+        self.storage.list_objects.side_effect = (
+            lambda page_size, continuation_token: self.pages[
+                continuation_token])
+        self.uploaded = {'foo': True, 'bar': False, 'baz': True}
+        self.storage.get_upload_status.side_effect = self.uploaded.get
+        self.store = state.SQLiteStateStore(':memory:')
+        self.clock = mock.Mock(return_value=1000.0)
+        self.reconciler = reconcile.Reconciler(
+            self.storage, self.store, workers=2, clock=self.clock)
+
+    def test_run(self):
+        self.assertEqual(3, self.reconciler.run())
+        self.assertTrue(self.store.get('foo').uploaded)
+        self.assertFalse(self.store.get('bar').uploaded)
+        self.assertEqual(10, self.store.get('baz').size)
+        self.assertEqual(
+            datetime.datetime(2017, 11, 5).replace(
+                tzinfo=datetime.timezone.utc).timestamp(),
+            self.store.get('baz').created_at)
+        self.assertEqual(3, self.reconciler.indexed)
+        self.assertIsNone(self.store.get_metadata(reconcile.TOKEN))
+
+    def test_run_skips_uploaded(self):
+        self.store.record(state.AssetState('foo', state.UPLOADED))
+        self.reconciler.run()
+        self.assertEqual(1, self.reconciler.skipped)
+        self.assertEqual(2, self.storage.get_upload_status.call_count)
+
+    def test_run_resumes(self):
+        self.store.set_metadata(reconcile.TOKEN, 'token1')
+        self.assertEqual(1, self.reconciler.run())
+        self.assertIsNone(self.store.get('foo'))
+        self.assertIsNotNone(self.store.get('baz'))
+
+    def test_run_restart(self):
+        self.store.set_metadata(reconcile.TOKEN, 'token1')
+        self.assertEqual(3, self.reconciler.run(resume=False))
+
+    def test_run_checkpoints_after_each_page(self):
+        self.pages['token1'] = exceptions.AssetError()
+
+        def list_objects(page_size, continuation_token):
+            page = self.pages[continuation_token]
+            if isinstance(page, Exception):
+                raise page
+            return page
+
+        self.storage.list_objects.side_effect = list_objects
+        self.assertRaises(exceptions.AssetError, self.reconciler.run)
+        self.assertEqual('token1', self.store.get_metadata(reconcile.TOKEN))
+        self.assertIsNotNone(self.store.get('foo'))
+
+    def test_run_incremental(self):
+        self.store.set_metadata(
+            reconcile.LAST_RUN_STARTED_AT,
+            repr(datetime.datetime(2017, 11, 2).replace(
+                tzinfo=datetime.timezone.utc).timestamp()))
+        self.reconciler.run(incremental=True)
+        self.assertIsNone(self.store.get('foo'))
+        self.assertEqual(2, self.reconciler.indexed)
+        self.assertEqual('1000.0', self.store.get_metadata(
+            reconcile.LAST_RUN_STARTED_AT))
+
+    def test_run_incremental_sharded(self):
+        layout = keys.ShardedLayout(1)
+        since = datetime.datetime(2017, 11, 2).replace(
+            tzinfo=datetime.timezone.utc).timestamp()
+        self.store.set_metadata(reconcile.LAST_RUN_STARTED_AT, repr(since))
+        new_id = str(keys.uuid7(clock=lambda: since + 86400))
+        pages = {
+            # root keys, created before switching layouts
+            ('', ''): [_object('foo', day=5)],
+            (layout.prefix(new_id) + '/', ''): [
+                _object(layout.key(new_id), day=3)],
+        }
+        listings = []
+
+        def list_objects(page_size, continuation_token, prefix='',
+                         start_after='', delimiter=''):
+            listings.append((prefix, start_after, delimiter))
+            return pages.get((prefix, delimiter and ''), []), None
+
+        self.storage.list_objects.side_effect = list_objects
+        self.uploaded[new_id] = True
+        self.reconciler.key_layout = layout
+        self.reconciler.lookback = 3600
+        self.assertEqual(2, self.reconciler.run(incremental=True))
+        self.assertEqual(17, len(listings))
+        self.assertEqual(('', '', '/'), listings[0])
+        self.assertEqual(
+            ('0/', '0/' + str(keys.uuid7_floor(since - 3600)), ''),
+            listings[1])
+        self.assertTrue(self.store.get('foo').uploaded)
+        self.assertTrue(self.store.get(new_id).uploaded)
+        # created when its ID was handed out, not when last modified
+        self.assertEqual(since + 86400, self.store.get(new_id).created_at)
+        self.assertIsNone(self.store.get_metadata(reconcile.RANGE))
+
+    def test_run_resumes_range(self):
+        self.reconciler.key_layout = keys.ShardedLayout(1)
+        self.store.set_metadata(reconcile.LAST_RUN_STARTED_AT, '0.0')
+        self.store.set_metadata(reconcile.RANGE, '16')
+        self.storage.list_objects.side_effect = None
+        self.storage.list_objects.return_value = ([], None)
+        self.reconciler.run(incremental=True)
+        self.assertEqual('f/', self.storage.list_objects.call_args[1][
+            'prefix'])
+        self.storage.list_objects.assert_called_once()
+
+    def test_run_skips_foreign_keys(self):
+        self.reconciler.key_layout = keys.ShardedLayout(1)
+        self.pages[None] = ([_object('logs/foo')], None)
+        self.assertEqual(1, self.reconciler.run())
+        self.assertEqual(1, self.reconciler.skipped)
+        self.assertFalse(self.storage.get_upload_status.called)
+
+    def test_run_tagging_failure(self):
+        self.storage.get_upload_status.side_effect = (
+            exceptions.AssetNotFoundError())
+        self.reconciler.run()
+        self.assertEqual(3, self.reconciler.failed)
+        self.assertIsNone(self.store.get('foo'))
+
+    def test_run_warms_readiness_cache(self):
+        self.reconciler.readiness_cache = mock.Mock()
+        self.reconciler.run()
+        self.reconciler.readiness_cache.observe.assert_any_call('foo', True)
+        self.reconciler.readiness_cache.observe.assert_any_call('bar', False)
+
+    def test_run_location(self):
+        self.reconciler.location = 'eu'
+        self.reconciler.readiness_cache = mock.Mock()
+        self.store.set_metadata(reconcile.TOKEN, 'token1')
+        self.assertEqual(3, self.reconciler.run())
+        self.assertTrue(self.store.get('eu.foo').uploaded)
+        self.assertIsNone(self.store.get('foo'))
+        self.storage.get_upload_status.assert_any_call('foo')
+        self.reconciler.readiness_cache.observe.assert_any_call('foo', True)
+        self.assertIsNotNone(self.store.get_metadata(
+            'eu.' + reconcile.LAST_RUN_STARTED_AT))
+        # the checkpoints of the other locations are left alone
+        self.assertEqual('token1', self.store.get_metadata(reconcile.TOKEN))
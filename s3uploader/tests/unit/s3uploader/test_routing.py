@@ -0,0 +1,219 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import asyncio
+import collections
+from concurrent import futures
+
+import mock
+import testtools
+from werkzeug import exceptions as werkzeug_exc
+
+from s3uploader import constants
+from s3uploader import exceptions
+from s3uploader import keys
+from s3uploader import routing
+from s3uploader import state
+
+
+LEGACY_ID = 'b5f4a3c2-1e0d-4c9b-8a7f-6e5d4c3b2a19'
+
+
+class TestPlacement(testtools.TestCase):
+
+    def test_split(self):
+        self.assertEqual(('eu', 'foo'), routing.split('eu.foo'))
+        self.assertEqual((None, LEGACY_ID), routing.split(LEGACY_ID))
+        self.assertEqual('eu.foo', routing.join('eu', 'foo'))
+        self.assertEqual('foo', routing.join(None, 'foo'))
+
+    def test_place_weighted(self):
+        placement = routing.Placement({'eu': 3, 'us': 1, 'eu-us': 0})
+        counts = collections.Counter(
+            placement.place(str(keys.uuid7())) for _ in range(4000))
+        self.assertEqual(set(['eu', 'us']), set(counts))
+        self.assertTrue(2700 < counts['eu'] < 3300, counts)
+
+    def test_place_consistent(self):
+        asset_ids = [str(keys.uuid7()) for _ in range(1000)]
+        before = routing.Placement({'eu': 1, 'us': 1})
+        after = routing.Placement({'eu': 1, 'us': 1, 'ap': 1})
+        # only the assets placed on the new location move
+        for asset_id in asset_ids:
+            self.assertIn(after.place(asset_id),
+                          (before.place(asset_id), 'ap'))
+
+    def test_no_weight(self):
+        self.assertRaises(ValueError, routing.Placement, {'eu': 0})
+
+    def test_routed_layout(self):
+        layout = routing.RoutedLayout(keys.FlatLayout(),
+                                      routing.Placement({'eu': 1}))
+        location, asset_id = routing.split(layout.new_id())
+        self.assertEqual('eu', location)
+        self.assertFalse(keys.is_uuid7(asset_id))
+
+
+def _manager(region):
+    manager = mock.Mock()
+    manager.config.region = region
+    return manager
+
+
+class TestRoutingManager(testtools.TestCase):
+
+    def setUp(self):
+        super(TestRoutingManager, self).setUp()
+        self.us = _manager('us-west-2')
+        self.us.executor = futures.ThreadPoolExecutor(2)
+        self.eu = _manager('eu-west-1')
+        self.eu_us = _manager('us-west-2')
+        self.clock = mock.Mock(return_value=2000000000.0)
+        self.manager = routing.RoutingManager(
+            {None: self.us, 'us': self.us, 'eu': self.eu,
+             'eu-us': self.eu_us},
+            replicas={'eu': ['eu-us']}, replication_lag=900,
+            clock=self.clock)
+        self.asset_id = str(keys.uuid7(clock=lambda: 1000000000.0))
+
+    def test_route(self):
+        self.manager.update_upload_status('eu.' + self.asset_id)
+        self.eu.update_upload_status.assert_called_once_with(self.asset_id)
+        self.manager.abort_multipart_upload('us.' + self.asset_id, 'upload')
+        self.us.abort_multipart_upload.assert_called_once_with(
+            self.asset_id, 'upload')
+
+    def test_remember_uploaded(self):
+        self.manager.remember_uploaded('eu.' + self.asset_id)
+        self.eu.remember_uploaded.assert_called_once_with(self.asset_id)
+
+    def test_open_download(self):
+        self.manager.open_download('eu.' + self.asset_id, 'bytes=0-9')
+        self.eu.open_download.assert_called_once_with(
+            self.asset_id, 'bytes=0-9', None, constants.PROXY_CHUNK_SIZE)
+
+    def test_route_legacy(self):
+        self.manager.get_url_for_upload(LEGACY_ID)
+        self.us.get_url_for_upload.assert_called_once_with(LEGACY_ID)
+
+    def test_route_unknown_location(self):
+        self.assertRaises(exceptions.AssetNotFoundError,
+                          self.manager.get_upload_status, 'ap.foo')
+
+    def test_get_url_for_download(self):
+        self.eu.get_url_for_download.return_value = 'eu_url'
+        self.assertEqual('eu_url', self.manager.get_url_for_download(
+            'eu.' + self.asset_id, 50, region='ap-south-1'))
+        self.eu.get_url_for_download.assert_called_once_with(
+            self.asset_id, 50)
+
+    def test_get_url_for_download_replica(self):
+        self.eu.get_upload_status.return_value = True
+        self.eu_us.presign_download.return_value = 'eu_us_url'
+        self.assertEqual('eu_us_url', self.manager.get_url_for_download(
+            'eu.' + self.asset_id, 50, region='us-west-2'))
+        self.eu.get_upload_status.assert_called_once_with(self.asset_id)
+        self.assertFalse(self.eu.presign_download.called)
+
+    def test_get_url_for_download_replica_not_ready(self):
+        self.eu.get_upload_status.return_value = False
+        self.assertIsNone(self.manager.get_url_for_download(
+            'eu.' + self.asset_id, 50, region='us-west-2'))
+        self.assertFalse(self.eu_us.presign_download.called)
+
+    def test_get_url_for_download_replication_lag(self):
+        self.clock.return_value = 1000000060.0
+        self.manager.get_url_for_download(
+            'eu.' + self.asset_id, 50, region='us-west-2')
+        self.eu.get_url_for_download.assert_called_once_with(
+            self.asset_id, 50)
+        self.assertFalse(self.eu_us.presign_download.called)
+
+    def test_get_url_for_download_replica_unknown_age(self):
+        self.manager.get_url_for_download(
+            'eu.' + LEGACY_ID, 50, region='us-west-2')
+        self.eu.get_url_for_download.assert_called_once_with(LEGACY_ID, 50)
+        self.assertFalse(self.eu_us.presign_download.called)
+
+    def test_get_urls_for_download(self):
+        self.eu.get_url_for_download.return_value = 'eu_url'
+        results = self.manager.get_urls_for_download(
+            ['eu.' + self.asset_id, 'ap.foo'], 50)
+        self.assertEqual(('eu_url', None), results[0])
+        self.assertIsInstance(results[1][1], exceptions.AssetNotFoundError)
+
+    def test_presign_download_replica(self):
+        self.manager.presign_download('eu.' + self.asset_id, 50,
+                                      region='us-west-2')
+        self.eu_us.presign_download.assert_called_once_with(
+            self.asset_id, 50)
+
+    def test_list_assets(self):
+        self.eu.list_assets.side_effect = [
+            ([state.AssetState('foo', None)], 'token'),
+            ([state.AssetState('bar', None)], None)]
+        self.us.list_assets.return_value = (
+            [state.AssetState('baz', None)], None)
+        pages = []
+        token = None
+        while True:
+            states, token = self.manager.list_assets(10, token)
+            pages.append(([s.asset_id for s in states], token))
+            if token is None:
+                break
+        # the replica is not listed, nor the default location twice
+        self.assertEqual([(['eu.foo'], 'eu:token'), (['eu.bar'], 'us:'),
+                          (['us.baz'], None)], pages)
+        self.assertEqual([mock.call(10, None), mock.call(10, 'token')],
+                         self.eu.list_assets.call_args_list)
+        self.us.list_assets.assert_called_once_with(10, None)
+        self.assertFalse(self.eu_us.list_assets.called)
+
+    def test_list_assets_invalid_token(self):
+        for token in ('token', 'eu-us:token', 'ap:token'):
+            self.assertRaises(werkzeug_exc.BadRequest,
+                              self.manager.list_assets, 10, token)
+
+
+class TestAsyncRoutingManager(testtools.TestCase):
+
+    def setUp(self):
+        super(TestAsyncRoutingManager, self).setUp()
+        self.eu = _manager('eu-west-1')
+        self.eu_us = _manager('us-west-2')
+        self.eu_us.s3_manager.batch_workers = 2
+        self.manager = routing.AsyncRoutingManager(
+            {None: self.eu_us, 'eu': self.eu, 'eu-us': self.eu_us},
+            replicas={'eu': ['eu-us']})
+        self.asset_id = str(keys.uuid7(clock=lambda: 1000000000.0))
+
+    def test_get_url_for_upload(self):
+        self.eu.get_url_for_upload = mock.AsyncMock(return_value='url')
+        self.assertEqual(['url'], asyncio.run(
+            self.manager.get_urls_for_upload(['eu.' + self.asset_id])))
+        self.eu.get_url_for_upload.assert_awaited_once_with(self.asset_id)
+
+    def test_get_urls_for_download_replica(self):
+        self.eu.get_upload_status = mock.AsyncMock(return_value=True)
+        self.eu_us.s3_manager.presign_download.return_value = 'eu_us_url'
+        results = asyncio.run(self.manager.get_urls_for_download(
+            ['eu.' + self.asset_id, 'ap.foo'], 50, region='us-west-2'))
+        self.assertEqual(('eu_us_url', None), results[0])
+        self.assertIsInstance(results[1][1], exceptions.AssetNotFoundError)
+
+    def test_list_assets(self):
+        self.eu.list_assets = mock.AsyncMock(
+            return_value=([state.AssetState('foo', None)], None))
+        states, token = asyncio.run(self.manager.list_assets(10))
+        self.assertEqual(['eu.foo'], [s.asset_id for s in states])
+        # the default location is a replica, it is not listed
+        self.assertIsNone(token)
@@ -10,12 +10,24 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+from concurrent import futures
+import datetime
+import threading
+
 from botocore import exceptions as boto_exc
 import mock
 import testtools
+from werkzeug import exceptions as werkzeug_exc
 
+from s3uploader import cache
+from s3uploader import constants
 from s3uploader import exceptions
+from s3uploader import keys
+from s3uploader import metrics
+from s3uploader import routing
 from s3uploader import s3
+from s3uploader import sigv4
+from s3uploader import state
 
 
 class TestAssetManager(testtools.TestCase):
@@ -37,12 +49,439 @@ class TestAssetManager(testtools.TestCase):
         self.storage_mock.update_upload_status.assert_called_once_with(
             'foo_asset_id')
 
+    def test_update_asset_write_behind(self):
+        self.manager.write_behind = mock.Mock()
+        self.manager.update_asset('foo_asset_id')
+        self.manager.write_behind.append.assert_called_once_with(
+            'foo_asset_id')
+        self.storage_mock.remember_uploaded.assert_called_once_with(
+            'foo_asset_id')
+        self.assertFalse(self.storage_mock.update_upload_status.called)
+
     def test_get_asset(self):
         self.storage_mock.get_url_for_download.return_value = 'foo_url'
         asset = self.manager.get_asset('foo_asset_id', 50)
         self.assertIsNotNone(asset)
         self.assertEqual('foo_url', asset.url)
 
+    def test_create_assets(self):
+        self.storage_mock.get_urls_for_upload.return_value = ['foo', 'bar']
+        assets = self.manager.create_assets(2)
+        self.assertEqual(['foo', 'bar'], [asset.url for asset in assets])
+        self.assertEqual(2, len(set(asset.asset_id for asset in assets)))
+
+    def test_get_assets(self):
+        error = exceptions.AssetNotFoundError()
+        self.storage_mock.get_urls_for_download.return_value = [
+            ('foo_url', None), (None, error)]
+        assets = self.manager.get_assets(['foo', 'bar'], 50)
+        self.assertEqual(['foo', 'bar'], [a.asset_id for a in assets])
+        self.assertEqual('foo_url', assets[0].url)
+        self.assertIs(error, assets[1].error)
+
+    def test_create_multipart_asset(self):
+        self.storage_mock.create_multipart_upload.return_value = 'upload'
+        self.storage_mock.get_urls_for_part_upload.return_value = [
+            'url1', 'url2', 'url3']
+        upload = self.manager.create_multipart_asset(
+            12 * 1024 * 1024, 5 * 1024 * 1024)
+        self.assertEqual('upload', upload.upload_id)
+        self.assertEqual(5 * 1024 * 1024, upload.part_size)
+        self.assertEqual([(1, 'url1'), (2, 'url2'), (3, 'url3')],
+                         upload.part_urls)
+        self.storage_mock.get_urls_for_part_upload.assert_called_once_with(
+            upload.asset_id, 'upload', range(1, 4),
+            constants.MULTIPART_URL_TIMEOUT)
+
+    def test_create_multipart_asset_raises_part_size(self):
+        size = constants.MULTIPART_MAX_SIZE
+        part_size, part_numbers = self.manager._plan_parts(size)
+        self.assertEqual(constants.MULTIPART_MAX_PARTS, len(part_numbers))
+        self.assertGreaterEqual(part_size * len(part_numbers), size)
+
+    def test_create_multipart_asset_empty(self):
+        part_size, part_numbers = self.manager._plan_parts(0)
+        self.assertEqual(range(1, 2), part_numbers)
+
+    def test_get_multipart_upload(self):
+        self.storage_mock.list_parts.return_value = [{'PartNumber': 1}]
+        self.storage_mock.get_urls_for_part_upload.return_value = ['url2']
+        upload = self.manager.get_multipart_upload('foo', 'upload', [2])
+        self.assertEqual([{'PartNumber': 1}], upload.parts)
+        self.assertEqual([(2, 'url2')], upload.part_urls)
+
+    def test_complete_multipart_asset(self):
+        self.storage_mock.complete_multipart_upload.return_value = 10
+        self.manager.complete_multipart_asset('foo', 'upload', 10)
+        self.storage_mock.complete_multipart_upload.assert_called_once_with(
+            'foo', 'upload', 10)
+        self.storage_mock.update_upload_status.assert_called_once_with('foo')
+
+    def test_open_download(self):
+        self.manager.proxy = True
+        self.storage_mock.get_upload_status.return_value = True
+        download = self.manager.open_download('foo', 'bytes=0-9', '"etag"')
+        self.assertIs(self.storage_mock.open_download.return_value, download)
+        self.storage_mock.open_download.assert_called_once_with(
+            'foo', 'bytes=0-9', '"etag"', constants.PROXY_CHUNK_SIZE)
+
+    def test_open_download_not_ready(self):
+        self.manager.proxy = True
+        self.storage_mock.get_upload_status.return_value = False
+        self.assertIsNone(self.manager.open_download('foo'))
+        self.assertFalse(self.storage_mock.open_download.called)
+
+    def test_list_assets(self):
+        self.storage_mock.list_assets.return_value = ([
+            state.AssetState('foo', state.UPLOADED, created_at=100.0),
+            state.AssetState('bar', None, created_at=200.0)], 'token')
+        states, cursor = self.manager.list_assets(
+            10, {'token': 'previous'}, status=state.UPLOADED)
+        self.assertEqual(['foo'], [s.asset_id for s in states])
+        self.assertEqual({'token': 'token'}, cursor)
+        self.storage_mock.list_assets.assert_called_once_with(10, 'previous')
+        states, cursor = self.manager.list_assets(10, created_after=150.0)
+        self.assertEqual(['bar'], [s.asset_id for s in states])
+
+    def test_list_assets_last_page(self):
+        self.storage_mock.list_assets.return_value = ([], None)
+        self.assertEqual(([], None), self.manager.list_assets(10))
+        self.assertRaises(werkzeug_exc.BadRequest, self.manager.list_assets,
+                          10, {'after': [100.0, 'foo']})
+
+    def test_open_download_disabled(self):
+        self.assertRaises(werkzeug_exc.NotFound,
+                          self.manager.open_download, 'foo')
+        self.assertFalse(self.storage_mock.get_upload_status.called)
+
+
+class TestAssetManagerStateStore(testtools.TestCase):
+
+    def setUp(self):
+        super(TestAssetManagerStateStore, self).setUp()
+        self.storage_mock = mock.Mock()
+        self.storage_mock.executor = futures.ThreadPoolExecutor(2)
+        self.store = state.SQLiteStateStore(':memory:')
+        self.manager = s3.AssetManager(storage_manager=self.storage_mock,
+                                       state_store=self.store)
+
+    def test_create_asset(self):
+        asset = self.manager.create_asset()
+        self.assertEqual(state.CREATED, self.store.get(asset.asset_id).status)
+
+    def test_update_asset(self):
+        asset = self.manager.create_asset()
+        self.manager.update_asset(asset.asset_id, 10)
+        self.assertTrue(self.store.get(asset.asset_id).uploaded)
+        self.assertEqual(10, self.store.get(asset.asset_id).size)
+        self.assertFalse(self.storage_mock.update_upload_status.called)
+
+    def test_get_asset(self):
+        self.storage_mock.presign_download.return_value = 'foo_url'
+        asset = self.manager.create_asset()
+        self.assertIsNone(self.manager.get_asset(asset.asset_id, 50).url)
+        self.manager.update_asset(asset.asset_id)
+        self.assertEqual(
+            'foo_url', self.manager.get_asset(asset.asset_id, 50).url)
+        self.assertFalse(self.storage_mock.get_url_for_download.called)
+
+    def test_get_asset_not_found(self):
+        self.assertRaises(exceptions.AssetNotFoundError,
+                          self.manager.get_asset, 'foo_asset_id', 50)
+
+    def test_get_asset_presign_error(self):
+        self.storage_mock.presign_download.side_effect = (
+            boto_exc.NoCredentialsError())
+        asset = self.manager.create_asset()
+        self.manager.update_asset(asset.asset_id)
+        self.assertRaises(exceptions.AssetError,
+                          self.manager.get_asset, asset.asset_id, 50)
+
+    def test_get_assets(self):
+        asset = self.manager.create_asset()
+        assets = self.manager.get_assets([asset.asset_id, 'foo'], 50)
+        self.assertIsNone(assets[0].error)
+        self.assertIsInstance(assets[1].error, exceptions.AssetNotFoundError)
+
+    def test_open_download(self):
+        self.manager.proxy = True
+        asset = self.manager.create_asset()
+        self.assertIsNone(self.manager.open_download(asset.asset_id))
+        self.manager.update_asset(asset.asset_id)
+        self.manager.open_download(asset.asset_id)
+        self.storage_mock.open_download.assert_called_once_with(
+            asset.asset_id, None, None, constants.PROXY_CHUNK_SIZE)
+        self.assertFalse(self.storage_mock.get_upload_status.called)
+        self.assertRaises(exceptions.AssetNotFoundError,
+                          self.manager.open_download, 'foo')
+
+    def test_list_assets(self):
+        asset_ids = [self.manager.create_asset().asset_id for _ in range(3)]
+        self.manager.update_asset(asset_ids[1])
+        states, cursor = self.manager.list_assets(2)
+        self.assertEqual(2, len(states))
+        last, cursor = self.manager.list_assets(2, cursor)
+        self.assertEqual(1, len(last))
+        self.assertIsNone(cursor)
+        self.assertEqual(sorted(asset_ids),
+                         sorted(s.asset_id for s in states + last))
+        states, cursor = self.manager.list_assets(10, status=state.UPLOADED)
+        self.assertEqual([asset_ids[1]], [s.asset_id for s in states])
+        self.assertFalse(self.storage_mock.list_assets.called)
+
+    def test_list_assets_invalid_cursor(self):
+        self.assertRaises(werkzeug_exc.BadRequest, self.manager.list_assets,
+                          10, {'token': 'foo'})
+
+
+class TestConfig(testtools.TestCase):
+
+    environ = {
+        'AWS_BUCKET': 'foo_bucket',
+        'AWS_ACCESS_KEY_ID': 'foo_key_id',
+        'AWS_SECRET_ACCESS_KEY': 'foo_key',
+        'AWS_REGION': 'us-west-2',
+    }
+
+    def test_defaults(self):
+        config = s3.Config(environ=self.environ)
+        self.assertEqual('foo_bucket', config.bucket)
+        self.assertEqual(constants.MAX_POOL_CONNECTIONS,
+                         config.max_pool_connections)
+        self.assertEqual(constants.READ_TIMEOUT, config.read_timeout)
+
+    def test_concurrency_limits(self):
+        config = s3.Config(environ=self.environ)
+        self.assertEqual({}, config.concurrency_limits)
+        environ = dict(
+            self.environ,
+            S3UPLOADER_CONCURRENCY_LIMITS='get_asset=64, put_asset=8')
+        config = s3.Config(environ=environ)
+        self.assertEqual({'get_asset': 64, 'put_asset': 8},
+                         config.concurrency_limits)
+        for limits in ('get_asset=0', 'get_asset=lots', 'post_asset=8'):
+            environ = dict(self.environ,
+                           S3UPLOADER_CONCURRENCY_LIMITS=limits)
+            self.assertRaises(ValueError, s3.Config, environ=environ)
+
+    def test_pool_settings(self):
+        environ = dict(self.environ, S3UPLOADER_MAX_POOL_CONNECTIONS='50',
+                       S3UPLOADER_CONNECT_TIMEOUT='2')
+        config = s3.Config(environ=environ)
+        self.assertEqual(50, config.max_pool_connections)
+        self.assertEqual(2, config.connect_timeout)
+
+    def test_invalid_pool_settings(self):
+        environ = dict(self.environ, S3UPLOADER_MAX_POOL_CONNECTIONS='lots')
+        self.assertRaises(ValueError, s3.Config, environ=environ)
+
+    def test_invalid_part_size(self):
+        environ = dict(self.environ, S3UPLOADER_MULTIPART_PART_SIZE='1024')
+        self.assertRaises(ValueError, s3.Config, environ=environ)
+
+    def test_build_readiness_cache(self):
+        readiness_cache = s3.build_readiness_cache(
+            s3.Config(environ=self.environ))
+        self.assertIsInstance(readiness_cache.backend, cache.LRUCache)
+        self.assertEqual(constants.READINESS_TTL, readiness_cache.ready_ttl)
+
+    def test_build_readiness_cache_disabled(self):
+        environ = dict(self.environ, S3UPLOADER_READINESS_CACHE_SIZE='0')
+        self.assertIsNone(
+            s3.build_readiness_cache(s3.Config(environ=environ)))
+
+    def test_build_url_cache(self):
+        self.assertIsNone(s3.build_url_cache(s3.Config(environ=self.environ)))
+        environ = dict(self.environ, S3UPLOADER_URL_CACHE_SIZE='100',
+                       S3UPLOADER_URL_CACHE_MIN_VALIDITY='0.5')
+        url_cache = s3.build_url_cache(s3.Config(environ=environ))
+        self.assertEqual(0.5, url_cache.min_validity)
+
+    def test_build_presigner(self):
+        config = s3.Config(environ=self.environ)
+        self.assertIsNone(s3.build_presigner(config, mock.Mock()))
+        environ = dict(self.environ, S3UPLOADER_PRESIGNER='native')
+        config = s3.Config(environ=environ)
+        presigner = s3.build_presigner(config, s3.create_client(config))
+        self.assertIsInstance(presigner, sigv4.SigV4Presigner)
+        self.assertEqual('foo_bucket', presigner.bucket)
+
+    def test_invalid_presigner(self):
+        environ = dict(self.environ, S3UPLOADER_PRESIGNER='fast')
+        self.assertRaises(ValueError, s3.Config, environ=environ)
+
+    def test_build_caller(self):
+        environ = dict(self.environ, S3UPLOADER_READ_DEADLINE='2',
+                       S3UPLOADER_WRITE_RETRIES='5',
+                       S3UPLOADER_DEADLINES='list_objects_v2=30,list_parts=1',
+                       S3UPLOADER_HEDGE_PERCENTILE='0')
+        caller = s3.build_caller(s3.Config(environ=environ), mock.Mock())
+        self.assertEqual(2, caller.read_policy.deadline)
+        self.assertFalse(caller.read_policy.hedge)
+        self.assertEqual(5, caller.write_policy.retries)
+        self.assertEqual((caller.read_policy, 30),
+                         caller.policy('list_objects_v2'))
+        self.assertEqual((caller.write_policy, constants.WRITE_DEADLINE),
+                         caller.policy('put_object_tagging'))
+
+    def test_create_read_client(self):
+        environ = dict(self.environ, S3UPLOADER_READ_DEADLINE='2',
+                       S3UPLOADER_DEADLINES='list_objects_v2=30')
+        client = s3.create_read_client(s3.Config(environ=environ))
+        self.assertEqual(30, client.meta.config.read_timeout)
+        self.assertEqual(30, client.meta.config.connect_timeout)
+        environ = dict(self.environ, S3UPLOADER_DEADLINES='list_parts=0')
+        self.assertIsNone(s3.create_read_client(s3.Config(environ=environ)))
+
+    def test_build_key_layout(self):
+        self.assertIsInstance(
+            s3.build_key_layout(s3.Config(environ=self.environ)),
+            keys.FlatLayout)
+        environ = dict(self.environ, S3UPLOADER_KEY_LAYOUT='sharded',
+                       S3UPLOADER_KEY_PREFIX_LENGTH='3')
+        layout = s3.build_key_layout(s3.Config(environ=environ))
+        self.assertEqual(3, layout.prefix_length)
+
+    def test_invalid_key_layout(self):
+        environ = dict(self.environ, S3UPLOADER_KEY_LAYOUT='nested')
+        self.assertRaises(ValueError, s3.Config, environ=environ)
+        environ = dict(self.environ, S3UPLOADER_KEY_PREFIX_LENGTH='5')
+        self.assertRaises(ValueError, s3.Config, environ=environ)
+
+    def test_invalid_deadlines(self):
+        environ = dict(self.environ, S3UPLOADER_DEADLINES='list_parts')
+        self.assertRaises(ValueError, s3.Config, environ=environ)
+        environ = dict(self.environ, S3UPLOADER_HEDGE_PERCENTILE='100')
+        self.assertRaises(ValueError, s3.Config, environ=environ)
+
+    def test_build_storage_manager_locations(self):
+        environ = dict(
+            self.environ,
+            S3UPLOADER_LOCATIONS=('us=foo_bucket@us-west-2,'
+                                  'eu=bar_bucket@eu-west-1*2,'
+                                  'eu-us=baz_bucket@us-west-2*0'),
+            S3UPLOADER_REPLICAS='eu=eu-us')
+        config = s3.Config(environ=environ)
+        self.assertEqual([('us', 1), ('eu', 2), ('eu-us', 0)],
+                         [(location.name, location.weight)
+                          for location in config.locations])
+        manager = s3.build_storage_manager(config, keys.FlatLayout())
+        self.assertIsInstance(manager, routing.RoutingManager)
+        # IDs without a location belong to AWS_BUCKET
+        self.assertIs(manager.managers['us'], manager.managers[None])
+        self.assertEqual('bar_bucket', manager.managers['eu'].config.bucket)
+        self.assertEqual('eu-west-1',
+                         manager.managers['eu'].client.meta.region_name)
+        self.assertEqual(['eu-us'], manager.replicas['eu'])
+        self.assertEqual('foo_bucket', config.bucket)
+
+    def test_build_asset_manager_locations(self):
+        environ = dict(self.environ,
+                       S3UPLOADER_LOCATIONS='eu=bar_bucket@eu-west-1')
+        asset_manager = s3.build_asset_manager(s3.Config(environ=environ))
+        managers = asset_manager.storage_manager.managers
+        self.assertEqual('foo_bucket', managers[None].config.bucket)
+        self.assertTrue(asset_manager._generate_uuid().startswith('eu.'))
+
+    def test_invalid_locations(self):
+        for locations in ('eu', 'eu=bar', 'eu=bar@eu-west-1*x',
+                          'EU=bar@eu-west-1', 'e.u=bar@eu-west-1',
+                          'eu=bar@eu-west-1,eu=baz@eu-west-1',
+                          'eu=bar@eu-west-1*0'):
+            environ = dict(self.environ, S3UPLOADER_LOCATIONS=locations)
+            self.assertRaises(ValueError, s3.Config, environ=environ)
+        environ = dict(self.environ,
+                       S3UPLOADER_LOCATIONS='eu=bar@eu-west-1',
+                       S3UPLOADER_REPLICAS='eu=us')
+        self.assertRaises(ValueError, s3.Config, environ=environ)
+
+    def test_build_state_store(self):
+        config = s3.Config(environ=self.environ)
+        self.assertIsNone(s3.build_state_store(config, mock.Mock()))
+        environ = dict(self.environ, S3UPLOADER_STATE_DB=':memory:')
+        store = s3.build_state_store(s3.Config(environ=environ), mock.Mock())
+        self.assertIsInstance(store, state.WriteThroughStateStore)
+        environ['S3UPLOADER_STATE_WRITE_THROUGH'] = 'false'
+        store = s3.build_state_store(s3.Config(environ=environ), mock.Mock())
+        self.assertIsInstance(store, state.SQLiteStateStore)
+
+    def test_proxy_settings(self):
+        config = s3.Config(environ=self.environ)
+        self.assertFalse(config.proxy)
+        environ = dict(self.environ, S3UPLOADER_PROXY='true',
+                       S3UPLOADER_PROXY_CHUNK_SIZE='1024')
+        asset_manager = s3.build_asset_manager(s3.Config(environ=environ))
+        self.assertTrue(asset_manager.proxy)
+        self.assertEqual(1024, asset_manager.proxy_chunk_size)
+        environ['S3UPLOADER_PROXY_CHUNK_SIZE'] = '0'
+        self.assertRaises(ValueError, s3.Config, environ=environ)
+
+    def test_build_write_behind(self):
+        config = s3.Config(environ=self.environ)
+        self.assertIsNone(s3.build_write_behind(config, mock.Mock()))
+        environ = dict(self.environ, S3UPLOADER_JOURNAL=':memory:',
+                       S3UPLOADER_JOURNAL_WORKERS='4',
+                       S3UPLOADER_STATE_DB=':memory:')
+        storage_manager = mock.Mock()
+        write_behind = s3.build_write_behind(s3.Config(environ=environ),
+                                             storage_manager)
+        self.addCleanup(write_behind.stop)
+        self.assertEqual(4, write_behind.workers)
+        self.assertEqual(storage_manager.update_upload_status,
+                         write_behind.apply)
+
+    def test_journal_requires_shared_readiness(self):
+        environ = dict(self.environ, S3UPLOADER_JOURNAL=':memory:')
+        self.assertRaises(ValueError, s3.Config, environ=environ)
+        environ['S3UPLOADER_READINESS_CACHE_URL'] = 'redis://localhost'
+        self.assertEqual(':memory:', s3.Config(environ=environ).journal)
+
+    def test_create_client(self):
+        client = s3.create_client(s3.Config(environ=self.environ))
+        self.assertEqual(
+            constants.MAX_POOL_CONNECTIONS,
+            client.meta.config.max_pool_connections)
+        self.assertEqual('us-west-2', client.meta.region_name)
+
+
+class TestSharedAssetManager(testtools.TestCase):
+
+    def setUp(self):
+        super(TestSharedAssetManager, self).setUp()
+        mock.patch('s3uploader.s3.Config').start()
+        mock.patch.object(s3, '_config', None).start()
+        mock.patch('s3uploader.s3.build_asset_manager',
+                   side_effect=lambda config: mock.Mock()).start()
+        s3.reset_asset_manager()
+        self.addCleanup(s3.reset_asset_manager)
+        self.addCleanup(mock.patch.stopall)
+
+    def test_get_config_is_read_once(self):
+        self.assertIs(s3.get_config(), s3.get_config())
+        s3.Config.assert_called_once_with()
+
+    def test_get_config_missing(self):
+        s3.Config.side_effect = KeyError('AWS_BUCKET')
+        self.assertRaisesRegex(ValueError, 'AWS_BUCKET must be set',
+                               s3.get_config)
+
+    def test_warm_up(self):
+        self.assertIs(s3.get_asset_manager(), s3.warm_up())
+
+    def test_get_asset_manager_is_shared(self):
+        self.assertIs(s3.get_asset_manager(), s3.get_asset_manager())
+        self.assertEqual(1, s3.build_asset_manager.call_count)
+
+    def test_get_asset_manager_after_reset(self):
+        manager = s3.get_asset_manager()
+        s3.reset_asset_manager()
+        self.assertIsNot(manager, s3.get_asset_manager())
+
+    def test_get_asset_manager_after_fork(self):
+        manager = s3.get_asset_manager()
+        with mock.patch('os.getpid', return_value=-1):
+            self.assertIsNot(manager, s3.get_asset_manager())
+
 
 class TestS3Manager(testtools.TestCase):
 
@@ -64,9 +503,56 @@ class TestS3Manager(testtools.TestCase):
             error_response={}, operation_name='foo')
         exc.response['Error'] = {'Code': 'NoSuchKey'}
         self.manager.client.put_object_tagging.side_effect = exc
+        errors = metrics.S3_ERRORS.value('NoSuchKey')
         self.assertRaises(
             exceptions.AssetNotFoundError,
             self.manager.update_upload_status, 'foo_asset_id')
+        self.assertEqual(errors + 1, metrics.S3_ERRORS.value('NoSuchKey'))
+
+    def test_list_objects(self):
+        self.manager.client.list_objects_v2.return_value = {
+            'Contents': [{'Key': 'foo'}], 'IsTruncated': True,
+            'NextContinuationToken': 'token'}
+        objects, token = self.manager.list_objects(
+            page_size=10, continuation_token='previous')
+        self.assertEqual([{'Key': 'foo'}], objects)
+        self.assertEqual('token', token)
+        self.manager.client.list_objects_v2.assert_called_once_with(
+            Bucket=self.manager.config.bucket, MaxKeys=10,
+            ContinuationToken='previous')
+
+    def test_list_objects_range(self):
+        self.manager.client.list_objects_v2.return_value = {}
+        self.manager.list_objects(page_size=10, prefix='ab/',
+                                  start_after='ab/foo', delimiter='/')
+        self.manager.client.list_objects_v2.assert_called_once_with(
+            Bucket=self.manager.config.bucket, MaxKeys=10, Prefix='ab/',
+            StartAfter='ab/foo', Delimiter='/')
+
+    def test_list_assets(self):
+        self.manager.key_layout = keys.ShardedLayout(2)
+        self.manager.readiness_cache = mock.Mock()
+        self.manager.readiness_cache.get.side_effect = [True, None]
+        asset_id = str(keys.uuid7(clock=lambda: 1500000000.0))
+        self.manager.client.list_objects_v2.return_value = {
+            'Contents': [
+                {'Key': 'foo', 'Size': 10,
+                 'LastModified': datetime.datetime(2017, 7, 14, 2, 40)},
+                {'Key': self.manager.key_layout.key(asset_id), 'Size': 20},
+                {'Key': 'ab/not-an-asset'}],
+            'IsTruncated': False}
+        states, token = self.manager.list_assets(10)
+        self.assertIsNone(token)
+        self.assertEqual(
+            [('foo', state.UPLOADED, 10, 1500000000.0),
+             (asset_id, None, 20, 1500000000.0)],
+            [(s.asset_id, s.status, s.size, s.created_at) for s in states])
+        self.assertFalse(self.manager.client.get_object_tagging.called)
+
+    def test_list_objects_last_page(self):
+        self.manager.client.list_objects_v2.return_value = {
+            'IsTruncated': False}
+        self.assertEqual(([], None), self.manager.list_objects())
 
     def test_get_url_for_download_ready_for_download(self):
         self.manager.client.get_object_tagging.return_value = (
@@ -101,14 +587,388 @@ class TestS3Manager(testtools.TestCase):
             exceptions.AssetError,
             self.manager.get_url_for_download, 'foo_asset_id', 50)
 
+    def test_get_url_for_upload_presigner(self):
+        self.manager.presigner = mock.Mock()
+        self.manager.presigner.presign_post.return_value = 'foo_post'
+        self.assertEqual(
+            'foo_post', self.manager.get_url_for_upload('foo_asset_id'))
+        self.assertFalse(self.manager.client.generate_presigned_post.called)
+
+    def test_get_url_for_download_presigner(self):
+        self.manager.presigner = mock.Mock()
+        self.manager.presigner.presign_get.return_value = 'foo_url'
+        self.manager.client.get_object_tagging.return_value = (
+            {'TagSet': [{'Key': 'Status', 'Value': 'Uploaded'}]})
+        self.assertEqual(
+            'foo_url', self.manager.get_url_for_download('foo_asset_id', 50))
+        self.manager.presigner.presign_get.assert_called_once_with(
+            'foo_asset_id', 50)
+        self.assertFalse(self.manager.client.generate_presigned_url.called)
+
     def test_get_url_for_upload_raises(self):
         self.manager.client.generate_presigned_post.side_effect = (
             boto_exc.BotoCoreError)
         self.assertRaises(exceptions.AssetError,
                           self.manager.get_url_for_upload, 'foo_asset_id')
 
+    def test_get_urls_for_upload(self):
+        self.manager.client.generate_presigned_post.side_effect = ['u1', 'u2']
+        self.assertEqual(
+            ['u1', 'u2'], self.manager.get_urls_for_upload(['foo', 'bar']))
+
+    def test_get_urls_for_download(self):
+        exc = boto_exc.ClientError(
+            error_response={'Error': {'Code': 'NoSuchKey'}},
+            operation_name='foo')
+        tags = {'foo': {'TagSet': [{'Key': 'Status', 'Value': 'Uploaded'}]},
+                'bar': {'TagSet': []},
+                'baz': exc}
+
+        def get_object_tagging(Bucket, Key):
+            if isinstance(tags[Key], Exception):
+                raise tags[Key]
+            return tags[Key]
+
+        self.manager.client.get_object_tagging.side_effect = (
+            get_object_tagging)
+        self.manager.client.generate_presigned_url.return_value = 'foo_url'
+        results = self.manager.get_urls_for_download(
+            ['foo', 'bar', 'baz'], 50)
+        self.assertEqual(('foo_url', None), results[0])
+        self.assertEqual((None, None), results[1])
+        self.assertIsNone(results[2][0])
+        self.assertIsInstance(results[2][1], exceptions.AssetNotFoundError)
+
     def test_update_upload_status_raises(self):
         self.manager.client.put_object_tagging.side_effect = (
             boto_exc.ClientError(error_response={}, operation_name='foo'))
         self.assertRaises(exceptions.AssetError,
                           self.manager.update_upload_status, 'foo_asset_id')
+
+    def test_open_download(self):
+        body = mock.Mock()
+        body.read.side_effect = [b'foo', b'bar', b'']
+        self.manager.client.get_object.return_value = {
+            'Body': body, 'ContentLength': 6, 'ContentType': 'text/plain',
+            'ETag': '"etag"',
+            'LastModified': datetime.datetime(
+                2017, 11, 1, tzinfo=datetime.timezone.utc)}
+        download = self.manager.open_download('foo', chunk_size=3)
+        self.assertEqual(200, download.status)
+        self.assertEqual([('Accept-Ranges', 'bytes'),
+                          ('Content-Type', 'text/plain'),
+                          ('Content-Length', '6'), ('ETag', '"etag"'),
+                          ('Last-Modified', 'Wed, 01 Nov 2017 00:00:00 GMT')],
+                         download.headers)
+        self.assertEqual([b'foo', b'bar'], list(download))
+        body.read.assert_called_with(3)
+        body.close.assert_called_once_with()
+
+    def test_open_download_range(self):
+        self.manager.client.get_object.return_value = {
+            'Body': mock.Mock(), 'ContentRange': 'bytes 0-9/100'}
+        download = self.manager.open_download('foo', 'bytes=0-9', '"etag"')
+        self.assertEqual(206, download.status)
+        self.assertIn(('Content-Range', 'bytes 0-9/100'), download.headers)
+        self.manager.client.get_object.assert_called_once_with(
+            Bucket=self.manager.config.bucket, Key='foo', Range='bytes=0-9',
+            IfNoneMatch='"etag"')
+
+    def test_open_download_not_modified(self):
+        self.manager.client.get_object.side_effect = boto_exc.ClientError(
+            error_response={'Error': {'Code': '304'}, 'ResponseMetadata': {
+                'HTTPStatusCode': 304, 'HTTPHeaders': {'etag': '"etag"'}}},
+            operation_name='GetObject')
+        download = self.manager.open_download('foo', if_none_match='"etag"')
+        self.assertEqual(304, download.status)
+        self.assertEqual([('ETag', '"etag"')], download.headers)
+        self.assertEqual([], list(download))
+
+    def test_open_download_invalid_range(self):
+        self.manager.client.get_object.side_effect = boto_exc.ClientError(
+            error_response={'Error': {'Code': 'InvalidRange'}},
+            operation_name='GetObject')
+        self.assertRaises(exceptions.AssetRangeNotSatisfiableError,
+                          self.manager.open_download, 'foo', 'bytes=100-')
+
+    def test_download_closed_on_error(self):
+        body = mock.Mock()
+        body.read.side_effect = [b'foo', boto_exc.ReadTimeoutError(
+            endpoint_url='foo')]
+        download = s3.Download('foo', 200, [], body)
+        chunks = iter(download)
+        next(chunks)
+        self.assertRaises(boto_exc.ReadTimeoutError, next, chunks)
+        body.close.assert_called_once_with()
+
+    def test_create_multipart_upload(self):
+        self.manager.client.create_multipart_upload.return_value = {
+            'UploadId': 'upload'}
+        self.assertEqual('upload',
+                         self.manager.create_multipart_upload('foo'))
+
+    def test_get_urls_for_part_upload(self):
+        self.manager.client.generate_presigned_url.side_effect = [
+            'url1', 'url2']
+        self.assertEqual(['url1', 'url2'],
+                         self.manager.get_urls_for_part_upload(
+                             'foo', 'upload', [1, 2], 60))
+        self.manager.client.generate_presigned_url.assert_called_with(
+            ClientMethod='upload_part',
+            Params={'Bucket': self.manager.config.bucket, 'Key': 'foo',
+                    'UploadId': 'upload', 'PartNumber': 2},
+            ExpiresIn=60, HttpMethod='PUT')
+
+    def test_get_urls_for_part_upload_presigner(self):
+        self.manager.presigner = mock.Mock()
+        self.manager.presigner.presign_upload_part.return_value = 'url'
+        self.assertEqual(['url'], self.manager.get_urls_for_part_upload(
+            'foo', 'upload', [1], 60))
+        self.manager.presigner.presign_upload_part.assert_called_once_with(
+            'foo', 'upload', 1, 60)
+        self.manager.client.generate_presigned_url.assert_not_called()
+
+    def test_list_parts(self):
+        self.manager.client.list_parts.side_effect = [
+            {'Parts': [{'PartNumber': 1}], 'IsTruncated': True,
+             'NextPartNumberMarker': 1},
+            {'Parts': [{'PartNumber': 2}], 'IsTruncated': False}]
+        self.assertEqual([{'PartNumber': 1}, {'PartNumber': 2}],
+                         self.manager.list_parts('foo', 'upload'))
+        self.manager.client.list_parts.assert_called_with(
+            Bucket=self.manager.config.bucket, Key='foo', UploadId='upload',
+            PartNumberMarker=1)
+
+    def test_list_parts_no_such_upload(self):
+        self.manager.client.list_parts.side_effect = boto_exc.ClientError(
+            error_response={'Error': {'Code': 'NoSuchUpload'}},
+            operation_name='foo')
+        self.assertRaises(exceptions.AssetNotFoundError,
+                          self.manager.list_parts, 'foo', 'upload')
+
+    def _parts(self, *numbers):
+        return {'Parts': [{'PartNumber': n, 'ETag': '"etag%d"' % n,
+                           'Size': 10} for n in numbers]}
+
+    def test_complete_multipart_upload(self):
+        self.manager.client.list_parts.return_value = self._parts(1, 2)
+        self.assertEqual(20, self.manager.complete_multipart_upload(
+            'foo', 'upload', 20))
+        self.manager.client.complete_multipart_upload.assert_called_once_with(
+            Bucket=self.manager.config.bucket, Key='foo', UploadId='upload',
+            MultipartUpload={'Parts': [
+                {'PartNumber': 1, 'ETag': '"etag1"'},
+                {'PartNumber': 2, 'ETag': '"etag2"'}]})
+
+    def test_complete_multipart_upload_incomplete(self):
+        for parts, size in ((self._parts(), None),
+                            (self._parts(1, 3), None),
+                            (self._parts(1, 2), 30)):
+            self.manager.client.list_parts.return_value = parts
+            self.assertRaises(exceptions.AssetUploadIncompleteError,
+                              self.manager.complete_multipart_upload,
+                              'foo', 'upload', size)
+        self.manager.client.complete_multipart_upload.assert_not_called()
+
+    def test_abort_multipart_upload(self):
+        self.manager.abort_multipart_upload('foo', 'upload')
+        self.manager.client.abort_multipart_upload.assert_called_once_with(
+            Bucket=self.manager.config.bucket, Key='foo', UploadId='upload')
+
+
+class TestS3ManagerReadinessCache(testtools.TestCase):
+
+    def setUp(self):
+        super(TestS3ManagerReadinessCache, self).setUp()
+        self.cache = cache.ReadinessCache(
+            cache.LRUCache(10, name='test_s3'), 60, 5)
+        self.manager = s3.S3Manager(config=mock.Mock(), client=mock.Mock(),
+                                    readiness_cache=self.cache)
+        metrics.CACHE_EVENTS.clear()
+        self.client = self.manager.client
+        self.client.get_object_tagging.return_value = (
+            {'TagSet': [{'Key': 'Status', 'Value': 'Uploaded'}]})
+
+    def test_get_url_for_download_cached(self):
+        self.manager.get_url_for_download('foo_asset_id', 50)
+        self.manager.get_url_for_download('foo_asset_id', 50)
+        self.client.get_object_tagging.assert_called_once()
+        self.assertEqual(2, self.client.generate_presigned_url.call_count)
+        self.assertEqual(1, metrics.CACHE_EVENTS.value('readiness', 'hit'))
+
+    def test_get_url_for_download_not_ready_cached(self):
+        self.client.get_object_tagging.return_value = {'TagSet': []}
+        self.assertIsNone(
+            self.manager.get_url_for_download('foo_asset_id', 50))
+        self.assertIsNone(
+            self.manager.get_url_for_download('foo_asset_id', 50))
+        self.client.get_object_tagging.assert_called_once()
+
+    def test_update_upload_status_populates_cache(self):
+        self.cache.set('foo_asset_id', False)
+        self.manager.update_upload_status('foo_asset_id')
+        self.assertTrue(self.manager.get_url_for_download('foo_asset_id', 50))
+        self.assertFalse(self.client.get_object_tagging.called)
+
+    def test_update_upload_status_failure_invalidates_cache(self):
+        self.cache.set('foo_asset_id', True)
+        exc = boto_exc.ClientError(
+            error_response={'Error': {'Code': 'NoSuchKey'}},
+            operation_name='foo')
+        self.client.put_object_tagging.side_effect = exc
+        self.assertRaises(
+            exceptions.AssetNotFoundError,
+            self.manager.update_upload_status, 'foo_asset_id')
+        self.assertIsNone(self.cache.get('foo_asset_id'))
+
+    def test_update_upload_status_transient_failure_keeps_cache(self):
+        self.manager.remember_uploaded('foo_asset_id')
+        exc = boto_exc.ClientError(
+            error_response={'Error': {'Code': 'SlowDown'}},
+            operation_name='foo')
+        self.manager.caller = mock.Mock(side_effect=exc)
+        self.assertRaises(
+            exceptions.AssetError,
+            self.manager.update_upload_status, 'foo_asset_id')
+        # the journal retries it, readers still see it ready
+        self.assertTrue(self.cache.get('foo_asset_id'))
+
+    def test_remember_uploaded(self):
+        self.cache.set('foo_asset_id', False)
+        self.manager.remember_uploaded('foo_asset_id')
+        self.assertTrue(self.manager.get_url_for_download('foo_asset_id', 50))
+        self.assertFalse(self.client.get_object_tagging.called)
+        self.assertFalse(self.client.put_object_tagging.called)
+
+    def test_remember_uploaded_during_lookup(self):
+        def get_object_tagging(**kwargs):
+            self.manager.remember_uploaded('foo_asset_id')
+            return {'TagSet': []}
+
+        self.client.get_object_tagging.side_effect = get_object_tagging
+        self.assertIsNone(
+            self.manager.get_url_for_download('foo_asset_id', 50))
+        self.assertTrue(self.cache.get('foo_asset_id'))
+
+    def test_not_found_not_cached(self):
+        exc = boto_exc.ClientError(
+            error_response={'Error': {'Code': 'NoSuchKey'}},
+            operation_name='foo')
+        self.client.get_object_tagging.side_effect = exc
+        self.assertRaises(
+            exceptions.AssetNotFoundError,
+            self.manager.get_url_for_download, 'foo_asset_id', 50)
+        self.assertEqual(0, len(self.cache.backend))
+
+
+class TestS3ManagerShardedKeys(testtools.TestCase):
+
+    def setUp(self):
+        super(TestS3ManagerShardedKeys, self).setUp()
+        self.layout = keys.ShardedLayout(2)
+        self.manager = s3.S3Manager(config=mock.Mock(), client=mock.Mock(),
+                                    key_layout=self.layout)
+        self.client = self.manager.client
+        self.client.get_object_tagging.return_value = (
+            {'TagSet': [{'Key': 'Status', 'Value': 'Uploaded'}]})
+        self.asset_id = self.layout.new_id()
+        self.key = self.layout.key(self.asset_id)
+
+    def test_get_url_for_upload(self):
+        self.manager.get_url_for_upload(self.asset_id)
+        self.client.generate_presigned_post.assert_called_once_with(
+            Bucket=self.manager.config.bucket, Key=self.key)
+
+    def test_get_url_for_download(self):
+        self.manager.get_url_for_download(self.asset_id, 50)
+        self.client.get_object_tagging.assert_called_once_with(
+            Bucket=self.manager.config.bucket, Key=self.key)
+        self.assertEqual(
+            self.key, self.client.generate_presigned_url.call_args[1][
+                'Params']['Key'])
+
+    def test_get_url_for_download_legacy(self):
+        legacy_id = 'b5f4a3c2-1e0d-4c9b-8a7f-6e5d4c3b2a19'
+        self.manager.get_url_for_download(legacy_id, 50)
+        self.client.get_object_tagging.assert_called_once_with(
+            Bucket=self.manager.config.bucket, Key=legacy_id)
+
+    def test_update_upload_status(self):
+        self.manager.update_upload_status(self.asset_id)
+        self.client.put_object_tagging.assert_called_once_with(
+            Bucket=self.manager.config.bucket, Key=self.key,
+            Tagging=s3.UPLOADED_TAGGING)
+
+    def test_asset_manager_ids(self):
+        manager = s3.AssetManager(storage_manager=self.manager,
+                                  key_layout=self.layout)
+        self.assertTrue(keys.is_uuid7(manager.create_asset().asset_id))
+
+
+class TestS3ManagerCoalescing(testtools.TestCase):
+
+    def setUp(self):
+        super(TestS3ManagerCoalescing, self).setUp()
+        self.manager = s3.S3Manager(config=mock.Mock(), client=mock.Mock())
+        self.client = self.manager.client
+        self.release = threading.Event()
+        self.response = {'TagSet': [{'Key': 'Status', 'Value': 'Uploaded'}]}
+
+        def get_object_tagging(**kwargs):
+            self.release.wait(5)
+            if isinstance(self.response, Exception):
+                raise self.response
+            return self.response
+
+        self.client.get_object_tagging.side_effect = get_object_tagging
+        metrics.COALESCED_CALLS.clear()
+
+    def _get_urls(self, count):
+        with futures.ThreadPoolExecutor(count) as pool:
+            jobs = [pool.submit(self.manager.get_url_for_download,
+                                'foo_asset_id', 50) for _ in range(count)]
+            while metrics.COALESCED_CALLS.value(
+                    'get_object_tagging') < count - 1:
+                threading.Event().wait(0.001)
+            self.release.set()
+            return [job.exception() or job.result() for job in jobs]
+
+    def test_get_url_for_download_coalesced(self):
+        self.assertEqual(4, len(self._get_urls(4)))
+        self.client.get_object_tagging.assert_called_once()
+        self.assertEqual(4, self.client.generate_presigned_url.call_count)
+
+    def test_get_url_for_download_coalesced_error(self):
+        self.response = boto_exc.ClientError(
+            error_response={'Error': {'Code': 'NoSuchKey'}},
+            operation_name='foo')
+        errors = self._get_urls(3)
+        self.client.get_object_tagging.assert_called_once()
+        for error in errors:
+            self.assertIsInstance(error, exceptions.AssetNotFoundError)
+
+
+class TestS3ManagerURLCache(testtools.TestCase):
+
+    def setUp(self):
+        super(TestS3ManagerURLCache, self).setUp()
+        self.manager = s3.S3Manager(
+            config=mock.Mock(), client=mock.Mock(),
+            url_cache=cache.PresignedURLCache(cache.LRUCache(10), 0.8))
+        self.client = self.manager.client
+        self.client.get_object_tagging.return_value = (
+            {'TagSet': [{'Key': 'Status', 'Value': 'Uploaded'}]})
+        self.client.generate_presigned_url.side_effect = ['url1', 'url2']
+
+    def test_get_url_for_download_reuses_url(self):
+        self.assertEqual(
+            'url1', self.manager.get_url_for_download('foo_asset_id', 50))
+        self.assertEqual(
+            'url1', self.manager.get_url_for_download('foo_asset_id', 50))
+        self.client.generate_presigned_url.assert_called_once()
+
+    def test_get_url_for_download_other_timeout(self):
+        self.assertEqual(
+            'url1', self.manager.get_url_for_download('foo_asset_id', 50))
+        self.assertEqual(
+            'url2', self.manager.get_url_for_download('foo_asset_id', 60))
@@ -0,0 +1,78 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import mock
+import testtools
+
+from s3uploader.cmds import service
+
+
+class TestService(testtools.TestCase):
+
+    def setUp(self):
+        super(TestService, self).setUp()
+        self.get_config = mock.patch('s3uploader.s3.get_config').start()
+        self.addCleanup(mock.patch.stopall)
+
+    @mock.patch.object(service, 'Server', create=True)
+    @mock.patch.object(service, 'gunicorn_base', mock.Mock())
+    def test_main(self, server):
+        service.main(['--workers', '3', '--threads', '4', '--backlog', '64',
+                      '--keepalive', '2', '--max-requests', '1000'])
+        app, options = server.call_args[0]
+        self.assertIs(service.app, app)
+        self.assertEqual('127.0.0.1:5000', options['bind'])
+        self.assertEqual(3, options['workers'])
+        self.assertEqual('gthread', options['worker_class'])
+        self.assertEqual(4, options['threads'])
+        self.assertEqual(64, options['backlog'])
+        self.assertEqual(2, options['keepalive'])
+        self.assertEqual(100, options['max_requests_jitter'])
+        self.assertTrue(options['preload_app'])
+        server.return_value.run.assert_called_once_with()
+
+    @mock.patch.object(service.app, 'run')
+    @mock.patch.object(service, 'gunicorn_base', None)
+    def test_main_without_gunicorn(self, run):
+        with mock.patch.object(service.s3.LOG, 'warning') as warning:
+            service.main(['--port', '8080'])
+        run.assert_called_once_with(host='127.0.0.1', port=8080, debug=False)
+        self.assertTrue(warning.called)
+
+    @mock.patch.object(service, 'Server', create=True)
+    @mock.patch.object(service, 'gunicorn_base', mock.Mock())
+    def test_main_invalid_config(self, server):
+        self.get_config.side_effect = ValueError('AWS_BUCKET must be set')
+        self.assertRaises(SystemExit, service.main, [])
+        self.assertFalse(server.called)
+
+    @mock.patch.object(service.app, 'run')
+    def test_main_dev(self, run):
+        service.main(['--dev', '--port', '8080'])
+        run.assert_called_once_with(host='127.0.0.1', port=8080, debug=False)
+
+    @mock.patch('s3uploader.s3.reset_asset_manager')
+    def test_post_fork(self, reset):
+        service.post_fork(mock.Mock(), mock.Mock())
+        reset.assert_called_once_with()
+
+    @mock.patch('s3uploader.s3.get_asset_manager')
+    def test_post_worker_init(self, get_asset_manager):
+        get_asset_manager.side_effect = ValueError()
+        service.post_worker_init(mock.Mock())
+        get_asset_manager.assert_called_once_with()
+
+    @mock.patch('s3uploader.s3.get_asset_manager')
+    def test_post_worker_init_no_warm_up(self, get_asset_manager):
+        self.get_config.return_value.warm_up = False
+        service.post_worker_init(mock.Mock())
+        self.assertFalse(get_asset_manager.called)
@@ -0,0 +1,126 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import datetime
+
+import boto3
+from botocore import config as boto_config
+import mock
+import testtools
+
+from s3uploader import sigv4
+
+
+NOW = datetime.datetime(2017, 11, 5, 23, 59, 58)
+KEYS = ['foo', 'a b/c+d~e', 'café/über?x=1&y#z', 'dir//x']
+
+
+class TestSigV4Presigner(testtools.TestCase):
+
+    scenarios = [
+        # region, endpoint_url, addressing style, session token
+        ('us-east-1', None, None, None),
+        ('eu-west-1', None, None, 'session/token+='),
+        ('us-west-2', None, 'path', None),
+        ('us-east-1', 'http://127.0.0.1:9000', None, None),
+        ('us-east-1', 'https://s3.example.com:8443', 'virtual', None),
+    ]
+
+    def setUp(self):
+        super(TestSigV4Presigner, self).setUp()
+        for target in ('botocore.auth.get_current_datetime',
+                       'botocore.signers.get_current_datetime'):
+            mock.patch(target, return_value=NOW).start()
+        self.addCleanup(mock.patch.stopall)
+
+    def _clients(self, region, endpoint_url, addressing_style, token,
+                 bucket='foo-bucket'):
+        session = boto3.session.Session(
+            aws_access_key_id='AKIDEXAMPLE',
+            aws_secret_access_key='wJalrXUtnFEMI/K7MDENG+bPxRfiCYEXAMPLEKEY',
+            aws_session_token=token,
+            region_name=region)
+        client = session.client(
+            's3', endpoint_url=endpoint_url,
+            config=boto_config.Config(
+                signature_version='s3v4',
+                s3={'addressing_style': addressing_style}))
+        presigner = sigv4.SigV4Presigner.from_client(
+            client, bucket, 'AKIDEXAMPLE',
+            'wJalrXUtnFEMI/K7MDENG+bPxRfiCYEXAMPLEKEY', token=token,
+            clock=lambda: NOW)
+        return client, presigner
+
+    def test_presign_get_matches_botocore(self):
+        for scenario in self.scenarios:
+            client, presigner = self._clients(*scenario)
+            for key in KEYS:
+                for expires_in in (1, 60, 604800):
+                    expected = client.generate_presigned_url(
+                        ClientMethod='get_object',
+                        Params={'Bucket': 'foo-bucket', 'Key': key},
+                        ExpiresIn=expires_in,
+                        HttpMethod='GET')
+                    self.assertEqual(
+                        expected, presigner.presign_get(key, expires_in),
+                        (scenario, key, expires_in))
+
+    def test_presign_get_dotted_bucket(self):
+        client, presigner = self._clients('us-east-1', None, None, None,
+                                          bucket='foo.bucket')
+        expected = client.generate_presigned_url(
+            ClientMethod='get_object',
+            Params={'Bucket': 'foo.bucket', 'Key': 'foo'}, ExpiresIn=60)
+        self.assertEqual(expected, presigner.presign_get('foo', 60))
+
+    def test_presign_upload_part_matches_botocore(self):
+        for scenario in self.scenarios:
+            client, presigner = self._clients(*scenario)
+            for key in KEYS:
+                for upload_id in ('upload-id', 'a.b_c/d+e=='):
+                    expected = client.generate_presigned_url(
+                        ClientMethod='upload_part',
+                        Params={'Bucket': 'foo-bucket', 'Key': key,
+                                'UploadId': upload_id, 'PartNumber': 42},
+                        ExpiresIn=3600)
+                    self.assertEqual(
+                        expected, presigner.presign_upload_part(
+                            key, upload_id, 42, 3600),
+                        (scenario, key, upload_id))
+
+    def test_presign_post_matches_botocore(self):
+        for scenario in self.scenarios:
+            client, presigner = self._clients(*scenario)
+            for key in KEYS:
+                expected = client.generate_presigned_post(
+                    Bucket='foo-bucket', Key=key)
+                self.assertEqual(expected, presigner.presign_post(key),
+                                 (scenario, key))
+                # same field order too
+                self.assertEqual(list(expected['fields']),
+                                 list(presigner.presign_post(key)['fields']))
+
+    def test_signing_key_cached(self):
+        client, presigner = self._clients('us-east-1', None, None, None)
+        with mock.patch.object(sigv4, '_hmac',
+                               wraps=sigv4._hmac) as hmac_mock:
+            presigner.presign_get('foo', 60)
+            presigner.presign_get('bar', 60)
+        self.assertEqual(4, hmac_mock.call_count)
+        self.assertEqual(['20171105'], list(presigner._signing_keys))
+
+    def test_signing_key_rolls_over(self):
+        client, presigner = self._clients('us-east-1', None, None, None)
+        for day in range(1, 5):
+            presigner.signing_key('201711%02d' % day)
+        self.assertLessEqual(len(presigner._signing_keys), 2)
+        self.assertIn('20171104', presigner._signing_keys)
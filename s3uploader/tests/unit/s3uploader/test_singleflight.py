@@ -0,0 +1,131 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import asyncio
+from concurrent import futures
+import threading
+
+import mock
+import testtools
+
+from s3uploader import metrics
+from s3uploader import singleflight
+
+
+class TestGroup(testtools.TestCase):
+
+    def setUp(self):
+        super(TestGroup, self).setUp()
+        self.group = singleflight.Group('foo')
+        self.release = threading.Event()
+        self.calls = []
+        metrics.COALESCED_CALLS.clear()
+
+    def _call(self, key):
+        self.calls.append(key)
+        self.release.wait(5)
+        return key.upper()
+
+    def _run(self, keys, f=None):
+        with futures.ThreadPoolExecutor(len(keys)) as pool:
+            jobs = [pool.submit(self.group.do, key, f or self._call, key)
+                    for key in keys]
+            # wait for the followers to join the calls in flight
+            while metrics.COALESCED_CALLS.value('foo') < len(keys) - len(
+                    set(keys)):
+                threading.Event().wait(0.001)
+            self.release.set()
+            return [job.result() if not job.exception() else job.exception()
+                    for job in jobs]
+
+    def test_do_coalesces(self):
+        self.assertEqual(['BAR'] * 4 + ['BAZ'],
+                         self._run(['bar'] * 4 + ['baz']))
+        self.assertEqual(['bar', 'baz'], sorted(self.calls))
+        self.assertEqual(3, metrics.COALESCED_CALLS.value('foo'))
+
+    def test_do_shares_error(self):
+        error = ValueError()
+
+        def fail(key):
+            self.calls.append(key)
+            self.release.wait(5)
+            raise error
+
+        self.assertEqual([error] * 3, self._run(['bar'] * 3, fail))
+        self.assertEqual(['bar'], self.calls)
+
+    def test_do_sequential(self):
+        self.release.set()
+        self.assertEqual('BAR', self.group.do('bar', self._call, 'bar'))
+        self.assertEqual('BAR', self.group.do('bar', self._call, 'bar'))
+        self.assertEqual(['bar', 'bar'], self.calls)
+        self.assertEqual(0, metrics.COALESCED_CALLS.value('foo'))
+
+    def test_forget(self):
+        def forget_and_call(key):
+            self.group.forget(key)
+            self.release.set()
+            return self.group.do(key, lambda key: 'new', key)
+
+        self.assertEqual(
+            'new', self.group.do('bar', forget_and_call, 'bar'))
+
+
+class TestAsyncGroup(testtools.TestCase):
+
+    def setUp(self):
+        super(TestAsyncGroup, self).setUp()
+        self.group = singleflight.AsyncGroup('foo')
+        self.call = mock.Mock()
+        metrics.COALESCED_CALLS.clear()
+
+    async def _call(self, key):
+        self.call(key)
+        await asyncio.sleep(0.01)
+        if key == 'error':
+            raise ValueError()
+        return key.upper()
+
+    def test_do_coalesces(self):
+        async def run():
+            return await asyncio.gather(
+                *[self.group.do(key, self._call, key)
+                  for key in ('bar', 'bar', 'baz')])
+
+        self.assertEqual(['BAR', 'BAR', 'BAZ'], asyncio.run(run()))
+        self.assertEqual(2, self.call.call_count)
+        self.assertEqual(1, metrics.COALESCED_CALLS.value('foo'))
+
+    def test_do_shares_error(self):
+        async def run():
+            return await asyncio.gather(
+                *[self.group.do('error', self._call, 'error')
+                  for _ in range(3)], return_exceptions=True)
+
+        results = asyncio.run(run())
+        self.assertIsInstance(results[0], ValueError)
+        self.assertEqual([results[0]] * 3, results)
+        self.call.assert_called_once_with('error')
+
+    def test_do_survives_cancelled_caller(self):
+        async def run():
+            first = asyncio.ensure_future(
+                self.group.do('bar', self._call, 'bar'))
+            second = asyncio.ensure_future(
+                self.group.do('bar', self._call, 'bar'))
+            await asyncio.sleep(0)
+            first.cancel()
+            return await second
+
+        self.assertEqual('BAR', asyncio.run(run()))
+        self.call.assert_called_once_with('bar')
@@ -0,0 +1,175 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import tempfile
+import threading
+
+import mock
+import testtools
+
+from s3uploader import exceptions
+from s3uploader import state
+
+
+class TestSQLiteStateStore(testtools.TestCase):
+
+    def setUp(self):
+        super(TestSQLiteStateStore, self).setUp()
+        tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(tmpdir, 'state.db')
+        self.clock = mock.Mock(return_value=100.0)
+        self.store = state.SQLiteStateStore(self.path, clock=self.clock)
+
+    def test_wal_mode(self):
+        mode = self.store._connection().execute(
+            'PRAGMA journal_mode').fetchone()[0]
+        self.assertEqual('wal', mode)
+
+    def test_create(self):
+        self.store.create('foo')
+        asset = self.store.get('foo')
+        self.assertEqual(state.CREATED, asset.status)
+        self.assertEqual(100.0, asset.created_at)
+        self.assertFalse(asset.uploaded)
+
+    def test_get_unknown(self):
+        self.assertIsNone(self.store.get('foo'))
+
+    def test_mark_uploaded(self):
+        self.store.create('foo')
+        self.clock.return_value = 200.0
+        self.store.mark_uploaded('foo', 42)
+        asset = self.store.get('foo')
+        self.assertTrue(asset.uploaded)
+        self.assertEqual(42, asset.size)
+        self.assertEqual(100.0, asset.created_at)
+        self.assertEqual(200.0, asset.uploaded_at)
+
+    def test_mark_uploaded_unknown(self):
+        self.assertRaises(exceptions.AssetNotFoundError,
+                          self.store.mark_uploaded, 'foo')
+
+    def test_record(self):
+        self.store.create('foo')
+        self.store.record(state.AssetState('foo', state.UPLOADED))
+        self.store.record(state.AssetState('bar', state.UPLOADED, size=1))
+        self.assertTrue(self.store.get('foo').uploaded)
+        self.assertEqual(100.0, self.store.get('foo').uploaded_at)
+        self.assertEqual(1, self.store.get('bar').size)
+
+    def test_record_does_not_downgrade(self):
+        self.store.record(state.AssetState('foo', state.UPLOADED))
+        self.store.record(state.AssetState('foo', state.CREATED))
+        self.assertTrue(self.store.get('foo').uploaded)
+
+    def test_list(self):
+        for i in range(5):
+            self.clock.return_value = 100.0 + i
+            self.store.create('foo%d' % i)
+        self.store.mark_uploaded('foo1', 10)
+        self.store.mark_uploaded('foo3', 10)
+        page = self.store.list(2)
+        self.assertEqual(['foo0', 'foo1'], [a.asset_id for a in page])
+        page = self.store.list(2, after=(101.0, 'foo1'))
+        self.assertEqual(['foo2', 'foo3'], [a.asset_id for a in page])
+        page = self.store.list(10, status=state.UPLOADED)
+        self.assertEqual(['foo1', 'foo3'], [a.asset_id for a in page])
+        page = self.store.list(10, created_after=101.0, created_before=103.0)
+        self.assertEqual(['foo1', 'foo2'], [a.asset_id for a in page])
+
+    def test_list_same_creation_time(self):
+        for asset_id in ('foo', 'bar', 'baz'):
+            self.store.create(asset_id)
+        page = self.store.list(2)
+        self.assertEqual(['bar', 'baz'], [a.asset_id for a in page])
+        page = self.store.list(2, after=(100.0, 'baz'))
+        self.assertEqual(['foo'], [a.asset_id for a in page])
+
+    def test_shared_across_threads_and_stores(self):
+        other = state.SQLiteStateStore(self.path)
+        thread = threading.Thread(target=self.store.create, args=('foo',))
+        thread.start()
+        thread.join()
+        self.assertIsNotNone(other.get('foo'))
+
+
+class TestTaggingStateStore(testtools.TestCase):
+
+    def setUp(self):
+        super(TestTaggingStateStore, self).setUp()
+        self.storage = mock.Mock()
+        self.store = state.TaggingStateStore(self.storage)
+
+    def test_get(self):
+        self.storage.get_upload_status.return_value = True
+        self.assertTrue(self.store.get('foo').uploaded)
+
+    def test_get_not_found(self):
+        self.storage.get_upload_status.side_effect = (
+            exceptions.AssetNotFoundError())
+        self.assertIsNone(self.store.get('foo'))
+
+    def test_mark_uploaded(self):
+        self.store.mark_uploaded('foo', 10)
+        self.storage.update_upload_status.assert_called_once_with('foo')
+
+    def test_mark_uploaded_write_behind(self):
+        write_behind = mock.Mock()
+        store = state.TaggingStateStore(self.storage, write_behind)
+        store.mark_uploaded('foo', 10)
+        write_behind.append.assert_called_once_with('foo')
+        self.storage.remember_uploaded.assert_called_once_with('foo')
+        self.assertFalse(self.storage.update_upload_status.called)
+
+
+class TestWriteThroughStateStore(testtools.TestCase):
+
+    def setUp(self):
+        super(TestWriteThroughStateStore, self).setUp()
+        self.local = state.SQLiteStateStore(':memory:')
+        self.remote = mock.Mock()
+        self.store = state.WriteThroughStateStore(self.local, self.remote)
+
+    def test_mark_uploaded(self):
+        self.store.create('foo')
+        self.store.mark_uploaded('foo', 10)
+        self.remote.mark_uploaded.assert_called_once_with('foo', 10)
+        self.assertTrue(self.local.get('foo').uploaded)
+
+    def test_mark_uploaded_remote_failure(self):
+        self.store.create('foo')
+        self.remote.mark_uploaded.side_effect = (
+            exceptions.AssetNotFoundError())
+        self.assertRaises(exceptions.AssetNotFoundError,
+                          self.store.mark_uploaded, 'foo')
+        self.assertFalse(self.local.get('foo').uploaded)
+
+    def test_get_uploaded_is_local(self):
+        self.local.record(state.AssetState('foo', state.UPLOADED))
+        self.assertTrue(self.store.get('foo').uploaded)
+        self.assertFalse(self.remote.get.called)
+
+    def test_get_falls_back_to_remote(self):
+        self.remote.get.return_value = state.AssetState('foo', state.UPLOADED)
+        self.assertTrue(self.store.get('foo').uploaded)
+        self.assertTrue(self.local.get('foo').uploaded)
+
+    def test_get_unknown(self):
+        self.remote.get.return_value = None
+        self.assertIsNone(self.store.get('foo'))
+
+    def test_list_is_local(self):
+        self.store.create('foo')
+        self.assertEqual(['foo'],
+                         [a.asset_id for a in self.store.list(10)])
+        self.assertFalse(self.remote.list.called)
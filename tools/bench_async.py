@@ -0,0 +1,78 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Compare the threaded and the asyncio services against a slow fake S3.
+
+Every GET /asset/<id> costs a tagging request to the fake S3, which answers
+after --latency seconds; the readiness cache is disabled:
+
+    python tools/bench_async.py --concurrency 500 --latency 0.1
+
+Requires uvicorn and aiobotocore.
+"""
+
+import argparse
+import asyncio
+import itertools
+
+import loadgen
+
+
+def _bench(args, service_args, s3_port):
+    port = loadgen.free_port()
+    env = loadgen.service_env(
+        s3_port,
+        S3UPLOADER_READINESS_CACHE_SIZE=0,
+        S3UPLOADER_MAX_POOL_CONNECTIONS=args.concurrency)
+    proc = loadgen.start(service_args(port), port, env)
+    counter = itertools.count()
+
+    async def next_request():
+        path = '/asset/bench-%d' % (next(counter) % args.assets)
+        status, _ = await loadgen.request(port, 'GET', path)
+        return 'GET /asset/<id>', status
+
+    try:
+        samples = asyncio.run(
+            loadgen.drive(next_request, args.concurrency, args.duration))
+    finally:
+        proc.terminate()
+        proc.wait()
+    return loadgen.summarize(samples, args.duration)['GET /asset/<id>']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--concurrency', type=int, default=200)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='seconds the fake S3 takes to answer')
+    parser.add_argument('--assets', type=int, default=1000)
+    args = parser.parse_args()
+
+    s3_port = loadgen.free_port()
+    fake_s3 = loadgen.start_fake_s3(s3_port, args.latency, args.assets)
+    try:
+        for mode, service_args in (
+                ('threaded', loadgen.threaded_service_args),
+                ('asyncio', loadgen.asyncio_service_args)):
+            result = _bench(args, service_args, s3_port)
+            print('%-8s %8.1f req/s  p50 %7.1fms  p99 %7.1fms  errors %d'
+                  % (mode, result['rps'], result['p50_ms'],
+                     result['p99_ms'], result['errors']))
+    finally:
+        fake_s3.terminate()
+        fake_s3.wait()
+
+
+if __name__ == '__main__':
+    main()
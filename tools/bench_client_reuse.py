@@ -0,0 +1,64 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Compare requests/sec with a per-request and a shared S3 client.
+
+POST /asset only presigns, so no S3 endpoint is needed and the difference
+between the two runs is the cost of building the client on every request:
+
+    python tools/bench_client_reuse.py --requests 500
+"""
+
+import argparse
+import os
+import time
+
+import mock
+
+
+def _setdefault_env():
+    os.environ.setdefault('AWS_BUCKET', 'bench-bucket')
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'AKIDEXAMPLE')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'bench-secret')
+    os.environ.setdefault('AWS_REGION', 'us-east-1')
+
+
+def _run(client, requests):
+    start = time.time()
+    for _ in range(requests):
+        response = client.post('/asset')
+        assert response.status_code == 200, response.status_code
+    return requests / (time.time() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=200)
+    args = parser.parse_args()
+
+    _setdefault_env()
+    from s3uploader.cmds import service
+    from s3uploader import s3
+
+    client = service.app.test_client()
+    with mock.patch.object(s3, 'get_asset_manager', s3.AssetManager):
+        per_request = _run(client, args.requests)
+    s3.reset_asset_manager()
+    shared = _run(client, args.requests)
+
+    print('per-request client: %8.1f req/s' % per_request)
+    print('shared client:      %8.1f req/s' % shared)
+    print('speedup:            %8.1fx' % (shared / per_request))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Measure presigned GET URLs and POST policies per second.
+
+Compares botocore (configured for SigV4) with s3uploader.sigv4:
+
+    python tools/bench_presign.py --iterations 20000
+"""
+
+import argparse
+import time
+import uuid
+
+import boto3
+from botocore import config as boto_config
+
+from s3uploader import sigv4
+
+
+def _rate(func, keys):
+    start = time.perf_counter()
+    for key in keys:
+        func(key)
+    return len(keys) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--iterations', type=int, default=5000)
+    parser.add_argument('--region', default='us-west-2')
+    args = parser.parse_args()
+
+    session = boto3.session.Session(
+        aws_access_key_id='AKIDEXAMPLE',
+        aws_secret_access_key='bench-secret',
+        region_name=args.region)
+    client = session.client(
+        's3', config=boto_config.Config(signature_version='s3v4'))
+    presigner = sigv4.SigV4Presigner.from_client(
+        client, 'bench-bucket', 'AKIDEXAMPLE', 'bench-secret')
+    keys = [str(uuid.uuid4()) for _ in range(args.iterations)]
+
+    runs = [
+        ('GET  botocore', lambda key: client.generate_presigned_url(
+            ClientMethod='get_object',
+            Params={'Bucket': 'bench-bucket', 'Key': key},
+            ExpiresIn=60, HttpMethod='GET')),
+        ('GET  native', lambda key: presigner.presign_get(key, 60)),
+        ('POST botocore', lambda key: client.generate_presigned_post(
+            Bucket='bench-bucket', Key=key)),
+        ('POST native', presigner.presign_post),
+    ]
+    for name, func in runs:
+        print('%-14s %10.0f signatures/s' % (name, _rate(func, keys)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Measure the throughput and the memory of the download proxy.
+
+Clients download whole assets through GET /asset/<id>/content, from the
+threaded and the asyncio services in turn. The objects are streamed in
+S3UPLOADER_PROXY_CHUNK_SIZE chunks, then in chunks as large as the objects
+(as a proxy buffering them would):
+
+    python tools/bench_proxy.py --concurrency 50 --object-size 8388608
+
+The memory per connection is the growth of the service's resident memory
+under load, over the number of connections. Linux only (it reads /proc);
+the asyncio service requires uvicorn and aiobotocore.
+"""
+
+import argparse
+import asyncio
+import itertools
+import time
+
+import loadgen
+
+
+def rss(pid):
+    """Return the resident memory of a process in bytes."""
+    with open('/proc/%d/status' % pid) as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+async def fetch(port, path):
+    """Download path, return its status and how many bytes it had."""
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    try:
+        writer.write(('GET %s HTTP/1.1\r\nHost: 127.0.0.1:%d\r\n'
+                      'Connection: close\r\n\r\n' % (path, port)).encode())
+        await writer.drain()
+        head = await reader.readuntil(b'\r\n\r\n')
+        size = 0
+        while True:
+            chunk = await reader.read(256 * 1024)
+            if not chunk:
+                break
+            size += len(chunk)
+    finally:
+        writer.close()
+    return int(head.split(b' ', 2)[1]), size
+
+
+def _bench(args, service_args, s3_port, chunk_size):
+    port = loadgen.free_port()
+    env = loadgen.service_env(
+        s3_port,
+        S3UPLOADER_PROXY='true',
+        S3UPLOADER_PROXY_CHUNK_SIZE=chunk_size,
+        S3UPLOADER_MAX_POOL_CONNECTIONS=args.concurrency)
+    proc = loadgen.start(service_args(port), port, env)
+    counter = itertools.count()
+    received = [0]
+    peak = [0]
+
+    async def next_request():
+        path = '/asset/bench-%d/content' % (next(counter) % args.assets)
+        status, size = await fetch(port, path)
+        received[0] += size
+        return 'GET /asset/<id>/content', status
+
+    async def sample_memory(deadline):
+        while time.perf_counter() < deadline:
+            peak[0] = max(peak[0], rss(proc.pid))
+            await asyncio.sleep(0.05)
+
+    async def run():
+        # warm up: build the clients, fill the connection pools
+        await loadgen.drive(next_request, args.concurrency, 1)
+        received[0] = 0
+        idle = rss(proc.pid)
+        deadline = time.perf_counter() + args.duration
+        samples, _ = await asyncio.gather(
+            loadgen.drive(next_request, args.concurrency, args.duration),
+            sample_memory(deadline))
+        return samples, idle
+
+    try:
+        samples, idle = asyncio.run(run())
+    finally:
+        proc.terminate()
+        proc.wait()
+    result = loadgen.summarize(samples, args.duration)[
+        'GET /asset/<id>/content']
+    result['mb_per_s'] = received[0] / args.duration / 1024 / 1024
+    result['kb_per_connection'] = max(peak[0] - idle, 0) / 1024.0 / (
+        args.concurrency)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--latency', type=float, default=0.01,
+                        help='seconds the fake S3 takes to answer')
+    parser.add_argument('--assets', type=int, default=100)
+    parser.add_argument('--object-size', type=int, default=8 * 1024 * 1024)
+    parser.add_argument('--chunk-size', type=int, default=64 * 1024)
+    parser.add_argument('--modes', default='threaded,asyncio')
+    args = parser.parse_args()
+
+    s3_port = loadgen.free_port()
+    fake_s3 = loadgen.start_fake_s3(s3_port, args.latency, args.assets,
+                                    args.object_size)
+    services = {'threaded': loadgen.threaded_service_args,
+                'asyncio': loadgen.asyncio_service_args}
+    try:
+        for mode in args.modes.split(','):
+            for name, chunk_size in (('streamed', args.chunk_size),
+                                     ('buffered', args.object_size)):
+                result = _bench(args, services[mode], s3_port, chunk_size)
+                print('%-8s %-8s %7.1f MB/s %6.1f req/s  p50 %7.1fms  '
+                      'p99 %7.1fms  %8.1f KB/connection  errors %d'
+                      % (mode, name, result['mb_per_s'], result['rps'],
+                         result['p50_ms'], result['p99_ms'],
+                         result['kb_per_connection'], result['errors']))
+    finally:
+        fake_s3.terminate()
+        fake_s3.wait()
+
+
+if __name__ == '__main__':
+    main()
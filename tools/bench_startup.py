@@ -0,0 +1,159 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Measure the cold start of the WSGI and ASGI apps.
+
+Each run is a fresh interpreter, which imports the app and serves a single
+GET /asset/<id> (a tagging lookup against a local fake S3), as a
+short-lived container or function would. Reported are the medians of:
+
+ * import: importing the app module
+ * first response: from the start of the import to the first response
+ * process: from spawning the interpreter to the first response
+
+Save the results with --output, and compare a later run against them with
+--baseline: the command fails if a figure regressed beyond --tolerance,
+which makes it usable as a gate:
+
+    python tools/bench_startup.py --output startup.json
+    python tools/bench_startup.py --baseline startup.json --tolerance 0.2
+
+The ASGI app requires aiobotocore.
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+import time
+
+import loadgen
+
+
+CHILD = {
+    'wsgi': (
+        'import time\n'
+        'start = time.perf_counter()\n'
+        'from s3uploader.cmds import service\n'
+        'imported = time.perf_counter()\n'
+        'environ = {"REQUEST_METHOD": "GET", "PATH_INFO": "/asset/bench-0",\n'
+        '           "QUERY_STRING": "", "SERVER_NAME": "127.0.0.1",\n'
+        '           "SERVER_PORT": "5000", "SERVER_PROTOCOL": "HTTP/1.1",\n'
+        '           "wsgi.url_scheme": "http", "wsgi.input": None,\n'
+        '           "wsgi.errors": None}\n'
+        'status = []\n'
+        'b"".join(service.app(environ, lambda s, h: status.append(s)))\n'
+        'print(status[0].split()[0], imported - start,\n'
+        '      time.perf_counter() - start, flush=True)\n'),
+    'asgi': (
+        'import time\n'
+        'start = time.perf_counter()\n'
+        'from s3uploader import asgi\n'
+        'imported = time.perf_counter()\n'
+        'import asyncio\n'
+        'scope = {"type": "http", "method": "GET", "path": "/asset/bench-0",\n'
+        '         "query_string": b"", "headers": []}\n'
+        'status = []\n'
+        'async def receive():\n'
+        '    return {"type": "http.request", "body": b""}\n'
+        'async def send(message):\n'
+        '    status.append(message.get("status"))\n'
+        'async def main():\n'
+        '    await asgi.app(scope, receive, send)\n'
+        '    print(status[0], imported - start, time.perf_counter() - start,\n'
+        '          flush=True)\n'
+        '    await asgi.app.shutdown()\n'
+        'asyncio.run(main())\n'),
+}
+
+
+def _run(app, env):
+    """Return the import, first response and process times in ms."""
+    spawned = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, '-c', CHILD[app]],
+                            env=env, stdout=subprocess.PIPE)
+    line = proc.stdout.readline()
+    process = time.perf_counter() - spawned
+    proc.wait()
+    try:
+        status, imported, first_response = line.split()
+    except ValueError:
+        raise RuntimeError('the %s app failed to start' % app)
+    if int(status) != 200:
+        raise RuntimeError('the %s app answered %s' % (app, status.decode()))
+    return {'import_ms': float(imported) * 1000,
+            'first_response_ms': float(first_response) * 1000,
+            'process_ms': process * 1000}
+
+
+def _median(runs, name):
+    values = sorted(run[name] for run in runs)
+    return values[len(values) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--apps', default='wsgi,asgi')
+    parser.add_argument('--set', action='append', default=[],
+                        metavar='NAME=VALUE', help='environment of the apps')
+    parser.add_argument('--output', help='save the results as JSON')
+    parser.add_argument('--baseline', help='results to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='relative slowdown over the baseline that '
+                             'fails the run')
+    args = parser.parse_args()
+
+    s3_port = loadgen.free_port()
+    fake_s3 = loadgen.start_fake_s3(s3_port, seed=1)
+    env = dict(loadgen.os.environ, **loadgen.service_env(
+        s3_port, **dict(item.split('=', 1) for item in args.set)))
+    results = {}
+    try:
+        for app in args.apps.split(','):
+            # NOTE(armax): a first run warms up the OS caches, as a
+            # deployed image would have.
+            _run(app, env)
+            runs = [_run(app, env) for _ in range(args.runs)]
+            results[app] = dict((name, _median(runs, name))
+                                for name in runs[0])
+    finally:
+        fake_s3.terminate()
+        fake_s3.wait()
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    regressions = []
+    for app, result in sorted(results.items()):
+        line = '%-5s' % app
+        for name in ('import_ms', 'first_response_ms', 'process_ms'):
+            line += '  %s %7.1fms' % (name[:-3], result[name])
+            before = baseline.get(app, {}).get(name)
+            if before:
+                change = result[name] / before - 1
+                line += ' (%+.1f%%)' % (change * 100)
+                if change > args.tolerance:
+                    regressions.append('%s %s' % (app, name))
+        print(line)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print('Results saved to %s' % args.output)
+    if regressions:
+        raise SystemExit('regressed beyond %d%%: %s' % (
+            args.tolerance * 100, ', '.join(regressions)))
+
+
+if __name__ == '__main__':
+    main()
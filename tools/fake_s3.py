@@ -0,0 +1,281 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""A tiny in-memory S3 stand-in for benchmarks, with injected latency.
+
+Only the operations used by the S3 uploader are supported, and requests
+are not authenticated. Point the service at it with:
+
+    python tools/fake_s3.py --port 9000 --latency 0.05 --seed 1000
+    export S3UPLOADER_ENDPOINT_URL=http://127.0.0.1:9000
+"""
+
+import argparse
+import hashlib
+from http import server
+import itertools
+import threading
+import time
+from urllib import parse
+from xml.sax import saxutils
+
+
+class Bucket(object):
+
+    def __init__(self):
+        self.objects = {}
+        # upload ID -> {'key': key, 'parts': {part number: body}}
+        self.uploads = {}
+        self.lock = threading.Lock()
+        self._upload_ids = itertools.count(1)
+
+    def create_upload(self, key):
+        with self.lock:
+            upload_id = 'upload-%d' % next(self._upload_ids)
+            self.uploads[upload_id] = {'key': key, 'parts': {}}
+        return upload_id
+
+    def put(self, key, body=b'', tags=None):
+        with self.lock:
+            self.objects[key] = {'body': body, 'tags': tags or {},
+                                 'modified': time.time()}
+
+    def seed(self, count, prefix='bench-', uploaded=True, size=0):
+        tags = {'Status': 'Uploaded'} if uploaded else {}
+        # NOTE(armax): the objects share their body, seeding large ones is
+        # cheap.
+        body = b'x' * size
+        for i in range(count):
+            self.put('%s%d' % (prefix, i), body, tags=dict(tags))
+
+
+class Handler(server.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _parse(self):
+        url = parse.urlsplit(self.path)
+        query = dict(parse.parse_qsl(url.query, keep_blank_values=True))
+        path = parse.unquote(url.path).lstrip('/')
+        host = self.headers.get('Host', '').split(':')[0]
+        if host.count('.') and not host.replace('.', '').isdigit():
+            # virtual hosted-style, the bucket is in the host name
+            return path, query
+        return path.partition('/')[2], query
+
+    def _reply(self, status, body=b'', headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if body and self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _error(self, status, code):
+        body = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<Error><Code>%s</Code><Message>%s</Message></Error>'
+                % (code, code)).encode('utf-8')
+        self._reply(status, body, {'Content-Type': 'application/xml'})
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def _handle(self):
+        time.sleep(self.server.latency)
+        key, query = self._parse()
+        if 'tagging' in query:
+            resource = 'tagging'
+        elif 'uploads' in query:
+            resource = 'uploads'
+        elif 'uploadId' in query:
+            resource = 'upload'
+        else:
+            resource = 'object'
+        handler = getattr(self, '_%s_%s' % (self.command.lower(), resource),
+                          None)
+        if handler is None:
+            self._body()
+            return self._error(501, 'NotImplemented')
+        handler(key, query)
+
+    do_GET = do_PUT = do_POST = do_HEAD = do_DELETE = _handle
+
+    def _get_tagging(self, key, query):
+        obj = self.server.bucket.objects.get(key)
+        if obj is None:
+            return self._error(404, 'NoSuchKey')
+        tags = ''.join(
+            '<Tag><Key>%s</Key><Value>%s</Value></Tag>'
+            % (saxutils.escape(k), saxutils.escape(v))
+            for k, v in obj['tags'].items())
+        body = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<Tagging><TagSet>%s</TagSet></Tagging>' % tags)
+        self._reply(200, body.encode('utf-8'),
+                    {'Content-Type': 'application/xml'})
+
+    def _put_object(self, key, query):
+        self.server.bucket.put(key, self._body())
+        self._reply(200, headers={'ETag': '"fake"'})
+
+    def _post_object(self, key, query):
+        # a presigned POST, to the bucket's root: the key is a form field
+        boundary = self.headers.get('Content-Type', '').partition(
+            'boundary=')[2].encode('utf-8')
+        fields = {}
+        for part in self._body().split(b'--' + boundary)[1:-1]:
+            head, _, value = part[2:-2].partition(b'\r\n\r\n')
+            name = head.split(b'name="')[1].split(b'"')[0].decode('utf-8')
+            fields[name] = value
+        if 'key' not in fields or 'file' not in fields:
+            return self._error(400, 'InvalidArgument')
+        self.server.bucket.put(fields['key'].decode('utf-8'), fields['file'])
+        self._reply(204)
+
+    def _get_object(self, key, query):
+        obj = self.server.bucket.objects.get(key)
+        if obj is None:
+            return self._error(404, 'NoSuchKey')
+        body = obj['body']
+        etag = '"%d-%d"' % (len(body), obj['modified'] * 1000)
+        headers = {'Content-Type': 'application/octet-stream',
+                   'Accept-Ranges': 'bytes', 'ETag': etag}
+        if self.headers.get('If-None-Match') == etag:
+            return self._reply(304, headers={'ETag': etag})
+        byte_range = self.headers.get('Range', '')
+        if not byte_range.startswith('bytes='):
+            return self._reply(200, body, headers)
+        start, _, end = byte_range[6:].partition('-')
+        start = int(start)
+        end = min(int(end) if end else len(body) - 1, len(body) - 1)
+        if start >= len(body):
+            return self._error(416, 'InvalidRange')
+        headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end, len(body))
+        self._reply(206, body[start:end + 1], headers)
+
+    _head_object = _get_object
+
+    def _xml(self, status, body):
+        self._reply(status, ('<?xml version="1.0" encoding="UTF-8"?>\n%s'
+                             % body).encode('utf-8'),
+                    {'Content-Type': 'application/xml'})
+
+    def _upload(self, key, query):
+        upload = self.server.bucket.uploads.get(query['uploadId'])
+        if upload is None or upload['key'] != key:
+            self._body()
+            self._error(404, 'NoSuchUpload')
+        return upload
+
+    def _post_uploads(self, key, query):
+        self._body()
+        upload_id = self.server.bucket.create_upload(key)
+        self._xml(200, '<InitiateMultipartUploadResult><Key>%s</Key>'
+                       '<UploadId>%s</UploadId>'
+                       '</InitiateMultipartUploadResult>'
+                  % (saxutils.escape(key), upload_id))
+
+    def _put_upload(self, key, query):
+        upload = self._upload(key, query)
+        if upload is None:
+            return
+        body = self._body()
+        upload['parts'][int(query['partNumber'])] = body
+        self._reply(200, headers={
+            'ETag': '"%s"' % hashlib.md5(body).hexdigest()})
+
+    def _get_upload(self, key, query):
+        upload = self._upload(key, query)
+        if upload is None:
+            return
+        parts = ''.join(
+            '<Part><PartNumber>%d</PartNumber><ETag>"%s"</ETag>'
+            '<Size>%d</Size></Part>'
+            % (n, hashlib.md5(body).hexdigest(), len(body))
+            for n, body in sorted(upload['parts'].items()))
+        self._xml(200, '<ListPartsResult><IsTruncated>false</IsTruncated>'
+                       '%s</ListPartsResult>' % parts)
+
+    def _post_upload(self, key, query):
+        upload = self._upload(key, query)
+        if upload is None:
+            return
+        body = self._body().decode('utf-8')
+        numbers = [int(n.split('</PartNumber>')[0])
+                   for n in body.split('<PartNumber>')[1:]]
+        if not numbers or any(n not in upload['parts'] for n in numbers):
+            return self._error(400, 'InvalidPart')
+        self.server.bucket.put(
+            key, b''.join(upload['parts'][n] for n in numbers))
+        del self.server.bucket.uploads[query['uploadId']]
+        self._xml(200, '<CompleteMultipartUploadResult><Key>%s</Key>'
+                       '<ETag>"fake"</ETag></CompleteMultipartUploadResult>'
+                  % saxutils.escape(key))
+
+    def _delete_upload(self, key, query):
+        if self._upload(key, query) is None:
+            return
+        del self.server.bucket.uploads[query['uploadId']]
+        self._reply(204)
+
+    def _put_tagging(self, key, query):
+        body = self._body().decode('utf-8')
+        obj = self.server.bucket.objects.get(key)
+        if obj is None:
+            return self._error(404, 'NoSuchKey')
+        tags = {}
+        for tag in body.split('<Tag>')[1:]:
+            name = tag.split('<Key>')[1].split('</Key>')[0]
+            value = tag.split('<Value>')[1].split('</Value>')[0]
+            tags[saxutils.unescape(name)] = saxutils.unescape(value)
+        obj['tags'] = tags
+        self._reply(200)
+
+
+class FakeS3Server(server.ThreadingHTTPServer):
+
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, address, latency=0.0):
+        server.ThreadingHTTPServer.__init__(self, address, Handler)
+        self.latency = latency
+        self.bucket = Bucket()
+
+    @property
+    def endpoint_url(self):
+        return 'http://%s:%d' % self.server_address[:2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9000)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds added to every request')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='number of uploaded objects named bench-<n>')
+    parser.add_argument('--object-size', type=int, default=0,
+                        help='size of the seeded objects in bytes')
+    args = parser.parse_args()
+
+    fake = FakeS3Server((args.host, args.port), latency=args.latency)
+    fake.bucket.seed(args.seed, size=args.object_size)
+    fake.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
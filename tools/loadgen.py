@@ -0,0 +1,157 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Helpers shared by the benchmarks: processes, HTTP load and statistics."""
+
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import time
+
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 0.5).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError('nothing is listening on port %d' % port)
+
+
+def start(args, port, env=None):
+    """Start a process listening on port, and wait for it to be ready."""
+    proc = subprocess.Popen(
+        args, env=dict(os.environ, **(env or {})),
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_port(port)
+    except Exception:
+        proc.kill()
+        raise
+    return proc
+
+
+def start_fake_s3(port, latency=0.0, seed=0, object_size=0):
+    return start([sys.executable, os.path.join(TOOLS_DIR, 'fake_s3.py'),
+                  '--port', str(port), '--latency', str(latency),
+                  '--seed', str(seed), '--object-size', str(object_size)],
+                 port)
+
+
+def service_env(s3_port, **settings):
+    """Return the environment to run the service against a fake S3."""
+    env = {
+        'AWS_BUCKET': 'bench-bucket',
+        'AWS_ACCESS_KEY_ID': 'AKIDEXAMPLE',
+        'AWS_SECRET_ACCESS_KEY': 'bench-secret',
+        'AWS_REGION': 'us-east-1',
+        'S3UPLOADER_ENDPOINT_URL': 'http://127.0.0.1:%d' % s3_port,
+    }
+    env.update((k, str(v)) for k, v in settings.items())
+    return env
+
+
+def threaded_service_args(port):
+    return [sys.executable, '-c',
+            'from werkzeug import serving\n'
+            'from s3uploader.cmds import service\n'
+            'serving.run_simple("127.0.0.1", %d, service.app, threaded=True)'
+            % port]
+
+
+def asyncio_service_args(port):
+    return [sys.executable, '-m', 'uvicorn', 's3uploader.asgi:app',
+            '--port', str(port), '--log-level', 'warning',
+            '--backlog', '4096']
+
+
+async def request(port, method, path, body=b'', headers=None):
+    """Issue a single HTTP request, return its status and body."""
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    try:
+        lines = ['%s %s HTTP/1.1' % (method, path),
+                 'Host: 127.0.0.1:%d' % port,
+                 'Connection: close',
+                 'Content-Length: %d' % len(body)]
+        lines.extend('%s: %s' % item for item in (headers or {}).items())
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode() + body)
+        await writer.drain()
+        response = await reader.read()
+    finally:
+        writer.close()
+    head, _, payload = response.partition(b'\r\n\r\n')
+    return int(head.split(b' ', 2)[1]), payload
+
+
+async def drive(next_request, concurrency, duration):
+    """Run requests from concurrency workers for duration seconds.
+
+    next_request is a coroutine function returning the name of the request
+    and its status; returns a list of (name, status, latency) samples.
+    """
+    samples = []
+    deadline = time.perf_counter() + duration
+
+    async def worker():
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            try:
+                name, status = await next_request()
+            except OSError:
+                name, status = 'connection', 0
+            samples.append((name, status, time.perf_counter() - start))
+
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return samples
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    index = min(int(round(fraction * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+def summarize(samples, duration):
+    """Return req/s, error count and latency percentiles per request."""
+    by_name = {}
+    for name, status, latency in samples:
+        by_name.setdefault(name, []).append((status, latency))
+    summary = {}
+    for name, results in sorted(by_name.items()):
+        latencies = [latency for _, latency in results]
+        summary[name] = {
+            'requests': len(results),
+            'errors': sum(1 for status, _ in results
+                          if not 200 <= status < 400),
+            'rps': len(results) / duration,
+            'p50_ms': percentile(latencies, 0.50) * 1000,
+            'p95_ms': percentile(latencies, 0.95) * 1000,
+            'p99_ms': percentile(latencies, 0.99) * 1000,
+        }
+    return summary
@@ -0,0 +1,241 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Load-test the service against a local fake S3 with injected latency.
+
+Each worker loops over a weighted mix of the asset lifecycle: create an
+asset (POST /asset), upload it to the fake S3 and mark it as uploaded
+(PUT /asset/<id>), and download assets (GET /asset/<id>). Throughput and
+latency percentiles are reported per endpoint, and can be saved as JSON
+to compare commits:
+
+    python tools/loadtest.py --concurrency 50 --latency 0.02 \\
+        --output before.json
+    git checkout my-branch
+    python tools/loadtest.py --concurrency 50 --latency 0.02 \\
+        --baseline before.json
+
+Service settings are passed with --set, e.g. --set S3UPLOADER_STATE_DB=...
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+import loadgen
+
+
+CREATE = 'POST /asset'
+MARK = 'PUT /asset/<id>'
+DOWNLOAD = 'GET /asset/<id>'
+
+
+def parse_mix(value):
+    """Parse create=1,mark=1,download=8 into {endpoint: weight}."""
+    names = {'create': CREATE, 'mark': MARK, 'download': DOWNLOAD}
+    mix = {}
+    for item in value.split(','):
+        name, _, weight = item.partition('=')
+        if name.strip() not in names:
+            raise argparse.ArgumentTypeError(
+                'unknown operation %r, expected one of %s'
+                % (name, ', '.join(sorted(names))))
+        try:
+            mix[names[name.strip()]] = float(weight)
+        except ValueError:
+            raise argparse.ArgumentTypeError('bad weight %r' % weight)
+    if not any(mix.values()):
+        raise argparse.ArgumentTypeError('the mix is empty')
+    return mix
+
+
+class Workload(object):
+    """The create/mark-uploaded/download mix run by every worker."""
+
+    def __init__(self, port, s3_port, mix, seeded, rand=None):
+        self.port = port
+        self.s3_port = s3_port
+        self.operations = list(mix)
+        self.weights = [mix[operation] for operation in self.operations]
+        self.created = []
+        self.uploaded = ['bench-%d' % i for i in range(seeded)]
+        self.random = rand or random.Random(42)
+
+    async def next_request(self):
+        operation = self.random.choices(self.operations, self.weights)[0]
+        if operation == MARK and not self.created:
+            operation = CREATE
+        if operation == DOWNLOAD and not self.uploaded:
+            operation = CREATE
+        return operation, await getattr(self, '_' + operation.split()[0])()
+
+    async def _POST(self):
+        status, body = await loadgen.request(self.port, 'POST', '/asset')
+        if status == 200:
+            asset = json.loads(body.decode('utf-8'))
+            # (asset ID, S3 key) pairs
+            self.created.append(
+                (asset['id'], asset['upload_url']['fields']['key']))
+        return status
+
+    async def _PUT(self):
+        asset_id, key = self.created.pop(
+            self.random.randrange(len(self.created)))
+        # NOTE(armax): the upload itself goes straight to S3, like clients
+        # do, and is not part of the service's latency.
+        await loadgen.request(self.s3_port, 'PUT',
+                              '/bench-bucket/%s' % key, b'x' * 1024)
+        status, _ = await loadgen.request(
+            self.port, 'PUT', '/asset/%s' % asset_id,
+            json.dumps({'Status': 'Uploaded'}).encode('utf-8'),
+            {'Content-Type': 'application/json'})
+        if status == 200:
+            self.uploaded.append(asset_id)
+        return status
+
+    async def _GET(self):
+        asset_id = self.random.choice(self.uploaded)
+        status, _ = await loadgen.request(
+            self.port, 'GET', '/asset/%s?timeout=60' % asset_id)
+        return status
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=loadgen.TOOLS_DIR,
+            stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    s3_port = loadgen.free_port()
+    port = loadgen.free_port()
+    fake_s3 = loadgen.start_fake_s3(s3_port, args.latency, args.seed)
+    service_args = {'threaded': loadgen.threaded_service_args,
+                    'asyncio': loadgen.asyncio_service_args}[args.mode]
+    env = loadgen.service_env(s3_port, **dict(args.settings))
+    try:
+        proc = loadgen.start(service_args(port), port, env)
+        try:
+            workload = Workload(port, s3_port, args.mix, args.seed)
+            if args.warmup:
+                asyncio.run(loadgen.drive(
+                    workload.next_request, args.concurrency, args.warmup))
+            samples = asyncio.run(loadgen.drive(
+                workload.next_request, args.concurrency, args.duration))
+        finally:
+            proc.terminate()
+            proc.wait()
+    finally:
+        fake_s3.terminate()
+        fake_s3.wait()
+
+    endpoints = loadgen.summarize(samples, args.duration)
+    total = loadgen.summarize(
+        [('total', status, latency) for _, status, latency in samples],
+        args.duration).get('total')
+    return {
+        'revision': _git_revision(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': sys.version.split()[0],
+        'settings': {
+            'mode': args.mode,
+            'concurrency': args.concurrency,
+            'duration': args.duration,
+            'latency': args.latency,
+            'mix': dict(args.mix),
+            'service': dict(args.settings),
+        },
+        'endpoints': endpoints,
+        'total': total,
+    }
+
+
+def report(result, baseline=None, out=sys.stdout):
+    rows = sorted(result['endpoints'].items())
+    if result['total']:
+        rows.append(('total', result['total']))
+    for name, stats in rows:
+        line = ('%-16s %9.1f req/s  p50 %7.1fms  p95 %7.1fms  p99 %7.1fms'
+                '  errors %d' % (name, stats['rps'], stats['p50_ms'],
+                                 stats['p95_ms'], stats['p99_ms'],
+                                 stats['errors']))
+        before = None
+        if baseline is not None:
+            before = (baseline['endpoints'].get(name) if name != 'total'
+                      else baseline.get('total'))
+        if before:
+            line += '  (req/s %+.1f%%, p99 %+.1f%%)' % (
+                _change(before['rps'], stats['rps']),
+                _change(before['p99_ms'], stats['p99_ms']))
+        out.write(line + '\n')
+
+
+def _change(before, after):
+    if not before:
+        return 0.0
+    return (after - before) / before * 100
+
+
+def _setting(value):
+    name, sep, setting = value.partition('=')
+    if not sep:
+        raise argparse.ArgumentTypeError('expected NAME=VALUE, got %r'
+                                         % value)
+    return name, setting
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--mode', choices=('threaded', 'asyncio'),
+                        default='threaded')
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--warmup', type=float, default=2,
+                        help='seconds of load before measuring')
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='seconds the fake S3 takes to answer')
+    parser.add_argument('--mix', type=parse_mix,
+                        default=parse_mix('create=1,mark=1,download=8'),
+                        help='relative weights of the create, mark and '
+                             'download operations')
+    parser.add_argument('--seed', type=int, default=1000,
+                        help='number of uploaded assets to start with')
+    parser.add_argument('--set', dest='settings', type=_setting,
+                        action='append', default=[], metavar='NAME=VALUE',
+                        help='environment of the service')
+    parser.add_argument('--output', help='save the results as JSON')
+    parser.add_argument('--baseline', help='results to compare with')
+    args = parser.parse_args()
+
+    result = run(args)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    report(result, baseline)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print('Results saved to %s' % os.path.abspath(args.output))
+
+
+if __name__ == '__main__':
+    main()